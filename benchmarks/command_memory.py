@@ -0,0 +1,72 @@
+"""
+Memory held by the lowered commands of a large generated testlist
+
+    python benchmarks/command_memory.py --targets 200000
+
+Every test shares most of its script with its neighbours, the way generated regressions usually do. The testlist is
+read from yaml, so each repeated value starts out as its own string object
+"""
+
+import argparse
+import gc
+import pathlib
+import tempfile
+import tracemalloc
+
+import yaml
+
+from pysmelt.smelt_muncher import columns_to_targets, lower_targets_to_commands
+from pysmelt.testlist_formats import load_testlist
+
+
+def synthetic_entries(num_targets: int):
+    return [
+        {
+            "name": f"test_{idx}",
+            "rule": "raw_bash",
+            "rule_args": {
+                "cmds": [
+                    "source ${SMELT_ROOT}/setup.sh",
+                    "cd ${TARGET_ROOT}",
+                    f"./simv +seed={idx}",
+                    "check_log sim.log",
+                ],
+                "outputs": {"log": "sim.log"},
+            },
+        }
+        for idx in range(num_targets)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--targets", type=int, default=200_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = pathlib.Path(tmpdir) / "testlist.smelt"
+        path.write_text(yaml.safe_dump(synthetic_entries(args.targets)))
+
+        gc.collect()
+        tracemalloc.start()
+        targets = columns_to_targets(load_testlist(str(path)), default_rules_only=True)
+        commands = lower_targets_to_commands(targets.values(), tmpdir)
+        del targets
+        gc.collect()
+        held, peak = tracemalloc.get_traced_memory()
+        del commands
+        gc.collect()
+        released, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    mib = 1024 * 1024
+    print(f"commands:          {args.targets:>12,}")
+    print(f"peak:              {peak / mib:>12.1f} MiB")
+    print(
+        f"held by commands:  {held / mib:>12.1f} MiB ({held / args.targets:,.0f} bytes/command)"
+    )
+    print(f"after release:     {released / mib:>12.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Events per second across the rust -> python boundary, for the protobuf path (`pop_batch` + `Event.FromString`)
+and the native path (`pop_batch_native` + `classify_native`)
+
+    python benchmarks/event_throughput.py --lines 200000
+
+The decode numbers only need pysmelt's python sources. The end to end numbers need the compiled extension,
+and run a single command that prints `--lines` lines
+"""
+
+import argparse
+import time
+from typing import Callable, List
+
+from pysmelt.interfaces import Command
+from pysmelt.interfaces.runtime import RuntimeRequirements
+from pysmelt.proto.smelt_telemetry import CommandEvent, CommandStdout, Event
+from pysmelt.rc import SmeltRcHolder
+from pysmelt.subscribers import classify_event, classify_native
+
+
+def report(name: str, events: int, seconds: float):
+    print(
+        f"{name:<28} {events:>9} events {seconds:>8.3f}s {events / seconds:>12,.0f} events/s"
+    )
+
+
+def bench_decode(num_events: int):
+    stamp = time.time()
+    secs, nanos = int(stamp), int((stamp % 1) * 1e9)
+    encoded = [
+        bytes(
+            Event(
+                trace_id="trace",
+                command=CommandEvent(
+                    command_ref="bench", stdout=CommandStdout(output=f"line {idx}")
+                ),
+            )
+        )
+        for idx in range(num_events)
+    ]
+    native = [
+        ("command.stdout", "trace", secs, nanos, "bench", (f"line {idx}", 0))
+        for idx in range(num_events)
+    ]
+
+    start = time.perf_counter()
+    for message in encoded:
+        classify_event(Event.FromString(message))
+    report("decode: protobuf", num_events, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for val in native:
+        classify_native(val)
+    report("decode: native", num_events, time.perf_counter() - start)
+
+
+def bench_end_to_end(num_lines: int):
+    try:
+        from pysmelt.pygraph import PyGraph, drain_events, drain_messages
+    except ImportError as exc:
+        print(f"skipping end to end benchmark -- {exc}")
+        return
+
+    command = Command(
+        name="event_throughput",
+        target_type="test",
+        script=[f"seq 1 {num_lines}"],
+        dependencies=[],
+        dependent_files=[],
+        outputs=[],
+        runtime=RuntimeRequirements.default(),
+        working_dir=SmeltRcHolder.current_smelt_root(),
+    )
+
+    def run(name: str, drain: Callable[..., List]):
+        # a fresh graph each time, so the command isn't served from a previous run
+        graph = PyGraph.init_commands_only([command])
+        listener = graph.controller.run_one_test(command.name)
+        total = 0
+        start = time.perf_counter()
+        while not listener.is_done():
+            total += len(drain(listener))
+        report(name, total, time.perf_counter() - start)
+
+    run("end to end: protobuf", drain_messages)
+    run("end to end: native", drain_events)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, default=200_000)
+    args = parser.parse_args()
+
+    bench_decode(args.lines)
+    bench_end_to_end(args.lines)
+
+
+if __name__ == "__main__":
+    main()
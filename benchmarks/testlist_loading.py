@@ -0,0 +1,96 @@
+"""
+Time to turn a large generated testlist in to targets, for each testlist format
+
+    python benchmarks/testlist_loading.py --targets 100000
+
+"per-entry yaml" is how testlists used to be loaded: the pure python yaml loader, and a pydantic model per target.
+Only the default rules are used, so the numbers don't depend on smelt_rules_dir
+"""
+
+import argparse
+import json
+import pathlib
+import tempfile
+import time
+from typing import Any, Dict
+
+import yaml
+from pydantic import BaseModel
+
+from pysmelt.importer import get_default_targets
+from pysmelt.rc import SmeltRcHolder
+from pysmelt.smelt_muncher import columns_to_targets
+from pysmelt.testlist_formats import (
+    COLUMNAR_SUFFIX,
+    TestlistColumns,
+    dump_columnar,
+    load_testlist,
+)
+
+
+def synthetic_entries(num_targets: int):
+    return [
+        {
+            "name": f"test_{idx}",
+            "rule": "raw_bash",
+            "rule_args": {"cmds": [f"echo {idx}"], "outputs": {"log": f"{idx}.log"}},
+        }
+        for idx in range(num_targets)
+    ]
+
+
+def report(name: str, num_targets: int, seconds: float):
+    print(
+        f"{name:<20} {num_targets:>9} targets {seconds:>8.3f}s {num_targets / seconds:>12,.0f} targets/s"
+    )
+
+
+class YamlTarget(BaseModel):
+    name: str
+    rule: str
+    rule_args: Dict[str, Any] = {}
+
+
+def per_entry_yaml(path: pathlib.Path):
+    rule_inst = yaml.safe_load(path.read_text())
+    all_rules = get_default_targets(SmeltRcHolder.current_rc())
+    targets = {}
+    for entry in rule_inst:
+        target = YamlTarget(**entry)
+        target_type = all_rules[target.rule]["target"]
+        targets[target.name] = target_type(name=target.name, **target.rule_args)
+    return targets
+
+
+def bulk(path: pathlib.Path):
+    return columns_to_targets(load_testlist(str(path)), default_rules_only=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--targets", type=int, default=100_000)
+    args = parser.parse_args()
+
+    entries = synthetic_entries(args.targets)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        yaml_path = root / "testlist.smelt"
+        yaml_path.write_text(yaml.safe_dump(entries, sort_keys=False))
+        json_path = root / "testlist.smelt.json"
+        json_path.write_text(json.dumps(entries))
+        columnar_path = root / f"testlist{COLUMNAR_SUFFIX}"
+        dump_columnar(TestlistColumns.from_entries(entries), str(columnar_path))
+
+        for name, load, path in (
+            ("per-entry yaml", per_entry_yaml, yaml_path),
+            ("bulk yaml", bulk, yaml_path),
+            ("bulk json", bulk, json_path),
+            ("bulk columnar", bulk, columnar_path),
+        ):
+            start = time.perf_counter()
+            targets = load(path)
+            report(name, len(targets), time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -33,6 +33,8 @@ pub enum SmeltErr {
     CommandSettingFailed { reason: String },
     #[error("Two commands with the same name {name} where declared")]
     DuplicateCommandName { name: String },
+    #[error("No command named {name} has been set")]
+    UnknownCommand { name: String },
     #[error("{output} was declared twice!")]
     DuplicateOutput { output: CommandDefPath },
     #[error("The following outputs were declared but never created: {missing_outputs:?}")]
@@ -56,7 +56,13 @@ fn main() -> io::Result<()> {
         .field_attribute("time", "#[serde(with = \"crate::serialize_timestamp\")]")
         .field_attribute("rundate", "#[serde(with = \"crate::serialize_timestamp\")]");
 
-    let proto_files = ["data.proto", "client.data.proto", "executed_tests.proto"];
+    let proto_files = [
+        "data.proto",
+        "client.data.proto",
+        "executed_tests.proto",
+        "remote_execution.proto",
+        "bytestream.proto",
+    ];
     for proto_file in proto_files {
         println!("cargo:rerun-if-changed={}", proto_file);
     }
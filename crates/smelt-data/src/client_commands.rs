@@ -10,6 +10,33 @@ impl ClientCommand {
 
         ClientCommand {
             client_commands: Some(cc),
+            subscription: None,
+        }
+    }
+
+    pub fn send_command_defs(commands: Vec<CommandDef>) -> Self {
+        let cc = ClientCommands::Setdefs(SetCommandDefs { commands });
+
+        ClientCommand {
+            client_commands: Some(cc),
+            subscription: None,
+        }
+    }
+
+    pub fn update_commands(
+        add: Vec<CommandDef>,
+        replace: Vec<CommandDef>,
+        remove: Vec<String>,
+    ) -> Self {
+        let cc = ClientCommands::Update(UpdateCommands {
+            add,
+            replace,
+            remove,
+        });
+
+        ClientCommand {
+            client_commands: Some(cc),
+            subscription: None,
         }
     }
 
@@ -18,6 +45,7 @@ impl ClientCommand {
 
         ClientCommand {
             client_commands: Some(cc),
+            subscription: None,
         }
     }
 
@@ -26,6 +54,7 @@ impl ClientCommand {
 
         ClientCommand {
             client_commands: Some(cc),
+            subscription: None,
         }
     }
 
@@ -34,6 +63,7 @@ impl ClientCommand {
 
         ClientCommand {
             client_commands: Some(cc),
+            subscription: None,
         }
     }
 
@@ -42,6 +72,15 @@ impl ClientCommand {
 
         ClientCommand {
             client_commands: Some(cc),
+            subscription: None,
+        }
+    }
+
+    /// Only stream back the events in `subscription`, when running commands
+    pub fn with_subscription(self, subscription: Option<EventSubscription>) -> Self {
+        Self {
+            subscription,
+            ..self
         }
     }
 }
@@ -8,6 +8,7 @@ impl ArtifactPointer {
         Self {
             artifact_name,
             pointer,
+            cas_hash: None,
         }
     }
 }
@@ -53,8 +54,28 @@ impl ExecutedTestResult {
     }
 }
 
+/// Exit code of a command that was killed for running past its timeout
+pub const TIMED_OUT_EXIT_CODE: i32 = -124;
+
+/// Exit code of a command that was killed for using more than its max_memory_mb
+pub const OUT_OF_MEMORY_EXIT_CODE: i32 = -137;
+
 impl TestOutputs {
     pub fn passed(&self) -> bool {
         self.exit_code == 0
     }
 }
+
+impl ExecutedTestResult {
+    /// Digest of the outputs of a command that went through the action cache -- None for every
+    /// other command, and for commands that didn't produce every output
+    pub fn result_digest(&self) -> Option<&Digest> {
+        match self {
+            Self::Success(val) => val
+                .outputs
+                .as_ref()
+                .and_then(|val| val.result_digest.as_ref()),
+            _ => None,
+        }
+    }
+}
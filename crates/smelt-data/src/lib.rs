@@ -56,6 +56,28 @@ mod serialize_timestamp {
 pub mod client_commands;
 pub mod executed_tests;
 
+/// REAPI types refer to `executed_tests::Digest` relative to their package, so they're nested
+/// the same way it is
+pub mod build {
+    pub mod bazel {
+        pub mod remote {
+            pub mod execution {
+                pub mod v2 {
+                    tonic::include_proto!("build.bazel.remote.execution.v2");
+                }
+            }
+        }
+    }
+}
+pub use build::bazel::remote::execution::v2 as remote_execution;
+
+pub mod google {
+    pub mod bytestream {
+        tonic::include_proto!("google.bytestream");
+    }
+}
+pub use google::bytestream;
+
 pub mod smelt_telemetry {
 
     tonic::include_proto!("smelt_telemetry");
@@ -92,12 +114,22 @@ impl Event {
     }
 
     pub fn command_finished(test: TestResult, trace_id: String) -> Self {
+        Self::finished(test, trace_id, false)
+    }
+
+    /// A command that was up to date -- its outputs were restored from the action cache
+    pub fn command_cached(test: TestResult, trace_id: String) -> Self {
+        Self::finished(test, trace_id, true)
+    }
+
+    fn finished(test: TestResult, trace_id: String, cached: bool) -> Self {
         let command_ref = test.test_name;
         let to = test.outputs.unwrap();
         let et = event::Et::Command(CommandEvent {
             command_ref,
             command_variant: Some(CommandVariant::Finished(CommandFinished {
                 outputs: Some(to),
+                cached,
             })),
         });
         Self::new(et, trace_id)
@@ -111,10 +143,46 @@ impl Event {
         Self::new(et, trace_id)
     }
 
+    /// A command that went over `limit` -- it still finishes, with the exit code for `reason`
+    pub fn command_killed(
+        command_ref: String,
+        trace_id: String,
+        reason: KillReason,
+        limit: u64,
+    ) -> Self {
+        let et = event::Et::Command(CommandEvent {
+            command_ref,
+            command_variant: Some(CommandVariant::Killed(CommandKilled {
+                reason: reason as i32,
+                limit,
+            })),
+        });
+        Self::new(et, trace_id)
+    }
+
     pub fn command_stdout(command_ref: String, trace_id: String, stdout: String) -> Self {
         let et = event::Et::Command(CommandEvent {
             command_ref,
-            command_variant: Some(CommandVariant::Stdout(CommandStdout { output: stdout })),
+            command_variant: Some(CommandVariant::Stdout(CommandStdout {
+                output: stdout,
+                dropped_bytes: 0,
+            })),
+        });
+        Self::new(et, trace_id)
+    }
+
+    /// Tells the client how much of a command's stdout was never sent to it
+    pub fn command_stdout_dropped(
+        command_ref: String,
+        trace_id: String,
+        dropped_bytes: u64,
+    ) -> Self {
+        let et = event::Et::Command(CommandEvent {
+            command_ref,
+            command_variant: Some(CommandVariant::Stdout(CommandStdout {
+                output: String::new(),
+                dropped_bytes,
+            })),
         });
         Self::new(et, trace_id)
     }
@@ -0,0 +1,592 @@
+//! The channel that carries events from the graph server back to a client
+//!
+//! Events are sent while commands run, so a client that stops reading (e.g. a python subscriber
+//! that is holding the GIL) would otherwise stall every command that is trying to report stdout.
+//! `Overflow` picks what happens once the channel is full
+use std::{
+    collections::VecDeque,
+    fs::{self, File},
+    io::{self, BufReader, BufWriter, Read, Write},
+    path::{Path, PathBuf},
+    sync::{
+        atomic::{AtomicU64, Ordering},
+        Arc, Mutex, MutexGuard,
+    },
+    time::Instant,
+};
+
+use prost::Message;
+use smelt_data::{
+    client_commands::{ConfigureSmelt, OverflowPolicy},
+    command_event::CommandVariant,
+    event::Et,
+    Event,
+};
+use tokio::sync::mpsc::{
+    self,
+    error::{SendError, TryRecvError, TrySendError},
+};
+
+/// Number of events that fit in the channel, if the cfg doesn't say otherwise
+pub const DEFAULT_EVENT_CAPACITY: usize = 100;
+
+#[derive(Clone, Debug, PartialEq, Eq)]
+pub enum Overflow {
+    /// Producers wait for room
+    Block,
+    /// Stdout that doesn't fit is dropped, every other event waits for room
+    DropStdout,
+    /// Events that don't fit are written to a segment in this directory, and are read back once
+    /// the client catches up -- producers never wait
+    Spill(PathBuf),
+}
+
+#[derive(Clone, Debug)]
+pub struct EventBuffer {
+    pub capacity: usize,
+    pub overflow: Overflow,
+}
+
+impl Default for EventBuffer {
+    fn default() -> Self {
+        Self {
+            capacity: DEFAULT_EVENT_CAPACITY,
+            overflow: Overflow::Block,
+        }
+    }
+}
+
+impl EventBuffer {
+    /// Reads the `event_buffer` section of the cfg -- spilled events go under
+    /// {SMELT_ROOT}/smelt-out/events
+    pub fn from_cfg(cfg: &ConfigureSmelt) -> Self {
+        let Some(ref buffer_cfg) = cfg.event_buffer else {
+            return Self::default();
+        };
+        let capacity = match buffer_cfg.capacity {
+            0 => DEFAULT_EVENT_CAPACITY,
+            capacity => capacity as usize,
+        };
+        let overflow = match buffer_cfg.overflow() {
+            OverflowPolicy::Block => Overflow::Block,
+            OverflowPolicy::DropStdout => Overflow::DropStdout,
+            OverflowPolicy::Spill => {
+                Overflow::Spill(Path::new(&cfg.smelt_root).join("smelt-out").join("events"))
+            }
+        };
+        Self { capacity, overflow }
+    }
+
+    pub fn channel(&self) -> (EventQueue, EventReceiver) {
+        let (tx, rx) = mpsc::channel(self.capacity);
+        let stats: Arc<ChannelStats> = Arc::default();
+        let spill = match self.overflow {
+            Overflow::Spill(ref dir) => Some(Arc::new(Spill::new(
+                dir.join(format!("{}.events", uuid::Uuid::new_v4())),
+                stats.clone(),
+            ))),
+            _ => None,
+        };
+        let shared = Arc::new(Shared {
+            drop_stdout: self.overflow == Overflow::DropStdout,
+            spill,
+            stats,
+        });
+        (
+            EventQueue {
+                tx,
+                shared: shared.clone(),
+            },
+            EventReceiver { rx, shared },
+        )
+    }
+}
+
+/// Counters for everything that went through the channel
+#[derive(Default)]
+pub struct ChannelStats {
+    sent: AtomicU64,
+    dropped: AtomicU64,
+    spilled: AtomicU64,
+    blocked_sends: AtomicU64,
+    blocked_us: AtomicU64,
+}
+
+#[derive(Clone, Copy, Debug, Default, PartialEq, Eq)]
+pub struct ChannelStatsSnapshot {
+    /// Events that made it in to the channel or the spill segment
+    pub sent: u64,
+    /// Stdout events thrown away by `Overflow::DropStdout`, and spilled events that couldn't be
+    /// written to or read back from the segment
+    pub dropped: u64,
+    /// Events that were spilled
+    pub spilled: u64,
+    /// Sends that had to wait for the client to make room
+    pub blocked_sends: u64,
+    /// Total time producers spent waiting for room, in microseconds
+    pub blocked_us: u64,
+}
+
+impl ChannelStats {
+    pub fn snapshot(&self) -> ChannelStatsSnapshot {
+        ChannelStatsSnapshot {
+            sent: self.sent.load(Ordering::Relaxed),
+            dropped: self.dropped.load(Ordering::Relaxed),
+            spilled: self.spilled.load(Ordering::Relaxed),
+            blocked_sends: self.blocked_sends.load(Ordering::Relaxed),
+            blocked_us: self.blocked_us.load(Ordering::Relaxed),
+        }
+    }
+
+    fn bump(counter: &AtomicU64, by: u64) {
+        counter.fetch_add(by, Ordering::Relaxed);
+    }
+}
+
+struct Shared {
+    drop_stdout: bool,
+    spill: Option<Arc<Spill>>,
+    stats: Arc<ChannelStats>,
+}
+
+/// Events that didn't fit in the channel
+///
+/// While anything is spilled, every new event is spilled too, so events always come out in order.
+/// Senders only ever push to `staged` -- a writer on a blocking thread moves staged events to an
+/// on disk [`Segment`], so nothing that sends an event waits on the disk. The receiver reads the
+/// segment first, then whatever is still staged
+struct Spill {
+    path: PathBuf,
+    stats: Arc<ChannelStats>,
+    /// Always locked before `queue`, so no batch is ever halfway between the two
+    segment: Mutex<Segment>,
+    queue: Mutex<SpillQueue>,
+}
+
+#[derive(Default)]
+struct SpillQueue {
+    /// Spilled events that haven't been handed to the writer yet
+    staged: VecDeque<Event>,
+    /// Spilled events that haven't been read back, whether they're staged or on disk
+    pending: u64,
+    /// True while a writer is running
+    writing: bool,
+    /// Set once the receiver is gone -- anything staged is thrown away
+    closed: bool,
+}
+
+/// Each event is written as a little endian u32 length, followed by the encoded event. The segment
+/// is truncated whenever the client catches up, and removed when the receiver is dropped
+#[derive(Default)]
+struct Segment {
+    writer: Option<BufWriter<File>>,
+    reader: Option<BufReader<File>>,
+    /// Events written to the segment that haven't been read back yet
+    unread: u64,
+    created: bool,
+}
+
+impl Spill {
+    fn new(path: PathBuf, stats: Arc<ChannelStats>) -> Self {
+        Self {
+            path,
+            stats,
+            segment: Mutex::default(),
+            queue: Mutex::default(),
+        }
+    }
+
+    fn lock_segment(&self) -> MutexGuard<'_, Segment> {
+        self.segment.lock().expect("spill segment lock poisoned")
+    }
+
+    fn lock_queue(&self) -> MutexGuard<'_, SpillQueue> {
+        self.queue.lock().expect("spill queue lock poisoned")
+    }
+
+    /// Stages `event`, and starts a writer if there isn't one running already
+    fn push(self: &Arc<Self>, queue: &mut SpillQueue, event: Event) {
+        queue.staged.push_back(event);
+        queue.pending += 1;
+        if !queue.writing {
+            queue.writing = true;
+            let spill = self.clone();
+            tokio::task::spawn_blocking(move || spill.write_staged());
+        }
+    }
+
+    /// Moves staged events to the segment until there are none left
+    fn write_staged(&self) {
+        loop {
+            let mut segment = self.lock_segment();
+            let staged = {
+                let mut queue = self.lock_queue();
+                if queue.staged.is_empty() || queue.closed {
+                    queue.writing = false;
+                    return;
+                }
+                std::mem::take(&mut queue.staged)
+            };
+            let count = staged.len() as u64;
+            if let Err(err) = segment.write(&self.path, staged) {
+                tracing::error!("Could not spill events to {:?}: {err}", self.path);
+                // the segment is unreadable from here on, so give up on everything in it
+                let lost = count + segment.unread;
+                segment.close();
+                self.lock_queue().pending -= lost;
+                ChannelStats::bump(&self.stats.dropped, lost);
+            }
+        }
+    }
+
+    /// Oldest spilled event -- `rx` is checked first, as anything in the channel is older than
+    /// everything that is spilled
+    fn pop(&self, rx: &mut mpsc::Receiver<Event>) -> Option<Event> {
+        let mut segment = self.lock_segment();
+        if let Ok(event) = rx.try_recv() {
+            return Some(event);
+        }
+        let mut queue = self.lock_queue();
+        if queue.pending == 0 {
+            return None;
+        }
+        let rv = if segment.unread > 0 {
+            drop(queue);
+            let rv = segment.read_next();
+            queue = self.lock_queue();
+            match rv {
+                Ok(event) => {
+                    segment.unread -= 1;
+                    queue.pending -= 1;
+                    Some(event)
+                }
+                Err(err) => {
+                    tracing::error!("Could not read spilled events from {:?}: {err}", self.path);
+                    // the segment is unreadable from here on, so give up on what's left in it
+                    queue.pending -= segment.unread;
+                    segment.close();
+                    None
+                }
+            }
+        } else {
+            queue.pending -= 1;
+            queue.staged.pop_front()
+        };
+        if queue.pending == 0 {
+            segment.close();
+        }
+        rv
+    }
+
+    fn pending(&self) -> u64 {
+        self.lock_queue().pending
+    }
+
+    /// Throws away everything that is spilled, and removes the segment
+    fn close(&self) {
+        let mut segment = self.lock_segment();
+        let mut queue = self.lock_queue();
+        queue.closed = true;
+        queue.staged.clear();
+        queue.pending = 0;
+        segment.close();
+        if segment.created {
+            let _ = fs::remove_file(&self.path);
+        }
+    }
+}
+
+impl Segment {
+    fn write(&mut self, path: &Path, events: VecDeque<Event>) -> io::Result<()> {
+        if self.writer.is_none() {
+            if let Some(parent) = path.parent() {
+                fs::create_dir_all(parent)?;
+            }
+            // truncates whatever was left from the last time we spilled
+            let file = File::create(path)?;
+            self.created = true;
+            self.reader = Some(BufReader::new(File::open(path)?));
+            self.writer = Some(BufWriter::new(file));
+        }
+        let writer = self.writer.as_mut().expect("writer was just opened");
+        let count = events.len() as u64;
+        for event in events {
+            let encoded = event.encode_to_vec();
+            writer.write_all(&(encoded.len() as u32).to_le_bytes())?;
+            writer.write_all(&encoded)?;
+        }
+        // the receiver reads straight from the file, so it has to see the whole batch
+        writer.flush()?;
+        self.unread += count;
+        Ok(())
+    }
+
+    fn read_next(&mut self) -> io::Result<Event> {
+        // the reader is always open while anything is unread
+        let Some(reader) = self.reader.as_mut() else {
+            return Err(io::Error::other("spill segment is not open"));
+        };
+        let mut len = [0u8; 4];
+        reader.read_exact(&mut len)?;
+        let mut encoded = vec![0; u32::from_le_bytes(len) as usize];
+        reader.read_exact(&mut encoded)?;
+        Event::decode(encoded.as_slice()).map_err(io::Error::other)
+    }
+
+    /// Closes the files, so the next spill starts a fresh segment
+    fn close(&mut self) {
+        self.writer = None;
+        self.reader = None;
+        self.unread = 0;
+    }
+}
+fn is_stdout(event: &Event) -> bool {
+    matches!(
+        event.et,
+        Some(Et::Command(ref command)) if matches!(command.command_variant, Some(CommandVariant::Stdout(_)))
+    )
+}
+
+/// Sending half of the event channel
+#[derive(Clone)]
+pub struct EventQueue {
+    tx: mpsc::Sender<Event>,
+    shared: Arc<Shared>,
+}
+
+impl EventQueue {
+    pub async fn send(&self, event: Event) -> Result<(), SendError<Event>> {
+        let stats = &self.shared.stats;
+        if let Some(ref spill) = self.shared.spill {
+            return self.send_or_spill(spill, event);
+        }
+
+        let event = match self.tx.try_send(event) {
+            Ok(()) => {
+                ChannelStats::bump(&stats.sent, 1);
+                return Ok(());
+            }
+            Err(TrySendError::Closed(event)) => return Err(SendError(event)),
+            Err(TrySendError::Full(event)) => event,
+        };
+
+        if self.shared.drop_stdout && is_stdout(&event) {
+            ChannelStats::bump(&stats.dropped, 1);
+            return Ok(());
+        }
+
+        let start = Instant::now();
+        let rv = self.tx.send(event).await;
+        ChannelStats::bump(&stats.blocked_sends, 1);
+        ChannelStats::bump(&stats.blocked_us, start.elapsed().as_micros() as u64);
+        if rv.is_ok() {
+            ChannelStats::bump(&stats.sent, 1);
+        }
+        rv
+    }
+
+    fn send_or_spill(&self, spill: &Arc<Spill>, event: Event) -> Result<(), SendError<Event>> {
+        let stats = &self.shared.stats;
+        let mut queue = spill.lock_queue();
+        let event = if queue.pending == 0 {
+            match self.tx.try_send(event) {
+                Ok(()) => {
+                    ChannelStats::bump(&stats.sent, 1);
+                    return Ok(());
+                }
+                Err(TrySendError::Closed(event)) => return Err(SendError(event)),
+                Err(TrySendError::Full(event)) => event,
+            }
+        } else if self.tx.is_closed() {
+            return Err(SendError(event));
+        } else {
+            event
+        };
+
+        spill.push(&mut queue, event);
+        ChannelStats::bump(&stats.sent, 1);
+        ChannelStats::bump(&stats.spilled, 1);
+        Ok(())
+    }
+
+    pub fn stats(&self) -> ChannelStatsSnapshot {
+        self.shared.stats.snapshot()
+    }
+}
+
+/// Receiving half of the event channel -- reads back spilled events once the channel is empty
+pub struct EventReceiver {
+    rx: mpsc::Receiver<Event>,
+    shared: Arc<Shared>,
+}
+
+impl EventReceiver {
+    pub fn try_recv(&mut self) -> Result<Event, TryRecvError> {
+        match self.rx.try_recv() {
+            Ok(event) => Ok(event),
+            Err(err) => self.pop_spilled().ok_or(err),
+        }
+    }
+
+    pub async fn recv(&mut self) -> Option<Event> {
+        match self.try_recv() {
+            Ok(event) => return Some(event),
+            Err(TryRecvError::Disconnected) => return None,
+            Err(TryRecvError::Empty) => {}
+        }
+        // nothing is spilled unless the channel is full, so waiting on the channel is enough
+        match self.rx.recv().await {
+            Some(event) => Some(event),
+            None => self.pop_spilled(),
+        }
+    }
+
+    pub fn blocking_recv(&mut self) -> Option<Event> {
+        match self.try_recv() {
+            Ok(event) => return Some(event),
+            Err(TryRecvError::Disconnected) => return None,
+            Err(TryRecvError::Empty) => {}
+        }
+        match self.rx.blocking_recv() {
+            Some(event) => Some(event),
+            None => self.pop_spilled(),
+        }
+    }
+
+    /// True once every sender is gone, and every event has been read
+    pub fn is_closed(&self) -> bool {
+        self.rx.is_closed()
+            && self.rx.is_empty()
+            && self
+                .shared
+                .spill
+                .as_ref()
+                .map_or(true, |spill| spill.pending() == 0)
+    }
+
+    pub fn stats(&self) -> ChannelStatsSnapshot {
+        self.shared.stats.snapshot()
+    }
+
+    /// Counters that stay readable after this receiver is gone
+    pub fn stats_handle(&self) -> Arc<ChannelStats> {
+        self.shared.stats.clone()
+    }
+
+    fn pop_spilled(&mut self) -> Option<Event> {
+        self.shared.spill.as_ref()?.pop(&mut self.rx)
+    }
+}
+
+impl Drop for EventReceiver {
+    fn drop(&mut self) {
+        if let Some(ref spill) = self.shared.spill {
+            spill.close();
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn stdout(line: usize) -> Event {
+        Event::command_stdout("a".to_string(), "trace".to_string(), format!("line {line}"))
+    }
+
+    fn lines(events: impl IntoIterator<Item = Event>) -> Vec<String> {
+        events
+            .into_iter()
+            .filter_map(|event| match event.et {
+                Some(Et::Command(command)) => match command.command_variant {
+                    Some(CommandVariant::Stdout(stdout)) => Some(stdout.output),
+                    _ => None,
+                },
+                _ => None,
+            })
+            .collect()
+    }
+
+    #[tokio::test]
+    async fn spills_in_order() {
+        let dir = std::env::temp_dir().join(format!("smelt-spill-{}", std::process::id()));
+        let buffer = EventBuffer {
+            capacity: 2,
+            overflow: Overflow::Spill(dir.clone()),
+        };
+        let (tx, mut rx) = buffer.channel();
+        for line in 0..10 {
+            tx.send(stdout(line)).await.unwrap();
+        }
+        let stats = tx.stats();
+        assert_eq!(stats.sent, 10);
+        assert_eq!(stats.spilled, 8);
+        assert_eq!(stats.blocked_sends, 0);
+
+        // senders never touch the disk -- wait for the writer to move the spilled events there
+        let spill = tx.shared.spill.clone().unwrap();
+        while spill.lock_segment().unread < 8 {
+            tokio::task::yield_now().await;
+        }
+        drop(spill);
+
+        let mut events = vec![];
+        for _ in 0..5 {
+            events.push(rx.recv().await.unwrap());
+        }
+        // the client caught up with part of the spill -- new events still go after it
+        tx.send(stdout(10)).await.unwrap();
+        drop(tx);
+        while let Some(event) = rx.recv().await {
+            events.push(event);
+        }
+        assert!(rx.is_closed());
+
+        let expected: Vec<String> = (0..11).map(|line| format!("line {line}")).collect();
+        assert_eq!(lines(events), expected);
+        drop(rx);
+        assert_eq!(fs::read_dir(&dir).unwrap().count(), 0);
+    }
+
+    #[tokio::test]
+    async fn drops_stdout_when_full() {
+        let buffer = EventBuffer {
+            capacity: 2,
+            overflow: Overflow::DropStdout,
+        };
+        let (tx, mut rx) = buffer.channel();
+        for line in 0..5 {
+            tx.send(stdout(line)).await.unwrap();
+        }
+        let stats = tx.stats();
+        assert_eq!(stats.sent, 2);
+        assert_eq!(stats.dropped, 3);
+        drop(tx);
+        assert_eq!(
+            lines([rx.recv().await.unwrap(), rx.recv().await.unwrap()]).len(),
+            2
+        );
+        assert!(rx.recv().await.is_none());
+    }
+
+    #[tokio::test]
+    async fn counts_blocked_sends() {
+        let buffer = EventBuffer {
+            capacity: 1,
+            overflow: Overflow::Block,
+        };
+        let (tx, mut rx) = buffer.channel();
+        tx.send(stdout(0)).await.unwrap();
+        let sender = tokio::spawn({
+            let tx = tx.clone();
+            async move { tx.send(stdout(1)).await.unwrap() }
+        });
+        tokio::time::sleep(std::time::Duration::from_millis(20)).await;
+        rx.recv().await.unwrap();
+        sender.await.unwrap();
+        let stats = rx.stats();
+        assert_eq!(stats.sent, 2);
+        assert_eq!(stats.blocked_sends, 1);
+        assert!(stats.blocked_us > 0);
+    }
+}
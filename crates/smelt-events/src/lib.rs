@@ -1,13 +1,17 @@
+mod buffer;
 pub mod runtime_support;
+mod subscription;
+
+pub use buffer::{
+    ChannelStats, ChannelStatsSnapshot, EventBuffer, EventQueue, EventReceiver, Overflow,
+    DEFAULT_EVENT_CAPACITY,
+};
+pub use subscription::EventSender;
 
 use smelt_data::client_commands::{ClientResp};
 pub use smelt_data::{client_commands::ClientCommand, Event};
 
-use tokio::{
-    fs::File,
-    io::AsyncWriteExt,
-    sync::{mpsc, oneshot},
-};
+use tokio::{fs::File, io::AsyncWriteExt, sync::oneshot};
 
 pub use helpers::*;
 mod helpers {
@@ -65,18 +69,22 @@ pub type ClientCommandResp = Result<ClientResp, String>;
 pub struct ClientCommandBundle {
     pub message: ClientCommand,
     pub oneshot_confirmer: oneshot::Sender<ClientCommandResp>,
-    pub event_streamer: mpsc::Sender<Event>,
+    pub event_streamer: EventQueue,
 }
 
 pub struct EventStreams {
     pub sync_chan: oneshot::Receiver<ClientCommandResp>,
-    pub event_stream: mpsc::Receiver<Event>,
+    pub event_stream: EventReceiver,
 }
 
 impl ClientCommandBundle {
     pub fn from_message(message: ClientCommand) -> (Self, EventStreams) {
+        Self::with_buffer(message, &EventBuffer::default())
+    }
+
+    pub fn with_buffer(message: ClientCommand, buffer: &EventBuffer) -> (Self, EventStreams) {
         let (oneshot_confirmer, sync_chan) = tokio::sync::oneshot::channel();
-        let (event_streamer, event_stream) = mpsc::channel(100);
+        let (event_streamer, event_stream) = buffer.channel();
         (
             Self {
                 message,
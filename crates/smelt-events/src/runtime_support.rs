@@ -1,20 +1,23 @@
-use std::path::{Path, PathBuf};
+use std::{
+    cmp::Reverse,
+    collections::BTreeMap,
+    path::{Path, PathBuf},
+    sync::Arc,
+};
 
-use crate::Event;
+use crate::EventSender;
 use async_trait::async_trait;
 use dice::{DiceData, DiceDataBuilder, UserComputationData};
 use smelt_core::SmeltPath;
 use smelt_data::client_commands::ConfigureSmelt;
-use tokio::sync::{Semaphore, SemaphorePermit};
+use tokio::sync::Notify;
 use uuid::Uuid;
 
-use tokio::sync::mpsc::Sender;
-
 pub trait SetTxChannel {
-    fn set_tx_channel(&mut self, tx_channel: Sender<Event>);
+    fn set_tx_channel(&mut self, tx_channel: EventSender);
 }
 pub trait GetTxChannel {
-    fn get_tx_channel(&self) -> Sender<Event>;
+    fn get_tx_channel(&self) -> EventSender;
 }
 
 pub trait SetTraceId {
@@ -37,14 +40,144 @@ pub trait GetSmeltRoot {
     fn get_smelt_root(&self) -> PathBuf;
 }
 
-pub trait SetSemaphore {
-    fn set_sempahore(&mut self, cnt: usize);
+pub trait SetResourceGate {
+    fn set_resource_gate(&mut self, gate: ResourceGate);
 }
 
 #[async_trait]
-pub trait LockSemaphore {
-    /// Gets the semaphore we use to control how many slots we're using in smelt
-    async fn lock_sem(&self, cnt: u32) -> SemaphorePermit<'_>;
+pub trait AdmitCommand {
+    /// Waits until `num_cpus` job slots and `memory_mb` of the memory budget are free, and
+    /// reserves them until the permit is dropped -- commands with a higher `priority` go first
+    async fn admit(&self, num_cpus: u32, memory_mb: u32, priority: u64) -> ResourcePermit<'_>;
+}
+
+/// Admits commands against a cpu budget (the job slots) and a memory budget
+///
+/// Waiting commands are admitted highest priority first, and in the order they arrived within a
+/// priority. The command at the front of the line holds up the ones behind it until it fits, so
+/// large commands are never starved by a stream of small ones. Requests larger than a budget are
+/// clamped to it
+pub struct ResourceGate {
+    cpus: u64,
+    /// No budget if zero
+    memory_mb: u64,
+    state: std::sync::Mutex<GateState>,
+}
+
+#[derive(Default)]
+struct GateState {
+    /// cpus and memory that are reserved right now
+    used: (u64, u64),
+    /// Commands that are waiting to be admitted, front of the line first -- each is woken
+    /// through its own `Notify` once it is at the front and something changed
+    waiting: BTreeMap<Ticket, Arc<Notify>>,
+    arrivals: u64,
+}
+
+/// Highest priority first, then first come first served
+type Ticket = (Reverse<u64>, u64);
+
+impl GateState {
+    fn wake_front(&self) {
+        if let Some((_, front)) = self.waiting.first_key_value() {
+            front.notify_one();
+        }
+    }
+}
+
+impl ResourceGate {
+    pub fn new(cpus: u64, memory_mb: u64) -> Self {
+        Self {
+            cpus,
+            memory_mb,
+            state: std::sync::Mutex::new(GateState::default()),
+        }
+    }
+
+    pub async fn admit(&self, cpus: u64, memory_mb: u64, priority: u64) -> ResourcePermit<'_> {
+        let cpus = cpus.min(self.cpus);
+        let memory_mb = if self.memory_mb == 0 {
+            0
+        } else {
+            memory_mb.min(self.memory_mb)
+        };
+        let wakeup = Arc::new(Notify::new());
+        let ticket = {
+            let mut state = self.state.lock().unwrap();
+            let ticket = (Reverse(priority), state.arrivals);
+            state.arrivals += 1;
+            state.waiting.insert(ticket, wakeup.clone());
+            ticket
+        };
+        let mut line = InLine {
+            gate: self,
+            ticket: Some(ticket),
+        };
+        loop {
+            {
+                let mut state = self.state.lock().unwrap();
+                let at_front = state.waiting.first_key_value().map(|(front, _)| *front);
+                if at_front == Some(ticket)
+                    && state.used.0 + cpus <= self.cpus
+                    && state.used.1 + memory_mb <= self.memory_mb
+                {
+                    state.waiting.remove(&ticket);
+                    line.ticket = None;
+                    state.used.0 += cpus;
+                    state.used.1 += memory_mb;
+                    // whoever is next may fit as well
+                    state.wake_front();
+                    return ResourcePermit {
+                        gate: self,
+                        cpus,
+                        memory_mb,
+                    };
+                }
+            }
+            // a wakeup between the check and here is still seen -- notify_one stores it if
+            // nobody is waiting yet
+            wakeup.notified().await;
+        }
+    }
+
+    /// cpus and memory that are free right now
+    pub fn available(&self) -> (u64, u64) {
+        let used = self.state.lock().unwrap().used;
+        (self.cpus - used.0, self.memory_mb.saturating_sub(used.1))
+    }
+}
+
+/// Takes a command out of the line if it stops waiting before it is admitted, e.g. because its
+/// invocation was cancelled
+struct InLine<'a> {
+    gate: &'a ResourceGate,
+    ticket: Option<Ticket>,
+}
+
+impl Drop for InLine<'_> {
+    fn drop(&mut self) {
+        if let Some(ticket) = self.ticket {
+            let mut state = self.gate.state.lock().unwrap();
+            state.waiting.remove(&ticket);
+            state.wake_front();
+        }
+    }
+}
+
+/// Resources that a running command has reserved -- handed back when it is dropped
+pub struct ResourcePermit<'a> {
+    gate: &'a ResourceGate,
+    cpus: u64,
+    memory_mb: u64,
+}
+
+impl Drop for ResourcePermit<'_> {
+    fn drop(&mut self) {
+        let mut state = self.gate.state.lock().unwrap();
+        state.used.0 -= self.cpus;
+        state.used.1 -= self.memory_mb;
+        state.wake_front();
+    }
 }
 pub trait GetJobSlots {
     fn get_job_slots(&self) -> u64;
@@ -58,15 +191,15 @@ pub trait GetProfilingFreq {
 }
 
 impl SetTxChannel for UserComputationData {
-    fn set_tx_channel(&mut self, tx_channel: Sender<Event>) {
+    fn set_tx_channel(&mut self, tx_channel: EventSender) {
         self.data.set(tx_channel);
     }
 }
 
 impl GetTxChannel for UserComputationData {
-    fn get_tx_channel(&self) -> Sender<Event> {
+    fn get_tx_channel(&self) -> EventSender {
         self.data
-            .get::<Sender<Event>>()
+            .get::<EventSender>()
             .expect("Channel should be set")
             .clone()
     }
@@ -106,33 +239,29 @@ impl GetJobSlots for DiceData {
 
 impl SetSmeltCfg for DiceDataBuilder {
     fn set_smelt_cfg(&mut self, cfg: ConfigureSmelt) {
-        let max = cfg.job_slots as usize;
+        let gate = ResourceGate::new(cfg.job_slots, cfg.memory_budget_mb);
         self.set(cfg);
-        self.set_sempahore(max);
+        self.set_resource_gate(gate);
     }
 }
 
-impl SetSemaphore for DiceDataBuilder {
-    fn set_sempahore(&mut self, cnt: usize) {
-        let sem = Semaphore::new(cnt);
-        self.set(sem);
+impl SetResourceGate for DiceDataBuilder {
+    fn set_resource_gate(&mut self, gate: ResourceGate) {
+        self.set(gate);
     }
 }
 #[async_trait]
-impl LockSemaphore for DiceData {
-    async fn lock_sem(&self, cnt: u32) -> SemaphorePermit<'_> {
-        let sem = self.get::<Semaphore>().expect("Semaphore should be set");
-        let max_slots = self.get_smelt_cfg().job_slots;
-        let slots = cnt.min(max_slots as u32);
-
-        let available = sem.available_permits();
-        tracing::debug!("Acquiring semaphore {cnt}, max is {max_slots}, current is {available}");
-        let val = sem
-            .acquire_many(slots)
+impl AdmitCommand for DiceData {
+    async fn admit(&self, num_cpus: u32, memory_mb: u32, priority: u64) -> ResourcePermit<'_> {
+        let gate = self
+            .get::<ResourceGate>()
+            .expect("Resource gate should be set");
+        let (cpus, memory) = gate.available();
+        tracing::debug!(
+            "Admitting {num_cpus} cpus and {memory_mb}MB at priority {priority}, {cpus} cpus and {memory}MB are free"
+        );
+        gate.admit(num_cpus as u64, memory_mb as u64, priority)
             .await
-            .expect("We should NEVER close this semaphore");
-
-        val
     }
 }
 
@@ -154,3 +283,60 @@ impl GetProfilingFreq for DiceData {
         })
     }
 }
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use std::time::Duration;
+
+    #[tokio::test]
+    async fn commands_are_admitted_against_memory() {
+        let gate = ResourceGate::new(8, 4096);
+        let big = gate.admit(1, 3072, 0).await;
+        // plenty of cpus are free, but not enough memory
+        let waiting = tokio::time::timeout(Duration::from_millis(50), gate.admit(1, 2048, 0)).await;
+        assert!(waiting.is_err());
+        assert_eq!(gate.available(), (7, 1024));
+
+        drop(big);
+        let small = gate.admit(1, 2048, 0).await;
+        // requests past the budget are clamped, and wait for the machine to drain
+        let huge = tokio::time::timeout(Duration::from_millis(50), gate.admit(1, 65536, 0)).await;
+        assert!(huge.is_err());
+        drop(small);
+        let _huge = gate.admit(1, 65536, 0).await;
+        assert_eq!(gate.available(), (7, 0));
+
+        // no memory budget means only cpus are counted
+        let unbudgeted = ResourceGate::new(2, 0);
+        let _first = unbudgeted.admit(1, 65536, 0).await;
+        let _second = unbudgeted.admit(1, 65536, 0).await;
+        assert_eq!(unbudgeted.available(), (0, 0));
+    }
+
+    #[tokio::test]
+    async fn higher_priority_commands_go_first() {
+        let gate = Arc::new(ResourceGate::new(1, 0));
+        let running = gate.admit(1, 0, 0).await;
+        let (tx, mut rx) = tokio::sync::mpsc::unbounded_channel();
+        for (name, priority) in [("short", 1), ("critical", 100), ("other", 1)] {
+            let (gate, tx) = (gate.clone(), tx.clone());
+            tokio::spawn(async move {
+                let _permit = gate.admit(1, 0, priority).await;
+                tx.send(name).unwrap();
+            });
+            tokio::time::sleep(Duration::from_millis(10)).await;
+        }
+
+        // a command that gives up waiting leaves the line
+        let gave_up = tokio::time::timeout(Duration::from_millis(10), gate.admit(1, 0, 1000)).await;
+        assert!(gave_up.is_err());
+
+        drop(running);
+        let mut order = vec![];
+        for _ in 0..3 {
+            order.push(rx.recv().await.unwrap());
+        }
+        assert_eq!(order, ["critical", "short", "other"]);
+    }
+}
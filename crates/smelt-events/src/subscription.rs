@@ -0,0 +1,173 @@
+use std::{collections::HashSet, sync::Arc};
+
+use smelt_data::{
+    client_commands::EventSubscription, command_event::CommandVariant, event::Et, Event,
+};
+use tokio::sync::mpsc::error::SendError;
+
+use crate::buffer::{ChannelStatsSnapshot, EventQueue};
+
+/// Sending half of a client's event stream
+///
+/// Any event the client didn't subscribe to is dropped here, so it never has to be encoded or
+/// shipped across to the client
+#[derive(Clone)]
+pub struct EventSender {
+    tx: EventQueue,
+    filter: Option<Arc<EventFilter>>,
+}
+
+struct EventFilter {
+    /// The only command variants that get sent
+    variants: HashSet<String>,
+    /// If set, the only commands that have their stdout sent
+    stdout_commands: Option<HashSet<String>>,
+}
+
+impl EventFilter {
+    fn new(subscription: EventSubscription) -> Self {
+        let stdout_commands = subscription.stdout_commands;
+        Self {
+            variants: subscription.command_variants.into_iter().collect(),
+            stdout_commands: (!stdout_commands.is_empty())
+                .then(|| stdout_commands.into_iter().collect()),
+        }
+    }
+
+    fn forwards_variant(&self, variant: &str) -> bool {
+        self.variants.contains(variant)
+    }
+
+    fn forwards_stdout(&self, command_ref: &str) -> bool {
+        self.forwards_variant("stdout")
+            && self
+                .stdout_commands
+                .as_ref()
+                .map_or(true, |commands| commands.contains(command_ref))
+    }
+}
+
+fn variant_name(variant: &CommandVariant) -> &'static str {
+    match variant {
+        CommandVariant::Scheduled(_) => "scheduled",
+        CommandVariant::Started(_) => "started",
+        CommandVariant::Cancelled(_) => "cancelled",
+        CommandVariant::Finished(_) => "finished",
+        CommandVariant::Stdout(_) => "stdout",
+        CommandVariant::Profile(_) => "profile",
+        CommandVariant::Skipped(_) => "skipped",
+        CommandVariant::Killed(_) => "killed",
+    }
+}
+
+impl EventSender {
+    pub fn new(tx: EventQueue, subscription: Option<EventSubscription>) -> Self {
+        Self {
+            tx,
+            filter: subscription.map(|sub| Arc::new(EventFilter::new(sub))),
+        }
+    }
+
+    /// Sender that forwards every event
+    pub fn unfiltered(tx: EventQueue) -> Self {
+        Self::new(tx, None)
+    }
+
+    /// True if the client wants the stdout of `command_ref`
+    ///
+    /// Lets producers skip building stdout events that would just be dropped
+    pub fn forwards_stdout(&self, command_ref: &str) -> bool {
+        self.filter
+            .as_ref()
+            .map_or(true, |filter| filter.forwards_stdout(command_ref))
+    }
+
+    /// True if the client wants `variant` events, e.g. "profile"
+    pub fn forwards_variant(&self, variant: &str) -> bool {
+        self.filter
+            .as_ref()
+            .map_or(true, |filter| filter.forwards_variant(variant))
+    }
+
+    pub fn forwards(&self, event: &Event) -> bool {
+        let Some(ref filter) = self.filter else {
+            return true;
+        };
+        match event.et {
+            Some(Et::Command(ref command)) => match command.command_variant {
+                Some(CommandVariant::Stdout(_)) => filter.forwards_stdout(&command.command_ref),
+                Some(ref variant) => filter.forwards_variant(variant_name(variant)),
+                None => true,
+            },
+            _ => true,
+        }
+    }
+
+    /// Sends `event` to the client, if it subscribed to it -- filtered events are dropped, and
+    /// count as sent
+    pub async fn send(&self, event: Event) -> Result<(), SendError<Event>> {
+        if self.forwards(&event) {
+            self.tx.send(event).await
+        } else {
+            Ok(())
+        }
+    }
+
+    pub fn stats(&self) -> ChannelStatsSnapshot {
+        self.tx.stats()
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use smelt_data::executed_tests::{TestOutputs, TestResult};
+
+    fn filtered(variants: &[&str], stdout_commands: &[&str]) -> EventSender {
+        let (tx, _rx) = crate::EventBuffer::default().channel();
+        EventSender::new(
+            tx,
+            Some(EventSubscription {
+                command_variants: variants.iter().map(|val| val.to_string()).collect(),
+                stdout_commands: stdout_commands.iter().map(|val| val.to_string()).collect(),
+            }),
+        )
+    }
+
+    fn finished() -> Event {
+        let tr = TestResult {
+            test_name: "a".to_string(),
+            outputs: Some(TestOutputs::default()),
+        };
+        Event::command_finished(tr, "trace".to_string())
+    }
+
+    #[test]
+    fn filters_variants() {
+        let sender = filtered(&["finished"], &[]);
+        assert!(sender.forwards(&finished()));
+        assert!(sender.forwards(&Event::done("trace".to_string())));
+        assert!(!sender.forwards(&Event::command_started(
+            "a".to_string(),
+            "trace".to_string()
+        )));
+        assert!(!sender.forwards_stdout("a"));
+    }
+
+    #[test]
+    fn filters_stdout_by_command() {
+        let sender = filtered(&["stdout"], &["a"]);
+        assert!(sender.forwards_stdout("a"));
+        assert!(!sender.forwards_stdout("b"));
+        assert!(sender.forwards(&Event::command_stdout(
+            "a".to_string(),
+            "trace".to_string(),
+            "line".to_string()
+        )));
+        assert!(!sender.forwards(&Event::command_stdout(
+            "b".to_string(),
+            "trace".to_string(),
+            "line".to_string()
+        )));
+    }
+}
@@ -0,0 +1,520 @@
+//! Results of commands that already ran, reused across invocations
+//!
+//! Every command that goes through the cache has an *action digest*, which covers everything that
+//! can change what the command does: its definition, its environment, the contents of its
+//! dependent files, and the results of the commands it depends on. When a command with the same
+//! action digest has already succeeded, its outputs and log are restored rather than running it.
+//!
+//! `smelt-out/.action_cache/ac/` maps action digests to an encoded [`ActionResult`]. The outputs
+//! and logs it points to live in the [`Cas`], along with the outputs of every other command.
+//!
+//! With a [`RemoteCache`], results that aren't found locally are looked up remotely, and every
+//! result that is stored is uploaded -- action digests only cover paths relative to the smelt
+//! root, so they're the same on every checkout
+
+use std::{
+    collections::HashMap,
+    io,
+    path::{Path, PathBuf},
+    sync::Arc,
+};
+
+use dice::{DiceData, DiceDataBuilder};
+use prost::Message;
+use sha2::{Digest as _, Sha256};
+use smelt_core::CommandDefPath;
+use smelt_data::executed_tests::{
+    artifact_pointer::Pointer, ActionResult, ArtifactPointer, Digest, ExecutedTestResult,
+    OutputFile,
+};
+
+use crate::{
+    cas::{is_executable, tmp_path, Cas, CAS_DIR},
+    commands::{Command, TargetType},
+    digest::{update_field, update_len},
+    executor::create_test_result,
+    file_index::{FileIndex, FILE_INDEX_FILE},
+    remote_cache::{batches, from_remote, to_remote, RemoteCache},
+};
+
+pub const ACTION_CACHE_DIR: &str = ".action_cache";
+
+pub struct ActionCache {
+    smelt_root: PathBuf,
+    root: PathBuf,
+    files: FileIndex,
+    cas: Cas,
+    remote: Option<RemoteCache>,
+}
+
+impl ActionCache {
+    /// `cas_max_bytes` is the size budget of the cas -- no budget if zero
+    pub fn new(smelt_root: PathBuf, cas_max_bytes: u64) -> Self {
+        let smelt_out = smelt_root.join("smelt-out");
+        Self {
+            root: smelt_out.join(ACTION_CACHE_DIR),
+            files: FileIndex::load(smelt_out.join(FILE_INDEX_FILE)),
+            cas: Cas::load(smelt_out.join(CAS_DIR), cas_max_bytes),
+            remote: None,
+            smelt_root,
+        }
+    }
+
+    pub fn with_remote(self, remote: RemoteCache) -> Self {
+        Self {
+            remote: Some(remote),
+            ..self
+        }
+    }
+
+    /// Digests of the files that commands read and write
+    pub fn files(&self) -> &FileIndex {
+        &self.files
+    }
+
+    /// Writes the file index and the cas index back, evicting blobs that are past the budget
+    pub async fn save(&self) -> io::Result<()> {
+        self.files.save().await?;
+        self.cas.save().await
+    }
+
+    /// Tests always run -- only the commands that build things for them are cached
+    pub fn caches(command: &Command) -> bool {
+        command.target_type != TargetType::Test
+    }
+
+    /// None if any of the dependencies has no result digest, e.g. a test, or a command that
+    /// failed
+    pub async fn action_digest(
+        &self,
+        command: &Command,
+        deps: &[Arc<ExecutedTestResult>],
+    ) -> io::Result<Option<Digest>> {
+        let mut hasher = Sha256::new();
+        hasher.update(command.def_digest().get_payload());
+        let working_dir = command
+            .working_dir
+            .strip_prefix(&self.smelt_root)
+            .unwrap_or(&command.working_dir);
+        update_str(&mut hasher, &working_dir.to_string_lossy());
+        update_len(&mut hasher, command.outputs.len());
+        for output in command.outputs.iter() {
+            update_str(&mut hasher, &output.to_string());
+        }
+        update_len(&mut hasher, command.runtime.env.len());
+        for (name, value) in command.runtime.env.iter() {
+            update_str(&mut hasher, name);
+            update_str(&mut hasher, value);
+        }
+        let paths = command
+            .dependent_files
+            .iter()
+            .map(|file| self.output_path(command, file))
+            .collect();
+        let digests = self.files.digests(paths).await;
+        update_len(&mut hasher, command.dependent_files.len());
+        for (file, digest) in command.dependent_files.iter().zip(digests) {
+            update_str(&mut hasher, &file.to_string());
+            match digest {
+                Ok(digest) => update_str(&mut hasher, &digest.hash),
+                Err(err) if err.kind() == io::ErrorKind::NotFound => update_str(&mut hasher, ""),
+                Err(err) => return Err(err),
+            }
+        }
+        update_len(&mut hasher, deps.len());
+        for dep in deps {
+            match dep.result_digest() {
+                Some(digest) => update_str(&mut hasher, &digest.hash),
+                None => return Ok(None),
+            }
+        }
+        Ok(Some(finish(hasher, 0)))
+    }
+
+    /// The result that was stored for `action`, if every blob it points to is still around --
+    /// locally, or in the remote cache
+    pub async fn lookup(&self, action: &Digest) -> Option<ActionResult> {
+        if let Some(result) = self.lookup_local(action).await {
+            return Some(result);
+        }
+        let remote = self.remote.as_ref()?;
+        self.fetch(remote, action).await.unwrap_or_else(|err| {
+            tracing::warn!(
+                "Could not fetch {} from the remote cache: {err}",
+                action.hash
+            );
+            None
+        })
+    }
+
+    async fn lookup_local(&self, action: &Digest) -> Option<ActionResult> {
+        let encoded = tokio::fs::read(self.action_path(action)).await.ok()?;
+        let result = ActionResult::decode(encoded.as_slice()).ok()?;
+        for digest in result_digests(&result) {
+            if !self.cas.contains(digest).await {
+                return None;
+            }
+        }
+        Some(result)
+    }
+
+    /// Pulls the result for `action`, and any blobs it points to that aren't in the cas, from the
+    /// remote cache -- the result is stored locally, so the next lookup doesn't go remote
+    async fn fetch(
+        &self,
+        remote: &RemoteCache,
+        action: &Digest,
+    ) -> io::Result<Option<ActionResult>> {
+        let Some(result) = remote.get_action_result(action).await? else {
+            return Ok(None);
+        };
+        let result = from_remote(result);
+        let mut missing = vec![];
+        for digest in result_digests(&result) {
+            if !self.cas.contains(digest).await {
+                missing.push(digest.clone());
+            }
+        }
+        let (batched, streamed) = batches(missing);
+        for batch in batched {
+            for (digest, data) in remote.read_blobs(batch).await? {
+                self.cas.insert(&digest, data).await?;
+            }
+        }
+        for digest in streamed.iter() {
+            self.cas
+                .insert_streamed(
+                    digest,
+                    |tmp| async move { remote.read_blob(digest, &tmp).await },
+                )
+                .await?;
+        }
+        write_atomic(&self.action_path(action), &result.encode_to_vec()).await?;
+        Ok(Some(result))
+    }
+
+    /// Uploads the blobs of `result` that the remote cache doesn't have, then the result itself
+    async fn upload(
+        &self,
+        remote: &RemoteCache,
+        action: &Digest,
+        result: &ActionResult,
+    ) -> io::Result<()> {
+        let missing = remote
+            .find_missing_blobs(result_digests(result).cloned().collect())
+            .await?;
+        let (batched, streamed) = batches(missing);
+        for batch in batched {
+            let mut blobs = vec![];
+            for digest in batch {
+                let data = tokio::fs::read(self.cas.blob_path(&digest)).await?;
+                blobs.push((digest, data));
+            }
+            remote.update_blobs(blobs).await?;
+        }
+        for digest in streamed.iter() {
+            remote
+                .write_blob(digest, &self.cas.blob_path(digest))
+                .await?;
+        }
+        remote.update_action_result(action, to_remote(result)).await
+    }
+
+    /// Puts the outputs and log of `result` back in place -- outputs that already have the right
+    /// contents are left alone
+    pub async fn restore(
+        &self,
+        command: &Command,
+        result: &ActionResult,
+        global_data: &DiceData,
+    ) -> io::Result<ExecutedTestResult> {
+        let mut restored = HashMap::new();
+        let paths: Vec<PathBuf> = result
+            .output_files
+            .iter()
+            .map(|output| self.output_path(command, &CommandDefPath::new(output.path.clone())))
+            .collect();
+        let current = self.files.digests(paths.clone()).await;
+        for ((output, path), current) in result.output_files.iter().zip(paths).zip(current) {
+            let digest = output.digest.clone().unwrap_or_default();
+            if !current.is_ok_and(|current| current == digest) {
+                self.materialize(&digest, &path, output.is_executable)
+                    .await?;
+            }
+            restored.insert(path, digest);
+        }
+        if let Some(ref digest) = result.stdout_digest {
+            let log_path = self.log_path(command);
+            self.materialize(digest, &log_path, false).await?;
+            restored.insert(log_path, digest.clone());
+        }
+        let mut executed = create_test_result(command, result.exit_code, global_data);
+        for (artifact, path) in artifacts_mut(&mut executed) {
+            artifact.cas_hash = restored.remove(&path);
+        }
+        set_result_digest(&mut executed, result);
+        Ok(executed)
+    }
+
+    /// Stores the result of a command that just ran through the action cache -- `action` is set
+    /// -- and succeeded, for later invocations
+    ///
+    /// Its outputs and log are ingested in to the cas, its artifacts are pointed at their blobs,
+    /// and `executed` gets its result digest. Nothing else is ingested, so the outputs of tests
+    /// are never hashed or copied. Commands that didn't produce every output aren't stored
+    pub async fn record(
+        &self,
+        action: Option<&Digest>,
+        command: &Command,
+        executed: &mut ExecutedTestResult,
+    ) -> io::Result<()> {
+        let Some(action) = action else {
+            return Ok(());
+        };
+        let exit_code = match &*executed {
+            ExecutedTestResult::Success(test_result) => test_result
+                .outputs
+                .as_ref()
+                .map(|outputs| outputs.exit_code)
+                .unwrap_or(-1),
+            _ => return Ok(()),
+        };
+        if exit_code != 0 {
+            return Ok(());
+        }
+
+        let paths: Vec<PathBuf> = artifacts_mut(executed)
+            .into_iter()
+            .map(|(_, path)| path)
+            .collect();
+        let digests = self.files.digests(paths.clone()).await;
+        let mut ingested = HashMap::new();
+        for (path, digest) in paths.into_iter().zip(digests) {
+            let digest = digest?;
+            self.cas.ingest(&path, &digest).await?;
+            ingested.insert(path, digest);
+        }
+        for (artifact, path) in artifacts_mut(executed) {
+            artifact.cas_hash = ingested.get(&path).cloned();
+        }
+
+        let mut output_files = vec![];
+        for output in command.outputs.iter() {
+            let path = self.output_path(command, output);
+            let Some(digest) = ingested.get(&path) else {
+                return Ok(());
+            };
+            let permissions = tokio::fs::metadata(&path).await?.permissions();
+            output_files.push(OutputFile {
+                path: output.to_string(),
+                digest: Some(digest.clone()),
+                is_executable: is_executable(&permissions),
+            });
+        }
+        let result = ActionResult {
+            exit_code,
+            output_files,
+            stdout_digest: ingested.get(&self.log_path(command)).cloned(),
+        };
+        write_atomic(&self.action_path(action), &result.encode_to_vec()).await?;
+        set_result_digest(executed, &result);
+        if let Some(ref remote) = self.remote {
+            if let Err(err) = self.upload(remote, action, &result).await {
+                tracing::warn!(
+                    "Could not upload {} to the remote cache: {err}",
+                    command.name
+                );
+            }
+        }
+        Ok(())
+    }
+
+    async fn materialize(&self, digest: &Digest, path: &Path, executable: bool) -> io::Result<()> {
+        self.cas.materialize(digest, path, executable).await?;
+        self.files.record(path.to_path_buf(), digest.clone()).await
+    }
+
+    fn output_path(&self, command: &Command, output: &CommandDefPath) -> PathBuf {
+        output.to_path(command.working_dir.as_path(), self.smelt_root.as_path())
+    }
+
+    fn log_path(&self, command: &Command) -> PathBuf {
+        self.smelt_root
+            .join("smelt-out")
+            .join(&command.name)
+            .join(Command::stdout_file())
+    }
+
+    fn action_path(&self, action: &Digest) -> PathBuf {
+        self.root.join("ac").join(&action.hash)
+    }
+}
+
+/// Every blob that `result` points to
+fn result_digests(result: &ActionResult) -> impl Iterator<Item = &Digest> {
+    result
+        .output_files
+        .iter()
+        .filter_map(|output| output.digest.as_ref())
+        .chain(result.stdout_digest.as_ref())
+}
+
+/// The artifacts of `executed` that point to files, and the paths they point to
+fn artifacts_mut(executed: &mut ExecutedTestResult) -> Vec<(&mut ArtifactPointer, PathBuf)> {
+    let test_result = match executed {
+        ExecutedTestResult::Success(test_result) => test_result,
+        ExecutedTestResult::MissingFiles { test_result, .. } => test_result,
+        ExecutedTestResult::Skipped => return vec![],
+    };
+    test_result
+        .outputs
+        .iter_mut()
+        .flat_map(|outputs| outputs.artifacts.iter_mut())
+        .filter_map(|artifact| match artifact.pointer.clone() {
+            Some(Pointer::Path(path)) => Some((artifact, PathBuf::from(path))),
+            None => None,
+        })
+        .collect()
+}
+
+/// What dependents of a command hash -- the encoded result covers the exit code and the digest of
+/// every output
+fn set_result_digest(executed: &mut ExecutedTestResult, result: &ActionResult) {
+    if let ExecutedTestResult::Success(test_result) = executed {
+        if let Some(outputs) = test_result.outputs.as_mut() {
+            let encoded = result.encode_to_vec();
+            let mut hasher = Sha256::new();
+            hasher.update(&encoded);
+            outputs.result_digest = Some(finish(hasher, encoded.len() as i64));
+        }
+    }
+}
+
+fn finish(hasher: Sha256, size_bytes: i64) -> Digest {
+    Digest {
+        hash: hex::encode(hasher.finalize()),
+        size_bytes,
+    }
+}
+
+fn update_str(hasher: &mut Sha256, value: &str) {
+    update_field(hasher, value.as_bytes());
+}
+
+async fn write_atomic(path: &Path, contents: &[u8]) -> io::Result<()> {
+    let tmp = tmp_path(path);
+    tokio::fs::create_dir_all(path.parent().unwrap()).await?;
+    tokio::fs::write(&tmp, contents).await?;
+    tokio::fs::rename(&tmp, path).await
+}
+
+pub trait SetActionCache {
+    fn set_action_cache(&mut self, cache: Option<Arc<ActionCache>>);
+}
+
+pub trait GetActionCache {
+    fn get_action_cache(&self) -> Option<Arc<ActionCache>>;
+}
+
+impl SetActionCache for DiceDataBuilder {
+    fn set_action_cache(&mut self, cache: Option<Arc<ActionCache>>) {
+        self.set(cache)
+    }
+}
+
+impl GetActionCache for DiceData {
+    fn get_action_cache(&self) -> Option<Arc<ActionCache>> {
+        self.get::<Option<Arc<ActionCache>>>()
+            .expect("Action cache should be set")
+            .clone()
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use dice::Dice;
+    use smelt_data::client_commands::ConfigureSmelt;
+    use smelt_events::runtime_support::SetSmeltCfg;
+
+    fn build_command(root: &Path) -> Command {
+        serde_yaml::from_str(&format!(
+            r#"
+name: build
+target_type: build
+script: ["make"]
+dependent_files: ["src.v"]
+outputs: ["simv"]
+working_dir: {}
+runtime:
+  num_cpus: 1
+  max_memory_mb: 1024
+  timeout: 600
+  env: {{}}
+"#,
+            root.display()
+        ))
+        .unwrap()
+    }
+
+    #[tokio::test]
+    async fn restores_outputs_of_unchanged_commands() {
+        let root = std::env::temp_dir().join(format!("smelt-ac-{}", std::process::id()));
+        let _ = std::fs::remove_dir_all(&root);
+        std::fs::create_dir_all(root.join("smelt-out/build")).unwrap();
+        std::fs::write(root.join("src.v"), "module top;").unwrap();
+        std::fs::write(root.join("simv"), "binary").unwrap();
+        std::fs::write(root.join("smelt-out/build/command.out"), "built").unwrap();
+
+        let mut builder = Dice::builder();
+        builder.set_smelt_cfg(ConfigureSmelt {
+            smelt_root: root.to_string_lossy().to_string(),
+            job_slots: 1,
+            ..Default::default()
+        });
+        let dice = builder.build(dice::DetectCycles::Enabled);
+        let tx = dice.updater().commit().await;
+
+        let cache = ActionCache::new(root.clone(), 0);
+        let command = build_command(&root);
+        let action = cache.action_digest(&command, &[]).await.unwrap().unwrap();
+        assert!(cache.lookup(&action).await.is_none());
+
+        let mut executed = create_test_result(&command, 0, tx.global_data());
+        cache
+            .record(Some(&action), &command, &mut executed)
+            .await
+            .unwrap();
+        assert!(executed.result_digest().is_some());
+        let artifacts = executed.clone().to_test_result().outputs.unwrap().artifacts;
+        assert!(artifacts.iter().all(|artifact| artifact.cas_hash.is_some()));
+
+        // outputs that were clobbered come back
+        std::fs::write(root.join("simv"), "clobbered").unwrap();
+        let result = cache.lookup(&action).await.unwrap();
+        let restored = cache
+            .restore(&command, &result, tx.global_data())
+            .await
+            .unwrap();
+        assert_eq!(
+            std::fs::read_to_string(root.join("simv")).unwrap(),
+            "binary"
+        );
+        assert_eq!(restored.result_digest(), executed.result_digest());
+
+        // a dependent file that changes makes it a different action
+        std::fs::write(root.join("src.v"), "module top2;").unwrap();
+        let changed = cache.action_digest(&command, &[]).await.unwrap().unwrap();
+        assert_ne!(changed, action);
+
+        // as does a dependency with no result digest
+        let test_dep = Arc::new(ExecutedTestResult::Skipped);
+        assert!(cache
+            .action_digest(&command, &[test_dep])
+            .await
+            .unwrap()
+            .is_none());
+
+        let _ = std::fs::remove_dir_all(&root);
+    }
+}
@@ -0,0 +1,458 @@
+//! Content addressed store for the outputs of commands, under `smelt-out/.cas`
+//!
+//! The outputs of commands whose results are cached are ingested once the command finishes. Blobs
+//! are copies that the store owns -- outputs are never linked in to the store, or have their mode
+//! changed, so nothing a command or a user does to an output can reach a blob. Identical outputs
+//! only take up space in the store once. Materializing a blob copies it back out, as a plain
+//! writable file.
+//!
+//! Where the filesystem supports it, copies are clones that share their blocks with the file they
+//! were copied from until either is written to, so ingesting or materializing a large output
+//! doesn't read or write its contents. Elsewhere they're plain copies
+//!
+//! The store is kept under its size budget by evicting the blobs that were used least recently,
+//! whenever it is saved
+
+use std::{
+    collections::HashMap,
+    fs::Permissions,
+    future::Future,
+    io,
+    path::{Path, PathBuf},
+    sync::{
+        atomic::{AtomicBool, AtomicU64, Ordering},
+        Mutex,
+    },
+    time::{SystemTime, UNIX_EPOCH},
+};
+
+use prost::Message;
+use sha2::{Digest as _, Sha256};
+use smelt_data::executed_tests::{CasEntries, CasEntry, Digest};
+
+use crate::file_index::hash_file;
+
+pub const CAS_DIR: &str = ".cas";
+
+/// Holds when each blob was last used, so that using a blob never has to write to it
+const CAS_INDEX_FILE: &str = "index";
+
+pub struct Cas {
+    root: PathBuf,
+    /// No budget if zero
+    max_bytes: u64,
+    entries: Mutex<HashMap<String, CasEntry>>,
+    dirty: AtomicBool,
+}
+
+impl Cas {
+    /// Opens the store at `root` -- if it has no index yet, every blob that is already there is
+    /// treated as used when it was last modified
+    pub fn load(root: PathBuf, max_bytes: u64) -> Self {
+        let entries = match std::fs::read(root.join(CAS_INDEX_FILE)) {
+            Ok(encoded) => CasEntries::decode(encoded.as_slice())
+                .map(|entries| entries.blobs)
+                .unwrap_or_default(),
+            Err(_) => scan_blobs(&root),
+        };
+        Self {
+            root,
+            max_bytes,
+            entries: Mutex::new(
+                entries
+                    .into_iter()
+                    .map(|entry| (entry.hash.clone(), entry))
+                    .collect(),
+            ),
+            dirty: AtomicBool::new(false),
+        }
+    }
+
+    pub fn blob_path(&self, digest: &Digest) -> PathBuf {
+        self.root.join(&digest.hash[..2]).join(&digest.hash)
+    }
+
+    pub async fn contains(&self, digest: &Digest) -> bool {
+        tokio::fs::try_exists(self.blob_path(digest))
+            .await
+            .unwrap_or(false)
+    }
+
+    /// Copies the file at `path`, whose contents hash to `digest`, in to the store -- unless the
+    /// store already has them. `path` itself is left alone
+    pub async fn ingest(&self, path: &Path, digest: &Digest) -> io::Result<()> {
+        let blob = self.blob_path(digest);
+        if !tokio::fs::try_exists(&blob).await? {
+            tokio::fs::create_dir_all(blob.parent().unwrap()).await?;
+            let tmp = tmp_path(&blob);
+            clone_file(path, &tmp).await?;
+            seal(&tmp, &blob).await?;
+        }
+        self.touch(digest);
+        Ok(())
+    }
+
+    /// Adds a blob that came from somewhere else, e.g. a remote cache -- errors if `data` doesn't
+    /// hash to `digest`
+    pub async fn insert(&self, digest: &Digest, data: Vec<u8>) -> io::Result<()> {
+        if hex::encode(Sha256::digest(&data)) != digest.hash {
+            return Err(io::Error::new(
+                io::ErrorKind::InvalidData,
+                format!("blob {} doesn't match its digest", digest.hash),
+            ));
+        }
+        let blob = self.blob_path(digest);
+        tokio::fs::create_dir_all(blob.parent().unwrap()).await?;
+        let tmp = tmp_path(&blob);
+        tokio::fs::write(&tmp, data).await?;
+        seal(&tmp, &blob).await?;
+        self.touch(digest);
+        Ok(())
+    }
+
+    /// Adds a blob that `write` streams in to the file it is given, e.g. from a remote cache, so
+    /// that the blob is never held in memory -- errors if what was written doesn't hash to `digest`
+    pub async fn insert_streamed<F, Fut>(&self, digest: &Digest, write: F) -> io::Result<()>
+    where
+        F: FnOnce(PathBuf) -> Fut,
+        Fut: Future<Output = io::Result<()>>,
+    {
+        let blob = self.blob_path(digest);
+        tokio::fs::create_dir_all(blob.parent().unwrap()).await?;
+        let tmp = tmp_path(&blob);
+        let written = async {
+            write(tmp.clone()).await?;
+            if hash_file(tmp.clone()).await?.hash != digest.hash {
+                return Err(io::Error::new(
+                    io::ErrorKind::InvalidData,
+                    format!("blob {} doesn't match its digest", digest.hash),
+                ));
+            }
+            Ok(())
+        }
+        .await;
+        if let Err(err) = written {
+            let _ = tokio::fs::remove_file(&tmp).await;
+            return Err(err);
+        }
+        seal(&tmp, &blob).await?;
+        self.touch(digest);
+        Ok(())
+    }
+
+    /// Puts a copy of the blob for `digest` at `path`, replacing whatever is there
+    pub async fn materialize(
+        &self,
+        digest: &Digest,
+        path: &Path,
+        executable: bool,
+    ) -> io::Result<()> {
+        if let Some(parent) = path.parent() {
+            tokio::fs::create_dir_all(parent).await?;
+        }
+        let tmp = tmp_path(path);
+        clone_file(&self.blob_path(digest), &tmp).await?;
+        // the copy starts out read only, like the blob
+        let permissions = tokio::fs::metadata(&tmp).await?.permissions();
+        tokio::fs::set_permissions(&tmp, writable(permissions, executable)).await?;
+        tokio::fs::rename(&tmp, path).await?;
+        self.touch(digest);
+        Ok(())
+    }
+
+    /// Evicts the blobs that were used least recently until the store fits in its budget, and
+    /// writes the index back
+    pub async fn save(&self) -> io::Result<()> {
+        if !self.dirty.swap(false, Ordering::Relaxed) {
+            return Ok(());
+        }
+        let evicted = self.evict();
+        for hash in evicted.iter() {
+            let blob = self.root.join(&hash[..2]).join(hash);
+            match tokio::fs::remove_file(&blob).await {
+                Err(err) if err.kind() != io::ErrorKind::NotFound => return Err(err),
+                _ => (),
+            }
+        }
+
+        let encoded = {
+            let entries = self.entries.lock().unwrap();
+            CasEntries {
+                blobs: entries.values().cloned().collect(),
+            }
+            .encode_to_vec()
+        };
+        tokio::fs::create_dir_all(&self.root).await?;
+        let index = self.root.join(CAS_INDEX_FILE);
+        let tmp = tmp_path(&index);
+        tokio::fs::write(&tmp, encoded).await?;
+        tokio::fs::rename(&tmp, &index).await
+    }
+
+    /// Drops the least recently used entries past the budget, and returns their hashes
+    fn evict(&self) -> Vec<String> {
+        let mut entries = self.entries.lock().unwrap();
+        let mut total: u64 = entries.values().map(|entry| entry.size_bytes as u64).sum();
+        if self.max_bytes == 0 || total <= self.max_bytes {
+            return vec![];
+        }
+        let mut by_age: Vec<(i64, String, u64)> = entries
+            .values()
+            .map(|entry| {
+                (
+                    entry.last_used_ns,
+                    entry.hash.clone(),
+                    entry.size_bytes as u64,
+                )
+            })
+            .collect();
+        by_age.sort_unstable();
+        let mut evicted = vec![];
+        for (_, hash, size_bytes) in by_age {
+            if total <= self.max_bytes {
+                break;
+            }
+            entries.remove(&hash);
+            total -= size_bytes;
+            evicted.push(hash);
+        }
+        evicted
+    }
+
+    fn touch(&self, digest: &Digest) {
+        self.entries.lock().unwrap().insert(
+            digest.hash.clone(),
+            CasEntry {
+                hash: digest.hash.clone(),
+                size_bytes: digest.size_bytes,
+                last_used_ns: now_ns(),
+            },
+        );
+        self.dirty.store(true, Ordering::Relaxed);
+    }
+}
+
+/// Makes the copy at `tmp` read only, and moves it in to place as `blob`
+async fn seal(tmp: &Path, blob: &Path) -> io::Result<()> {
+    let mut permissions = tokio::fs::metadata(tmp).await?.permissions();
+    permissions.set_readonly(true);
+    tokio::fs::set_permissions(tmp, permissions).await?;
+    tokio::fs::rename(tmp, blob).await
+}
+
+/// Copies `from` to a new file at `to`, along with its permissions -- as a clone where the
+/// filesystem supports them, otherwise byte for byte
+async fn clone_file(from: &Path, to: &Path) -> io::Result<()> {
+    let (from, to) = (from.to_path_buf(), to.to_path_buf());
+    tokio::task::spawn_blocking(move || {
+        if reflink(&from, &to).is_err() {
+            let _ = std::fs::remove_file(&to);
+            std::fs::copy(&from, &to)?;
+        }
+        Ok(())
+    })
+    .await?
+}
+
+#[cfg(target_os = "linux")]
+fn reflink(from: &Path, to: &Path) -> io::Result<()> {
+    use std::os::fd::AsRawFd;
+    // _IOW(0x94, 9, int) -- supported by btrfs, xfs, bcachefs and overlays of them
+    const FICLONE: libc::c_ulong = 0x4004_9409;
+    let src = std::fs::File::open(from)?;
+    let dst = std::fs::OpenOptions::new()
+        .write(true)
+        .create_new(true)
+        .open(to)?;
+    // SAFETY: both descriptors stay open for the whole call
+    if unsafe { libc::ioctl(dst.as_raw_fd(), FICLONE as _, src.as_raw_fd()) } != 0 {
+        return Err(io::Error::last_os_error());
+    }
+    dst.set_permissions(src.metadata()?.permissions())
+}
+
+#[cfg(any(target_os = "macos", target_os = "ios"))]
+fn reflink(from: &Path, to: &Path) -> io::Result<()> {
+    use std::{ffi::CString, os::unix::ffi::OsStrExt};
+    extern "C" {
+        // from <sys/clonefile.h>, in libSystem -- apfs only, and keeps the mode of `src`
+        fn clonefile(src: *const libc::c_char, dst: *const libc::c_char, flags: u32)
+            -> libc::c_int;
+    }
+    let from = CString::new(from.as_os_str().as_bytes())?;
+    let to = CString::new(to.as_os_str().as_bytes())?;
+    // SAFETY: both paths are nul terminated, and outlive the call
+    if unsafe { clonefile(from.as_ptr(), to.as_ptr(), 0) } != 0 {
+        return Err(io::Error::last_os_error());
+    }
+    Ok(())
+}
+
+#[cfg(not(any(target_os = "linux", target_os = "macos", target_os = "ios")))]
+fn reflink(_from: &Path, _to: &Path) -> io::Result<()> {
+    Err(io::ErrorKind::Unsupported.into())
+}
+
+/// What a materialized copy of a blob gets -- a plain file that its owner can write
+fn writable(mut permissions: Permissions, executable: bool) -> Permissions {
+    #[cfg(unix)]
+    std::os::unix::fs::PermissionsExt::set_mode(
+        &mut permissions,
+        if executable { 0o755 } else { 0o644 },
+    );
+    #[cfg(not(unix))]
+    {
+        let _ = executable;
+        permissions.set_readonly(false);
+    }
+    permissions
+}
+
+/// Whether a file with `permissions` can be executed by anyone
+pub(crate) fn is_executable(permissions: &Permissions) -> bool {
+    #[cfg(unix)]
+    {
+        std::os::unix::fs::PermissionsExt::mode(permissions) & 0o111 != 0
+    }
+    #[cfg(not(unix))]
+    {
+        let _ = permissions;
+        false
+    }
+}
+
+fn scan_blobs(root: &Path) -> Vec<CasEntry> {
+    let mut blobs = vec![];
+    let Ok(prefixes) = std::fs::read_dir(root) else {
+        return blobs;
+    };
+    for prefix in prefixes.flatten() {
+        let Ok(prefix_blobs) = std::fs::read_dir(prefix.path()) else {
+            continue;
+        };
+        for blob in prefix_blobs.flatten() {
+            if let Ok(metadata) = blob.metadata() {
+                blobs.push(CasEntry {
+                    hash: blob.file_name().to_string_lossy().to_string(),
+                    size_bytes: metadata.len() as i64,
+                    last_used_ns: metadata.modified().map_or(0, system_time_ns),
+                });
+            }
+        }
+    }
+    blobs
+}
+
+/// A path next to `path` to write to before renaming in to place -- unique to this call, so
+/// tasks writing the same blob at once never write to the same file
+pub(crate) fn tmp_path(path: &Path) -> PathBuf {
+    static NEXT: AtomicU64 = AtomicU64::new(0);
+    let mut name = path.file_name().unwrap_or_default().to_os_string();
+    name.push(format!(
+        ".tmp-{}-{}",
+        std::process::id(),
+        NEXT.fetch_add(1, Ordering::Relaxed)
+    ));
+    path.with_file_name(name)
+}
+
+fn now_ns() -> i64 {
+    system_time_ns(SystemTime::now())
+}
+
+fn system_time_ns(time: SystemTime) -> i64 {
+    time.duration_since(UNIX_EPOCH)
+        .map_or(0, |val| val.as_nanos() as i64)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn tmp_paths_are_unique() {
+        let blob = Path::new("/cas/ab/abcd");
+        assert_ne!(tmp_path(blob), tmp_path(blob));
+        assert_eq!(tmp_path(blob).parent(), blob.parent());
+    }
+
+    #[tokio::test]
+    async fn clones_are_copies() {
+        let root = std::env::temp_dir().join(format!("smelt-clone-{}", std::process::id()));
+        let _ = std::fs::remove_dir_all(&root);
+        std::fs::create_dir_all(&root).unwrap();
+        let (from, to) = (root.join("from"), root.join("to"));
+        std::fs::write(&from, "original").unwrap();
+        #[cfg(unix)]
+        {
+            use std::os::unix::fs::PermissionsExt;
+            std::fs::set_permissions(&from, Permissions::from_mode(0o755)).unwrap();
+        }
+
+        // a clone where the filesystem has them, a plain copy everywhere else
+        clone_file(&from, &to).await.unwrap();
+        assert_eq!(std::fs::read_to_string(&to).unwrap(), "original");
+        #[cfg(unix)]
+        assert!(is_executable(
+            &std::fs::metadata(&to).unwrap().permissions()
+        ));
+        std::fs::write(&to, "changed").unwrap();
+        assert_eq!(std::fs::read_to_string(&from).unwrap(), "original");
+
+        let _ = std::fs::remove_dir_all(&root);
+    }
+
+    #[tokio::test]
+    async fn dedupes_and_evicts_least_recently_used() {
+        let root = std::env::temp_dir().join(format!("smelt-cas-{}", std::process::id()));
+        let _ = std::fs::remove_dir_all(&root);
+        std::fs::create_dir_all(&root).unwrap();
+        let cas = Cas::load(root.join(CAS_DIR), 8);
+
+        let (first, second, other) = (root.join("a"), root.join("b"), root.join("c"));
+        std::fs::write(&first, "same").unwrap();
+        std::fs::write(&second, "same").unwrap();
+        std::fs::write(&other, "diff").unwrap();
+        let same = hash_file(first.clone()).await.unwrap();
+        let diff = hash_file(other.clone()).await.unwrap();
+
+        cas.ingest(&first, &same).await.unwrap();
+        cas.ingest(&second, &same).await.unwrap();
+        // identical outputs share the blob, and the outputs themselves are left alone
+        assert_eq!(cas.entries.lock().unwrap().len(), 1);
+        assert!(std::fs::metadata(cas.blob_path(&same))
+            .unwrap()
+            .permissions()
+            .readonly());
+        assert!(!std::fs::metadata(&second).unwrap().permissions().readonly());
+        std::fs::write(&second, "changed").unwrap();
+        assert_eq!(
+            std::fs::read_to_string(cas.blob_path(&same)).unwrap(),
+            "same"
+        );
+
+        let restored = root.join("restored/a");
+        cas.materialize(&same, &restored, false).await.unwrap();
+        assert_eq!(std::fs::read_to_string(&restored).unwrap(), "same");
+        assert!(!std::fs::metadata(&restored)
+            .unwrap()
+            .permissions()
+            .readonly());
+
+        // 4 + 4 bytes fits, a third blob doesn't -- the oldest goes
+        cas.ingest(&other, &diff).await.unwrap();
+        std::fs::write(root.join("d"), "more").unwrap();
+        let more = hash_file(root.join("d")).await.unwrap();
+        cas.ingest(&root.join("d"), &more).await.unwrap();
+        cas.save().await.unwrap();
+        assert!(!cas.contains(&same).await);
+        assert!(cas.contains(&diff).await && cas.contains(&more).await);
+        // outputs whose blob was evicted are still around
+        assert_eq!(std::fs::read_to_string(&restored).unwrap(), "same");
+
+        let reloaded = Cas::load(root.join(CAS_DIR), 8);
+        assert_eq!(reloaded.entries.lock().unwrap().len(), 2);
+
+        let _ = std::fs::remove_dir_all(&root);
+    }
+}
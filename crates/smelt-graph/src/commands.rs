@@ -12,8 +12,9 @@ use std::{
 };
 
 use smelt_core::SmeltErr;
+use smelt_data::client_commands::{CommandDef, CommandRuntime};
 
-use crate::digest::{CommandDefDigest, CommandIdDigest};
+use crate::digest::{update_field, update_len, CommandDefDigest, CommandIdDigest};
 use smelt_core::CommandDefPath;
 
 #[repr(transparent)]
@@ -49,13 +50,15 @@ pub struct Command {
 impl Command {
     pub fn def_digest(&self) -> CommandDefDigest {
         let mut hasher = Sha1::new();
-        hasher.update(&self.name);
-        hasher.update(&self.target_type.to_string());
+        update_field(&mut hasher, self.name.as_bytes());
+        update_field(&mut hasher, self.target_type.to_string().as_bytes());
+        update_len(&mut hasher, self.script.len());
         for line in self.script.iter() {
-            hasher.update(line);
+            update_field(&mut hasher, line.as_bytes());
         }
+        update_len(&mut hasher, self.dependencies.len());
         for dep in self.dependencies.iter() {
-            hasher.update(&dep.0);
+            update_field(&mut hasher, dep.0.as_bytes());
         }
 
         let rv: [u8; 20] = hasher.finalize().into();
@@ -93,6 +96,56 @@ impl Command {
     }
 }
 
+impl TryFrom<CommandDef> for Command {
+    type Error = SmeltErr;
+
+    fn try_from(def: CommandDef) -> Result<Self, Self::Error> {
+        let CommandDef {
+            name,
+            target_type,
+            script,
+            dependent_files,
+            dependencies,
+            outputs,
+            runtime,
+            working_dir,
+            sweep: _,
+        } = def;
+        Ok(Command {
+            name,
+            target_type: target_type.parse()?,
+            script,
+            dependent_files: dependent_files
+                .into_iter()
+                .map(CommandDefPath::new)
+                .collect(),
+            dependencies: dependencies.into_iter().map(CommandDependency).collect(),
+            outputs: outputs.into_iter().map(CommandDefPath::new).collect(),
+            runtime: runtime.unwrap_or_default().into(),
+            working_dir: working_dir.into(),
+        })
+    }
+}
+
+impl From<CommandRuntime> for Runtime {
+    fn from(runtime: CommandRuntime) -> Self {
+        let CommandRuntime {
+            num_cpus,
+            max_memory_mb,
+            timeout,
+            env,
+            command_run_dir,
+        } = runtime;
+        Runtime {
+            num_cpus,
+            max_memory_mb,
+            timeout,
+            env: env.into_iter().collect(),
+            command_run_dir: (!command_run_dir.is_empty()).then_some(command_run_dir),
+        }
+    }
+}
+
 #[derive(Serialize, Deserialize, Clone, Dupe, PartialEq, Eq, Hash, Debug, Allocative)]
 #[serde(rename_all = "lowercase")]
 pub enum TargetType {
@@ -187,4 +240,70 @@ mod tests {
 
         let _script = script.unwrap();
     }
+
+    #[test]
+    fn command_def_matches_yaml() {
+        let yaml_data = r#"
+- name: a
+  target_type: test
+  script: ["echo a"]
+  dependencies: ["//b.smelt:b"]
+  outputs: ["a.out"]
+  runtime:
+    num_cpus: 2
+    max_memory_mb: 512
+    timeout: 60
+    env: {FOO: bar}
+  working_dir: /tmp
+"#;
+        let from_yaml: Vec<Command> = serde_yaml::from_str(yaml_data).unwrap();
+        let def = CommandDef {
+            name: "a".to_string(),
+            target_type: "test".to_string(),
+            script: vec!["echo a".to_string()],
+            dependent_files: vec![],
+            dependencies: vec!["//b.smelt:b".to_string()],
+            outputs: vec!["a.out".to_string()],
+            runtime: Some(CommandRuntime {
+                num_cpus: 2,
+                max_memory_mb: 512,
+                timeout: 60,
+                env: [("FOO".to_string(), "bar".to_string())].into(),
+                command_run_dir: String::new(),
+            }),
+            working_dir: "/tmp".to_string(),
+            sweep: None,
+        };
+        assert_eq!(Command::try_from(def).unwrap(), from_yaml[0]);
+    }
+
+    #[test]
+    fn def_digest_separates_fields() {
+        let command: Command = serde_yaml::from_str(
+            r#"
+name: a
+target_type: build
+script: ["ab", "c"]
+runtime:
+  num_cpus: 1
+  max_memory_mb: 512
+  timeout: 60
+  env: {}
+"#,
+        )
+        .unwrap();
+        let mut moved = command.clone();
+        moved.script = vec!["a".to_string(), "bc".to_string()];
+        assert_ne!(
+            command.def_digest().get_payload(),
+            moved.def_digest().get_payload()
+        );
+
+        let mut joined = command.clone();
+        joined.script = vec!["abc".to_string()];
+        assert_ne!(
+            command.def_digest().get_payload(),
+            joined.def_digest().get_payload()
+        );
+    }
 }
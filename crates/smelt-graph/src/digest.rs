@@ -64,3 +64,15 @@ pub struct CommandIdDigestKind {
 pub type CommandDefDigest = CasDigest<CommandDefDigestKind>;
 
 pub type CommandIdDigest = CasDigest<CommandIdDigestKind>;
+
+/// Feeds a variable length field to `hasher` after its length, so neighbouring fields can't run in
+/// to each other -- `["ab", "c"]` and `["a", "bc"]` hash differently
+pub fn update_field<D: sha1::Digest>(hasher: &mut D, field: &[u8]) {
+    update_len(hasher, field.len());
+    hasher.update(field);
+}
+
+/// Feeds the number of items in a list to `hasher`, so where one list ends is part of the hash
+pub fn update_len<D: sha1::Digest>(hasher: &mut D, len: usize) {
+    hasher.update((len as u64).to_le_bytes());
+}
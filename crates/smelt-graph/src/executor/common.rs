@@ -6,14 +6,20 @@ use crate::Command;
 use dice::DiceData;
 
 use smelt_data::{
+    client_commands::StdoutCfg,
     executed_tests::{
         artifact_pointer::Pointer, ArtifactPointer, ExecutedTestResult, TestOutputs, TestResult,
     },
     Event,
 };
 
-use smelt_events::runtime_support::GetSmeltRoot;
-use tokio::{fs::File, io::AsyncWriteExt, sync::mpsc::Sender};
+use smelt_events::{runtime_support::GetSmeltRoot, EventSender};
+use std::time::Duration;
+use tokio::{
+    fs::File,
+    io::{AsyncWriteExt, BufWriter},
+    time::{Interval, MissedTickBehavior},
+};
 
 pub(crate) struct Workspace {
     pub(crate) script_file: PathBuf,
@@ -37,6 +43,7 @@ pub(crate) async fn prepare_workspace(
     let script_file = working_dir.join(Command::script_file());
     let stdout_file = working_dir.join(Command::stdout_file());
     tokio::fs::create_dir_all(&working_dir).await?;
+
     let mut file = File::create(&script_file).await?;
 
     let stdout = File::create(&stdout_file).await?;
@@ -72,23 +79,146 @@ pub(crate) async fn prepare_workspace(
     })
 }
 
-pub(crate) async fn handle_line(
-    command: &Command,
-    line: String,
+/// How long a partial stdout chunk, or output that hasn't been written to the log, is held if
+/// `flush_ms` isn't set
+const DEFAULT_STDOUT_FLUSH_MS: u64 = 100;
+
+/// Writes a command's output to its log, and forwards it to the client as stdout events
+///
+/// By default every line is sent as its own event. A [`StdoutCfg`] can coalesce lines in to
+/// chunks, and cap how much is forwarded per command -- the log always gets everything
+pub(crate) struct StdoutForwarder {
+    command_ref: String,
     trace_id: String,
-    tx_chan: &Sender<Event>,
-    stdout: &mut File,
-) {
-    let _handleme = tx_chan
-        .send(Event::command_stdout(
-            command.name.clone(),
-            trace_id.clone(),
-            line.clone(),
-        ))
-        .await;
-    let bytes = line.as_str();
-    let _unhandled = stdout.write(bytes.as_bytes()).await;
-    let _unhandled = stdout.write(&[b'\n']).await;
+    tx_chan: EventSender,
+    log: BufWriter<File>,
+    /// False if the client didn't subscribe to this command's stdout
+    forward: bool,
+    /// Size a chunk needs to reach before it's sent -- lines aren't coalesced if zero
+    chunk_bytes: usize,
+    flush_period: Duration,
+    max_forwarded_bytes: Option<u64>,
+    pending: String,
+    forwarded_bytes: u64,
+    dropped_bytes: u64,
+}
+
+impl StdoutForwarder {
+    pub(crate) fn new(
+        command_ref: String,
+        trace_id: String,
+        tx_chan: EventSender,
+        log: File,
+        cfg: Option<&StdoutCfg>,
+    ) -> Self {
+        let cfg = cfg.cloned().unwrap_or_default();
+        let flush_ms = if cfg.flush_ms == 0 {
+            DEFAULT_STDOUT_FLUSH_MS
+        } else {
+            cfg.flush_ms
+        };
+        Self {
+            forward: tx_chan.forwards_stdout(&command_ref),
+            command_ref,
+            trace_id,
+            tx_chan,
+            log: BufWriter::new(log),
+            chunk_bytes: cfg.chunk_bytes as usize,
+            flush_period: Duration::from_millis(flush_ms),
+            max_forwarded_bytes: (cfg.max_forwarded_bytes != 0).then_some(cfg.max_forwarded_bytes),
+            pending: String::new(),
+            forwarded_bytes: 0,
+            dropped_bytes: 0,
+        }
+    }
+
+    /// Interval that executors should [`Self::flush`] on, so partial chunks are never held for
+    /// too long, and the log on disk never falls far behind the command
+    pub(crate) fn flush_interval(&self) -> Interval {
+        let mut interval = tokio::time::interval(self.flush_period);
+        interval.set_missed_tick_behavior(MissedTickBehavior::Delay);
+        interval
+    }
+
+    pub(crate) async fn handle_line(&mut self, line: String) {
+        let _unhandled = self.log.write_all(line.as_bytes()).await;
+        let _unhandled = self.log.write_all(b"\n").await;
+        if !self.forward {
+            return;
+        }
+
+        let line_bytes = line.len() as u64 + 1;
+        // once we've started dropping, we drop everything -- so the client never sees gaps
+        let over_cap = self
+            .max_forwarded_bytes
+            .is_some_and(|max| self.forwarded_bytes + line_bytes > max);
+        if self.dropped_bytes > 0 || over_cap {
+            self.dropped_bytes += line_bytes;
+            return;
+        }
+        self.forwarded_bytes += line_bytes;
+
+        if self.chunk_bytes == 0 {
+            self.send(line).await;
+            return;
+        }
+        if !self.pending.is_empty() {
+            self.pending.push('\n');
+        }
+        self.pending.push_str(&line);
+        if self.pending.len() >= self.chunk_bytes {
+            self.flush().await;
+        }
+    }
+
+    /// Sends the partial chunk we're holding on to, if there is one, and writes out the log
+    pub(crate) async fn flush(&mut self) {
+        if !self.pending.is_empty() {
+            let chunk = std::mem::take(&mut self.pending);
+            self.send(chunk).await;
+        }
+        if !self.log.buffer().is_empty() {
+            let _unhandled = self.log.flush().await;
+        }
+    }
+
+    /// Sends everything that's left, tells the client how much output it never got, and flushes
+    /// the log
+    pub(crate) async fn finish(mut self) -> std::io::Result<()> {
+        self.flush().await;
+        if self.dropped_bytes > 0 {
+            let _handleme = self
+                .tx_chan
+                .send(Event::command_stdout_dropped(
+                    self.command_ref.clone(),
+                    self.trace_id.clone(),
+                    self.dropped_bytes,
+                ))
+                .await;
+        }
+        self.log.flush().await
+    }
+
+    async fn send(&self, output: String) {
+        let _handleme = self
+            .tx_chan
+            .send(Event::command_stdout(
+                self.command_ref.clone(),
+                self.trace_id.clone(),
+                output,
+            ))
+            .await;
+    }
+}
+
+/// Ticks `interval` -- or never completes, if there isn't one
+pub(crate) async fn maybe_tick(interval: &mut Option<Interval>) {
+    match interval {
+        Some(interval) => {
+            interval.tick().await;
+        }
+        None => std::future::pending().await,
+    }
 }
 
 pub(crate) fn create_test_result(
@@ -107,6 +237,7 @@ pub(crate) fn create_test_result(
             smelt_root.to_string_lossy().to_string(),
             command.name,
         ))),
+        cas_hash: None,
     }];
 
     for output in command.outputs.iter() {
@@ -135,6 +266,7 @@ pub(crate) fn create_test_result(
         outputs: Some(TestOutputs {
             artifacts,
             exit_code,
+            result_digest: None,
         }),
     };
 
@@ -147,3 +279,92 @@ pub(crate) fn create_test_result(
         }
     }
 }
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use smelt_data::{command_event::CommandVariant, event::Et, CommandStdout};
+
+    async fn forward_lines(name: &str, cfg: StdoutCfg, lines: &[&str]) -> Vec<CommandStdout> {
+        let (tx, mut rx) = smelt_events::EventBuffer::default().channel();
+        let log_path =
+            std::env::temp_dir().join(format!("smelt-{name}-{}.out", std::process::id()));
+        let log = File::create(&log_path).await.unwrap();
+        let mut forwarder = StdoutForwarder::new(
+            "cmd".to_string(),
+            "trace".to_string(),
+            EventSender::unfiltered(tx),
+            log,
+            Some(&cfg),
+        );
+        for line in lines {
+            forwarder.handle_line(line.to_string()).await;
+        }
+        forwarder.finish().await.unwrap();
+
+        // the log always gets everything
+        let logged = tokio::fs::read_to_string(&log_path).await.unwrap();
+        let _ = tokio::fs::remove_file(&log_path).await;
+        assert_eq!(
+            logged,
+            lines
+                .iter()
+                .map(|line| format!("{line}\n"))
+                .collect::<String>()
+        );
+
+        let mut rv = vec![];
+        while let Ok(event) = rx.try_recv() {
+            if let Some(Et::Command(command)) = event.et {
+                if let Some(CommandVariant::Stdout(stdout)) = command.command_variant {
+                    rv.push(stdout);
+                }
+            }
+        }
+        rv
+    }
+
+    #[tokio::test]
+    async fn coalesces_lines() {
+        let cfg = StdoutCfg {
+            chunk_bytes: 8,
+            ..Default::default()
+        };
+        let events = forward_lines("coalesce", cfg, &["aaaa", "bbbb", "cc"]).await;
+        let outputs: Vec<_> = events.iter().map(|val| val.output.as_str()).collect();
+        assert_eq!(outputs, vec!["aaaa\nbbbb", "cc"]);
+    }
+
+    #[tokio::test]
+    async fn caps_forwarded_bytes() {
+        let cfg = StdoutCfg {
+            max_forwarded_bytes: 10,
+            ..Default::default()
+        };
+        let events = forward_lines("cap", cfg, &["aaaa", "bbbb", "cc", "d"]).await;
+        let outputs: Vec<_> = events.iter().map(|val| val.output.as_str()).collect();
+        assert_eq!(outputs, vec!["aaaa", "bbbb", ""]);
+        assert_eq!(events.last().unwrap().dropped_bytes, 5);
+    }
+
+    #[tokio::test]
+    async fn flush_writes_the_log() {
+        let (tx, _rx) = smelt_events::EventBuffer::default().channel();
+        let log_path = std::env::temp_dir().join(format!("smelt-flush-{}.out", std::process::id()));
+        let log = File::create(&log_path).await.unwrap();
+        let mut forwarder = StdoutForwarder::new(
+            "cmd".to_string(),
+            "trace".to_string(),
+            EventSender::unfiltered(tx),
+            log,
+            None,
+        );
+        forwarder.handle_line("still running".to_string()).await;
+        forwarder.flush().await;
+
+        // a command that is still going, or one whose executor bailed out, has its output on disk
+        let logged = tokio::fs::read_to_string(&log_path).await.unwrap();
+        let _ = tokio::fs::remove_file(&log_path).await;
+        assert_eq!(logged, "still running\n");
+    }
+}
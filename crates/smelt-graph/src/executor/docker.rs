@@ -6,7 +6,7 @@ use futures::StreamExt;
 
 use smelt_data::{executed_tests::ExecutedTestResult, Event};
 
-use smelt_events::runtime_support::{GetSmeltRoot, GetTraceId, GetTxChannel};
+use smelt_events::runtime_support::{GetSmeltCfg, GetSmeltRoot, GetTraceId, GetTxChannel};
 use std::{collections::HashMap, sync::Arc};
 
 use bollard::container::LogOutput;
@@ -16,7 +16,7 @@ use bollard::{
     service::HostConfig,
 };
 
-use super::common::{create_test_result, handle_line, prepare_workspace, Workspace};
+use super::common::{create_test_result, prepare_workspace, StdoutForwarder, Workspace};
 
 pub struct DockerExecutor {
     docker_client: Docker,
@@ -66,9 +66,16 @@ impl Executor for DockerExecutor {
         // {SMELT_ROOT}/smelt-out/{COMMAND_NAME}
         let Workspace {
             script_file,
-            mut stdout,
+            stdout,
             working_dir: _,
         } = prepare_workspace(&command, root.clone(), command_default_dir.as_path()).await?;
+        let mut stdout = StdoutForwarder::new(
+            command.name.clone(),
+            trace_id.clone(),
+            tx.clone(),
+            stdout,
+            global_data.get_smelt_cfg().stdout_cfg.as_ref(),
+        );
 
         // The "default" bind mount for all commands is smelt root -- in expectation, this should
         // mount the git root in to the container, at the same path as it has on the host
@@ -140,13 +147,23 @@ impl Executor for DockerExecutor {
         let mut output = docker.logs(&container.id, Some(attach_options));
 
         // Stream the stdout and stderr ouput from the docker container via Event messages
-        while let Some(message) = output.next().await {
+        let mut flush_interval = stdout.flush_interval();
+        loop {
+            let message = tokio::select! {
+                message = output.next() => message,
+                _ = flush_interval.tick() => {
+                    stdout.flush().await;
+                    continue;
+                }
+            };
+            let Some(message) = message else {
+                break;
+            };
             match message {
                 Ok(output) => match output {
                     LogOutput::StdOut { message } | LogOutput::StdErr { message } => {
                         if let Ok(line) = String::from_utf8(message.to_vec()) {
-                            handle_line(command.as_ref(), line, trace_id.clone(), &tx, &mut stdout)
-                                .await;
+                            stdout.handle_line(line).await;
                         }
                     }
 
@@ -162,6 +179,7 @@ impl Executor for DockerExecutor {
                 Err(e) => eprintln!("Error: {}", e),
             }
         }
+        stdout.finish().await?;
 
         // get status code from the container, which should be exited at this point
         let status_code = docker
@@ -0,0 +1,118 @@
+//! Enforces the timeout and max_memory_mb of commands that run locally
+//!
+//! Every command runs in its own process group, so everything it starts -- simulators, compilers,
+//! waveform dumpers -- is killed with it, and counted against its memory
+
+use std::time::Duration;
+
+use smelt_data::{
+    executed_tests::{OUT_OF_MEMORY_EXIT_CODE, TIMED_OUT_EXIT_CODE},
+    KillReason,
+};
+
+/// How often the memory of a command is checked against its limit
+pub(crate) const MEMORY_POLL_INTERVAL: Duration = Duration::from_millis(500);
+
+pub(crate) fn exit_code(reason: KillReason) -> i32 {
+    match reason {
+        KillReason::TimedOut => TIMED_OUT_EXIT_CODE,
+        KillReason::OutOfMemory => OUT_OF_MEMORY_EXIT_CODE,
+    }
+}
+
+#[cfg(unix)]
+pub(crate) fn kill_process_group(pgid: u32) {
+    // SAFETY: killpg has no memory safety requirements
+    let rv = unsafe { libc::killpg(pgid as libc::pid_t, libc::SIGKILL) };
+    if rv != 0 {
+        tracing::warn!(
+            "Could not kill process group {pgid}: {}",
+            std::io::Error::last_os_error()
+        );
+    }
+}
+
+#[cfg(not(unix))]
+pub(crate) fn kill_process_group(_pgid: u32) {}
+
+/// Resident memory of the command whose process group leader is `pid`, in bytes
+///
+/// On linux, this walks `/proc/<pid>/task/<tid>/children`, so the cost only depends on how many
+/// processes the command has -- processes that were reparented away from the command aren't
+/// counted, though they're still in its process group, and killed with it
+#[cfg(target_os = "linux")]
+pub(crate) fn command_memory_bytes(pid: u32) -> u64 {
+    let mut total = 0;
+    let mut pending = vec![pid];
+    while let Some(pid) = pending.pop() {
+        let Some(resident) = resident_bytes(pid) else {
+            continue;
+        };
+        total += resident;
+
+        let Ok(tasks) = std::fs::read_dir(format!("/proc/{pid}/task")) else {
+            continue;
+        };
+        for task in tasks.flatten() {
+            if let Ok(children) = std::fs::read_to_string(task.path().join("children")) {
+                pending.extend(
+                    children
+                        .split_whitespace()
+                        .filter_map(|child| child.parse().ok()),
+                );
+            }
+        }
+    }
+    total
+}
+
+#[cfg(target_os = "linux")]
+fn resident_bytes(pid: u32) -> Option<u64> {
+    let statm = std::fs::read_to_string(format!("/proc/{pid}/statm")).ok()?;
+    let resident_pages: u64 = statm.split_whitespace().nth(1)?.parse().ok()?;
+    // SAFETY: sysconf has no memory safety requirements
+    let page_size = unsafe { libc::sysconf(libc::_SC_PAGESIZE) }.max(0) as u64;
+    Some(resident_pages * page_size)
+}
+
+#[cfg(target_os = "macos")]
+pub(crate) fn command_memory_bytes(pid: u32) -> u64 {
+    use libproc::{
+        pid_rusage::{pidrusage, RUsageInfoV3},
+        processes::{pids_by_type, ProcFilter},
+    };
+    let members = pids_by_type(ProcFilter::ByProgramGroup { pgrpid: pid }).unwrap_or_default();
+    members
+        .into_iter()
+        .filter_map(|member| pidrusage::<RUsageInfoV3>(member as i32).ok())
+        .map(|usage| usage.memory_used())
+        .sum()
+}
+
+#[cfg(not(any(target_os = "linux", target_os = "macos")))]
+pub(crate) fn command_memory_bytes(_pid: u32) -> u64 {
+    0
+}
+
+#[cfg(all(test, target_os = "linux"))]
+mod tests {
+    use super::*;
+    use std::os::unix::process::CommandExt;
+
+    #[test]
+    fn counts_and_kills_the_whole_command() {
+        let mut child = std::process::Command::new("sh")
+            .args(["-c", "sleep 30 & sleep 30"])
+            .process_group(0)
+            .spawn()
+            .unwrap();
+        std::thread::sleep(Duration::from_millis(200));
+        let leader = resident_bytes(child.id()).unwrap();
+        assert!(command_memory_bytes(child.id()) > leader);
+
+        kill_process_group(child.id());
+        let status = child.wait().unwrap();
+        assert!(!status.success());
+        assert_eq!(command_memory_bytes(child.id()), 0);
+    }
+}
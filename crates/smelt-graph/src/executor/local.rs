@@ -1,25 +1,27 @@
-use crate::executor::{common::handle_line, Executor};
+use crate::executor::Executor;
 use dice::{DiceData, UserComputationData};
 use std::process::Stdio;
+use std::time::{Duration, Instant};
 use std::{path::PathBuf, sync::Arc};
 
-use crate::Command;
+use crate::{Command, GetScheduler};
 use async_trait::async_trait;
 
 use smelt_data::{
     executed_tests::{ExecutedTestResult, TestOutputs},
-    Event,
+    Event, KillReason,
 };
-use smelt_events::runtime_support::{
-    GetProfilingFreq, GetSmeltRoot, GetTraceId, GetTxChannel, LockSemaphore,
-};
-use tokio::{
-    io::{AsyncBufReadExt, BufReader},
-    sync::mpsc::Sender,
+use smelt_events::{
+    runtime_support::{
+        AdmitCommand, GetProfilingFreq, GetSmeltCfg, GetSmeltRoot, GetTraceId, GetTxChannel,
+    },
+    EventSender,
 };
+use tokio::io::{AsyncBufReadExt, BufReader};
 
 use super::{
-    common::{create_test_result, prepare_workspace, Workspace},
+    common::{create_test_result, maybe_tick, prepare_workspace, StdoutForwarder, Workspace},
+    limits::{self, command_memory_bytes, kill_process_group, MEMORY_POLL_INTERVAL},
     profiler::profile_cmd,
 };
 
@@ -55,12 +57,20 @@ impl Executor for LocalExecutor {
 async fn execute_local_command(
     command: &Command,
     trace_id: String,
-    tx_chan: Sender<Event>,
+    tx_chan: EventSender,
     command_working_dir: PathBuf,
     root: PathBuf,
     global_data: &DiceData,
 ) -> anyhow::Result<TestOutputs> {
-    let _sem = global_data.lock_sem(command.runtime.num_cpus).await;
+    let scheduler = global_data.get_scheduler();
+    let _permit = global_data
+        .admit(
+            command.runtime.num_cpus,
+            command.runtime.max_memory_mb,
+            scheduler.priority(&command.name),
+        )
+        .await;
+    let started = Instant::now();
     let shell = "bash";
     let _handle_me = tx_chan
         .send(Event::command_started(
@@ -71,9 +81,17 @@ async fn execute_local_command(
 
     let Workspace {
         script_file,
-        mut stdout,
+        stdout,
         ..
     } = prepare_workspace(command, root.clone(), command_working_dir.as_path()).await?;
+    let mut stdout = StdoutForwarder::new(
+        command.name.clone(),
+        trace_id.clone(),
+        tx_chan.clone(),
+        stdout,
+        global_data.get_smelt_cfg().stdout_cfg.as_ref(),
+    );
+    let mut flush_interval = stdout.flush_interval();
 
     let mut commandlocal = tokio::process::Command::new(shell);
 
@@ -81,6 +99,9 @@ async fn execute_local_command(
         .arg(script_file)
         .stdout(Stdio::piped())
         .stderr(Stdio::piped());
+    // its own process group, so everything the command starts is killed along with it
+    #[cfg(unix)]
+    commandlocal.process_group(0);
     let mut comm_handle = commandlocal.spawn()?;
     let stderr = comm_handle.stderr.take().unwrap();
     let stderr_reader = BufReader::new(stderr);
@@ -90,8 +111,12 @@ async fn execute_local_command(
     let mut lines = reader.lines();
     let maybe_pid = comm_handle.id();
 
+    // no point sampling if nobody is listening for the samples
+    let profiling_freq = global_data
+        .get_profiling_freq()
+        .filter(|_| tx_chan.forwards_variant("profile"));
     let sample_task = maybe_pid.and_then(|pid| {
-        global_data.get_profiling_freq().map(|freq| {
+        profiling_freq.map(|freq| {
             tokio::spawn(profile_cmd(
                 pid,
                 tx_chan.clone(),
@@ -104,29 +129,68 @@ async fn execute_local_command(
 
     //let sample_task = ;
 
+    let enforce_limits = global_data.get_smelt_cfg().enforce_limits && maybe_pid.is_some();
+    let timeout = command.runtime.timeout;
+    let deadline = tokio::time::sleep(Duration::from_secs(timeout as u64));
+    tokio::pin!(deadline);
+    let max_memory_bytes = command.runtime.max_memory_mb as u64 * 1024 * 1024;
+    let mut memory_interval = (enforce_limits && max_memory_bytes > 0)
+        .then(|| tokio::time::interval(MEMORY_POLL_INTERVAL));
+    let mut killed: Option<KillReason> = None;
+    let kill = |reason: KillReason, limit: u64| {
+        let pid = maybe_pid.expect("limits are only enforced on commands with a pid");
+        tracing::warn!("Killing {}: {:?}, limit was {limit}", command.name, reason);
+        kill_process_group(pid);
+        Event::command_killed(command.name.clone(), trace_id.clone(), reason, limit)
+    };
+
     let cstatus: TestOutputs = loop {
         tokio::select!(
             Ok(Some(line)) = lines.next_line() => {
-                handle_line(command,line,trace_id.clone(),&tx_chan,&mut stdout).await;
+                stdout.handle_line(line).await;
             }
             Ok(Some(line)) = stderr_lines.next_line() => {
-                handle_line(command,line,trace_id.clone(),&tx_chan,&mut stdout).await;
+                stdout.handle_line(line).await;
+            }
+            _ = flush_interval.tick() => {
+                stdout.flush().await;
+            }
+            _ = &mut deadline, if enforce_limits && timeout > 0 && killed.is_none() => {
+                killed = Some(KillReason::TimedOut);
+                let _ = tx_chan.send(kill(KillReason::TimedOut, timeout as u64)).await;
+            }
+            _ = maybe_tick(&mut memory_interval), if killed.is_none() => {
+                if command_memory_bytes(maybe_pid.unwrap()) > max_memory_bytes {
+                    killed = Some(KillReason::OutOfMemory);
+                    let limit = command.runtime.max_memory_mb as u64;
+                    let _ = tx_chan.send(kill(KillReason::OutOfMemory, limit)).await;
+                }
             }
             status_code = comm_handle.wait() => {
-                break status_code.map(|val| TestOutputs{ exit_code: val.code().unwrap_or(-555), artifacts: vec![]});
+                break status_code.map(|val| {
+                    let exit_code = match killed {
+                        Some(reason) => limits::exit_code(reason),
+                        None => val.code().unwrap_or(-555),
+                    };
+                    TestOutputs{ exit_code, ..Default::default()}
+                });
             }
 
 
         );
-    }?;
+    };
     //kill the sampling task
     if let Some(task) = sample_task {
         task.abort()
     }
 
+    // the log is finished even if waiting on the command failed, so it has everything it printed
     while let Ok(Some(line)) = lines.next_line().await {
-        handle_line(command, line, trace_id.clone(), &tx_chan, &mut stdout).await;
+        stdout.handle_line(line).await;
     }
+    stdout.finish().await?;
+    let cstatus = cstatus?;
+    scheduler.record(&command.name, started.elapsed());
 
     Ok(cstatus)
 }
@@ -9,6 +9,7 @@ mod common;
 
 #[cfg(feature = "docker")]
 mod docker;
+mod limits;
 mod local;
 mod profiler;
 
@@ -17,6 +18,8 @@ use async_trait::async_trait;
 pub use docker::DockerExecutor;
 pub use local::LocalExecutor;
 
+pub(crate) use common::create_test_result;
+
 #[async_trait]
 pub trait Executor: Send + Sync {
     async fn execute_commands(
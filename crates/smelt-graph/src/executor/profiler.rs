@@ -2,7 +2,8 @@ use std::time::Duration;
 
 use libproc::{self, pid_rusage::PIDRUsage, processes};
 use smelt_data::{command_event::CommandVariant, CommandProfile, Event};
-use tokio::{sync::mpsc::Sender, time::Instant};
+use smelt_events::EventSender;
+use tokio::time::Instant;
 const MICROS_TO_NANOS: u64 = 1_000;
 struct SampleStruct {
     /// Memory used by a command in bytes
@@ -66,7 +67,7 @@ fn sample_memory_and_load(
 
 pub async fn profile_cmd(
     pid: u32,
-    tx: Sender<Event>,
+    tx: EventSender,
     sample_freq_ms: u64,
     command_ref: String,
     trace_id: String,
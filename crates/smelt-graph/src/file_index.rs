@@ -0,0 +1,247 @@
+//! Digests of the files that commands read and write, remembered across invocations
+//!
+//! Much like git's index, every file that is hashed is recorded with its size, mtime and inode.
+//! As long as none of those change, the recorded digest is used, and the file is never read
+//! again -- which matters when the files are multi-GB simulator binaries and waveforms.
+//!
+//! A file that was modified within [`RACY_WINDOW_NS`] of being hashed is "racily clean": it could
+//! have been written again in the same mtime tick, without its stat changing. Those entries are
+//! never trusted, and the file is hashed again the next time it is asked for
+
+use std::{
+    collections::HashMap,
+    fs::Metadata,
+    io::{self, Read},
+    path::{Path, PathBuf},
+    sync::{
+        atomic::{AtomicBool, Ordering},
+        Mutex,
+    },
+    time::{SystemTime, UNIX_EPOCH},
+};
+
+use futures::future;
+use memmap2::Mmap;
+use prost::Message;
+use sha2::{Digest as _, Sha256};
+use smelt_data::executed_tests::{Digest, FileState, FileStates};
+use tokio::sync::Semaphore;
+
+use crate::cas::tmp_path;
+
+pub const FILE_INDEX_FILE: &str = ".file_index";
+
+/// Files whose mtime is within this long of when they were hashed are hashed again
+pub const RACY_WINDOW_NS: i64 = 1_000_000_000;
+
+/// Files smaller than this are read, rather than memory mapped
+const MMAP_THRESHOLD: u64 = 1 << 16;
+
+pub struct FileIndex {
+    path: PathBuf,
+    entries: Mutex<HashMap<String, FileState>>,
+    dirty: AtomicBool,
+    /// Bounds how many files are hashed at once
+    hashers: Semaphore,
+}
+
+impl FileIndex {
+    /// Reads the index at `path` -- starts out empty if there isn't one, or it can't be read
+    pub fn load(path: PathBuf) -> Self {
+        let entries = std::fs::read(&path)
+            .ok()
+            .and_then(|encoded| FileStates::decode(encoded.as_slice()).ok())
+            .map(|states| {
+                states
+                    .files
+                    .into_iter()
+                    .map(|state| (state.path.clone(), state))
+                    .collect()
+            })
+            .unwrap_or_default();
+        let threads = std::thread::available_parallelism().map_or(1, |val| val.get());
+        Self {
+            path,
+            entries: Mutex::new(entries),
+            dirty: AtomicBool::new(false),
+            hashers: Semaphore::new(threads),
+        }
+    }
+
+    /// Digest of the file at `path` -- only read if it changed since it was last hashed
+    pub async fn digest(&self, path: PathBuf) -> io::Result<Digest> {
+        let metadata = tokio::fs::metadata(&path).await?;
+        let key = path.to_string_lossy().to_string();
+        if let Some(digest) = self.lookup(&key, &metadata) {
+            return Ok(digest);
+        }
+
+        let _permit = self.hashers.acquire().await.expect("never closed");
+        let hashed_ns = now_ns();
+        let digest = hash_file(path).await?;
+        self.insert(key, &metadata, digest.clone(), hashed_ns);
+        Ok(digest)
+    }
+
+    /// Records that the file at `path` is known to hash to `digest`, e.g. because it was just
+    /// copied out of a blob with those contents
+    pub async fn record(&self, path: PathBuf, digest: Digest) -> io::Result<()> {
+        let metadata = tokio::fs::metadata(&path).await?;
+        let key = path.to_string_lossy().to_string();
+        self.insert(key, &metadata, digest, now_ns());
+        Ok(())
+    }
+
+    /// Digests of every file in `paths`, in order -- the files that need to be read are hashed in
+    /// parallel
+    pub async fn digests(&self, paths: Vec<PathBuf>) -> Vec<io::Result<Digest>> {
+        future::join_all(paths.into_iter().map(|path| self.digest(path))).await
+    }
+
+    /// Writes the index back, if anything was hashed since it was loaded
+    pub async fn save(&self) -> io::Result<()> {
+        if !self.dirty.swap(false, Ordering::Relaxed) {
+            return Ok(());
+        }
+        let encoded = {
+            let entries = self.entries.lock().unwrap();
+            FileStates {
+                files: entries.values().cloned().collect(),
+            }
+            .encode_to_vec()
+        };
+        let tmp = tmp_path(&self.path);
+        if let Some(parent) = self.path.parent() {
+            tokio::fs::create_dir_all(parent).await?;
+        }
+        tokio::fs::write(&tmp, encoded).await?;
+        tokio::fs::rename(&tmp, &self.path).await
+    }
+
+    fn insert(&self, key: String, metadata: &Metadata, digest: Digest, hashed_ns: i64) {
+        self.entries.lock().unwrap().insert(
+            key.clone(),
+            FileState {
+                path: key,
+                size_bytes: metadata.len(),
+                mtime_ns: mtime_ns(metadata),
+                inode: inode(metadata),
+                digest: Some(digest),
+                hashed_ns,
+            },
+        );
+        self.dirty.store(true, Ordering::Relaxed);
+    }
+
+    fn lookup(&self, key: &str, metadata: &Metadata) -> Option<Digest> {
+        let entries = self.entries.lock().unwrap();
+        let state = entries.get(key)?;
+        let mtime = mtime_ns(metadata);
+        let unchanged = state.size_bytes == metadata.len()
+            && state.mtime_ns == mtime
+            && state.inode == inode(metadata);
+        let racy = mtime + RACY_WINDOW_NS > state.hashed_ns;
+        (unchanged && !racy).then(|| state.digest.clone()).flatten()
+    }
+}
+
+/// sha256 of the contents of `path`, off the runtime's worker threads -- large files are memory
+/// mapped, rather than copied through a buffer
+pub async fn hash_file(path: PathBuf) -> io::Result<Digest> {
+    tokio::task::spawn_blocking(move || hash_file_blocking(&path)).await?
+}
+
+fn hash_file_blocking(path: &Path) -> io::Result<Digest> {
+    let mut file = std::fs::File::open(path)?;
+    let size_bytes = file.metadata()?.len();
+    let mut hasher = Sha256::new();
+    if size_bytes >= MMAP_THRESHOLD {
+        // SAFETY: smelt doesn't write to the file while it's mapped -- a command that truncates a
+        // file while it's being hashed is already racing with smelt
+        let map = unsafe { Mmap::map(&file)? };
+        hasher.update(&map[..]);
+    } else {
+        let mut buf = Vec::with_capacity(size_bytes as usize);
+        file.read_to_end(&mut buf)?;
+        hasher.update(&buf);
+    }
+    Ok(Digest {
+        hash: hex::encode(hasher.finalize()),
+        size_bytes: size_bytes as i64,
+    })
+}
+
+fn now_ns() -> i64 {
+    system_time_ns(SystemTime::now())
+}
+
+fn mtime_ns(metadata: &Metadata) -> i64 {
+    metadata.modified().map_or(0, system_time_ns)
+}
+
+fn system_time_ns(time: SystemTime) -> i64 {
+    time.duration_since(UNIX_EPOCH)
+        .map_or(0, |val| val.as_nanos() as i64)
+}
+
+#[cfg(unix)]
+fn inode(metadata: &Metadata) -> u64 {
+    std::os::unix::fs::MetadataExt::ino(metadata)
+}
+
+#[cfg(not(unix))]
+fn inode(_metadata: &Metadata) -> u64 {
+    0
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use std::time::Duration;
+
+    fn set_mtime(path: &Path, time: SystemTime) {
+        std::fs::File::options()
+            .write(true)
+            .open(path)
+            .unwrap()
+            .set_modified(time)
+            .unwrap();
+    }
+
+    #[tokio::test]
+    async fn unchanged_files_are_not_read() {
+        let root = std::env::temp_dir().join(format!("smelt-fi-{}", std::process::id()));
+        let _ = std::fs::remove_dir_all(&root);
+        std::fs::create_dir_all(&root).unwrap();
+        let file = root.join("simv");
+        let index_path = root.join(FILE_INDEX_FILE);
+
+        // just written, so racily clean -- a same sized write in the same tick is still seen
+        std::fs::write(&file, "aaaa").unwrap();
+        let index = FileIndex::load(index_path.clone());
+        let first = index.digest(file.clone()).await.unwrap();
+        std::fs::write(&file, "bbbb").unwrap();
+        let second = index.digest(file.clone()).await.unwrap();
+        assert_ne!(first, second);
+
+        // once the file is old enough, its stat is trusted -- even across invocations
+        let old = SystemTime::now() - Duration::from_secs(60);
+        set_mtime(&file, old);
+        let trusted = index.digest(file.clone()).await.unwrap();
+        assert_eq!(trusted, second);
+        index.save().await.unwrap();
+
+        std::fs::write(&file, "cccc").unwrap();
+        set_mtime(&file, old);
+        let reloaded = FileIndex::load(index_path);
+        assert_eq!(reloaded.digest(file.clone()).await.unwrap(), second);
+        assert_eq!(hash_file(file.clone()).await.unwrap().size_bytes, 4);
+
+        // but any change to the stat means it's read again
+        std::fs::write(&file, "ccccc").unwrap();
+        set_mtime(&file, old);
+        assert_ne!(reloaded.digest(file).await.unwrap(), second);
+
+        let _ = std::fs::remove_dir_all(&root);
+    }
+}
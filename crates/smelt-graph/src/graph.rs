@@ -17,16 +17,29 @@ use smelt_events::{
     runtime_support::{
         GetSmeltCfg, GetTraceId, GetTxChannel, SetSmeltCfg, SetTraceId, SetTxChannel,
     },
-    ClientCommandBundle, Event,
+    ClientCommandBundle, Event, EventSender,
 };
 
 use futures::FutureExt;
-use std::{collections::HashSet, str::FromStr, sync::Arc};
-use tokio::sync::mpsc::{Sender, UnboundedReceiver, UnboundedSender};
+use std::{
+    collections::{HashMap, HashSet},
+    fmt,
+    path::PathBuf,
+    str::FromStr,
+    sync::Arc,
+};
+use tokio::{
+    sync::mpsc::{UnboundedReceiver, UnboundedSender},
+    task::JoinSet,
+};
 
 use crate::{
+    action_cache::{ActionCache, GetActionCache, SetActionCache},
     commands::{Command, TargetType},
     executor::{DockerExecutor, Executor, GetExecutor, LocalExecutor, SetExecutor},
+    remote_cache::RemoteCache,
+    schedule::{GetScheduler, Scheduler, SetScheduler, DURATIONS_FILE},
+    sweep::{sweep_name, Sweep, SweepAxis, SweepRef},
     utils::invoke_start_message,
     CommandDependency,
 };
@@ -108,103 +121,177 @@ impl Key for LookupFileMaker {
     }
 }
 
+type CommandResult = Result<Arc<ExecutedTestResult>, Arc<SmeltErr>>;
+
 #[async_trait]
 impl Key for CommandRef {
-    type Value = Result<Arc<ExecutedTestResult>, Arc<SmeltErr>>;
+    type Value = CommandResult;
     async fn compute(
         &self,
         ctx: &mut DiceComputations,
         _cancellations: &CancellationContext,
     ) -> Self::Value {
-        let deps = self.0.dependencies.as_slice();
-        let req_files = self.0.dependent_files.as_slice();
-        let (command_deps, file_command_deps) = get_command_deps(ctx, deps, req_files).await;
+        run_command(ctx, self.0.dupe()).await
+    }
 
-        let all_deps: Vec<CommandRef> = command_deps
-            .into_iter()
-            .chain(file_command_deps.into_iter())
-            .collect::<Result<Vec<CommandRef>, SmeltErr>>()?;
+    fn equality(_x: &Self::Value, _y: &Self::Value) -> bool {
+        false
+    }
+}
 
-        let futs = ctx.compute_many(all_deps.into_iter().map(|val| {
-            DiceComputations::declare_closure(
-                move |ctx: &mut DiceComputations| -> BoxFuture<Self::Value> {
-                    ctx.compute(&val)
-                        .map(|computed_val| match computed_val {
-                            Ok(val) => val,
-                            Err(err) => Err(Arc::new(SmeltErr::DiceFail(err))),
-                        })
-                        .boxed()
-                },
-            )
-        }));
+/// A single instance of a sweep -- the command is only built when the instance is computed, so
+/// the key itself is a pointer and an index
+#[derive(Clone, Dupe, PartialEq, Eq, Hash, Debug, Allocative)]
+pub struct SweepInstance {
+    sweep: SweepRef,
+    index: u64,
+}
 
-        let val: Vec<Self::Value> = future::join_all(futs).await.into_iter().collect();
+impl fmt::Display for SweepInstance {
+    fn fmt(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        write!(f, "{}", self.sweep.0.instance_name(self.index))
+    }
+}
 
-        let mut exit = None;
-        for val in val {
-            match val {
-                Ok(res) => {
-                    if res.is_skipped() {
-                        tracing::trace!("Dependency was skipped -- skipping {}", self.0.name);
-                        exit = Some(Arc::new(ExecutedTestResult::Skipped));
-                        break;
-                    }
+#[async_trait]
+impl Key for SweepInstance {
+    type Value = CommandResult;
+    async fn compute(
+        &self,
+        ctx: &mut DiceComputations,
+        _cancellations: &CancellationContext,
+    ) -> Self::Value {
+        run_command(ctx, Arc::new(self.sweep.0.instance(self.index))).await
+    }
 
-                    if res.get_retcode() != 0 {
-                        tracing::trace!("Dependency was skipped -- skipping {}", self.0.name);
-                        exit = Some(Arc::new(ExecutedTestResult::Skipped));
-                        break;
-                    }
+    fn equality(_x: &Self::Value, _y: &Self::Value) -> bool {
+        false
+    }
+}
+
+/// Runs `command` once its dependencies have run -- it is skipped if any of them failed
+async fn run_command(ctx: &mut DiceComputations<'_>, command: Arc<Command>) -> CommandResult {
+    let deps = command.dependencies.as_slice();
+    let req_files = command.dependent_files.as_slice();
+    let (command_deps, file_command_deps) = get_command_deps(ctx, deps, req_files).await;
+
+    let all_deps: Vec<CommandRef> = command_deps
+        .into_iter()
+        .chain(file_command_deps.into_iter())
+        .collect::<Result<Vec<CommandRef>, SmeltErr>>()?;
+
+    let futs = ctx.compute_many(all_deps.into_iter().map(|val| {
+        DiceComputations::declare_closure(
+            move |ctx: &mut DiceComputations| -> BoxFuture<CommandResult> {
+                ctx.compute(&val)
+                    .map(|computed_val| match computed_val {
+                        Ok(val) => val,
+                        Err(err) => Err(Arc::new(SmeltErr::DiceFail(err))),
+                    })
+                    .boxed()
+            },
+        )
+    }));
+
+    let val: Vec<CommandResult> = future::join_all(futs).await.into_iter().collect();
+
+    let mut exit = None;
+    let mut dep_results = Vec::with_capacity(val.len());
+    for val in val {
+        match val {
+            Ok(res) => {
+                if res.is_skipped() {
+                    tracing::trace!("Dependency was skipped -- skipping {}", command.name);
+                    exit = Some(Arc::new(ExecutedTestResult::Skipped));
+                    break;
                 }
-                Err(e) => {
-                    tracing::warn!(
-                        "Smelt runtime failed to execute a command with error {e}  -- skipping {}",
-                        self.0.name
-                    );
+
+                if res.get_retcode() != 0 {
+                    tracing::trace!("Dependency was skipped -- skipping {}", command.name);
                     exit = Some(Arc::new(ExecutedTestResult::Skipped));
                     break;
                 }
+                dep_results.push(res);
+            }
+            Err(e) => {
+                tracing::warn!(
+                    "Smelt runtime failed to execute a command with error {e}  -- skipping {}",
+                    command.name
+                );
+                exit = Some(Arc::new(ExecutedTestResult::Skipped));
+                break;
             }
         }
+    }
 
-        let tx = ctx.per_transaction_data().get_tx_channel();
-        if let Some(need_to_skip) = exit {
-            let _ = tx
-                .send(Event::command_skipped(
-                    self.0.name.clone(),
-                    ctx.per_transaction_data().get_trace_id(),
-                ))
-                .await;
-            return Ok(need_to_skip);
-        }
+    let tx = ctx.per_transaction_data().get_tx_channel();
+    if let Some(need_to_skip) = exit {
+        let _ = tx
+            .send(Event::command_skipped(
+                command.name.clone(),
+                ctx.per_transaction_data().get_trace_id(),
+            ))
+            .await;
+        return Ok(need_to_skip);
+    }
 
-        //Currently, we do nothing with this. What we _should_ do is check if these guys fail --
-        //specifically, if build targets fail -- this would be Bad and should cause an abort
+    // commands that are up to date are restored from the action cache, rather than run
+    let cache = ctx.global_data().get_action_cache();
+    let action = match cache {
+        Some(ref cache) if ActionCache::caches(&command) => cache
+            .action_digest(&command, &dep_results)
+            .await
+            .unwrap_or_else(|err| {
+                tracing::warn!("Could not hash the inputs of {}: {err}", command.name);
+                None
+            }),
+        _ => None,
+    };
+    if let (Some(cache), Some(action)) = (cache.as_ref(), action.as_ref()) {
+        if let Some(result) = cache.lookup(action).await {
+            match cache.restore(&command, &result, ctx.global_data()).await {
+                Ok(restored) => {
+                    let command_cached = Event::command_cached(
+                        restored.clone().to_test_result(),
+                        ctx.per_transaction_data().get_trace_id(),
+                    );
+                    let mut _handleme = tx.send(command_cached).await;
+                    return Ok(Arc::new(restored));
+                }
+                Err(err) => tracing::warn!(
+                    "Could not restore {} from the action cache, running it: {err}",
+                    command.name
+                ),
+            }
+        }
+    }
 
-        let executor = ctx.global_data().get_executor();
+    //Currently, we do nothing with this. What we _should_ do is check if these guys fail --
+    //specifically, if build targets fail -- this would be Bad and should cause an abort
 
-        let output = executor
-            .execute_commands(
-                self.0.clone(),
-                ctx.per_transaction_data(),
-                ctx.global_data(),
-            )
-            .await;
+    let executor = ctx.global_data().get_executor();
 
-        let output = output.map_err(|err| Arc::new(SmeltErr::ExecutorFailed(err.to_string())))?;
+    let output = executor
+        .execute_commands(
+            command.dupe(),
+            ctx.per_transaction_data(),
+            ctx.global_data(),
+        )
+        .await;
 
-        let tr = output.clone().to_test_result();
+    let mut output = output.map_err(|err| Arc::new(SmeltErr::ExecutorFailed(err.to_string())))?;
+    if let Some(cache) = cache {
+        if let Err(err) = cache.record(action.as_ref(), &command, &mut output).await {
+            tracing::warn!("Could not store the outputs of {}: {err}", command.name);
+        }
+    }
 
-        let command_finished =
-            Event::command_finished(tr, ctx.per_transaction_data().get_trace_id());
-        let mut _handleme = tx.send(command_finished).await;
+    let tr = output.clone().to_test_result();
 
-        Ok(Arc::new(output))
-    }
+    let command_finished = Event::command_finished(tr, ctx.per_transaction_data().get_trace_id());
+    let mut _handleme = tx.send(command_finished).await;
 
-    fn equality(_x: &Self::Value, _y: &Self::Value) -> bool {
-        false
-    }
+    Ok(Arc::new(output))
 }
 
 async fn get_command_deps(
@@ -330,6 +417,16 @@ pub struct CommandGraph {
     /// The commands that are currently contained in the graph -- they hold no information
     /// regarding dependencies, etc
     pub(crate) all_commands: Vec<CommandRef>,
+    /// Where each command sits in `all_commands`, by name
+    command_index: HashMap<String, usize>,
+    /// The name of the command that creates each declared output
+    output_owners: HashMap<CommandDefPath, String>,
+    /// Command templates that run once per combination of their parameters -- their instances
+    /// are only built as they run
+    sweeps: Vec<SweepRef>,
+    /// Orders the commands that are waiting to run -- re-planned at the start of every run, with
+    /// the durations of the runs before it
+    scheduler: Arc<Scheduler>,
     /// The receiver for all ClientCommands -- these kick off executions of the dice graph
     rx_chan: UnboundedReceiver<ClientCommandBundle>,
 }
@@ -353,9 +450,44 @@ impl CommandGraph {
             None => Arc::new(LocalExecutor {}),
         };
 
+        // --test-only relies on non-test commands being checked against the action cache, but it
+        // never turns the cache on by itself -- the cache is off unless it is asked for
+        let use_cache = cfg.cache.as_ref().is_some_and(|val| val.action_cache);
+        if cfg.test_only && !use_cache {
+            tracing::warn!(
+                "--test-only has no effect without the action cache, every command runs"
+            );
+        }
+        let action_cache = use_cache.then(|| {
+            let cache_cfg = cfg.cache.clone().unwrap_or_default();
+            let cache = ActionCache::new(PathBuf::from(&cfg.smelt_root), cache_cfg.cas_max_bytes);
+            let remote = (!cache_cfg.remote_url.is_empty()).then(|| {
+                RemoteCache::connect(&cache_cfg.remote_url, cache_cfg.remote_instance_name)
+            });
+            match remote {
+                Some(Ok(remote)) => Arc::new(cache.with_remote(remote)),
+                Some(Err(err)) => {
+                    tracing::warn!(
+                        "Could not use the remote cache {}: {err}",
+                        cache_cfg.remote_url
+                    );
+                    Arc::new(cache)
+                }
+                None => Arc::new(cache),
+            }
+        });
+
+        let scheduler = Arc::new(Scheduler::load(
+            PathBuf::from(&cfg.smelt_root)
+                .join("smelt-out")
+                .join(DURATIONS_FILE),
+        ));
+
         let mut dice_builder = Dice::builder();
         dice_builder.set_smelt_cfg(cfg);
         dice_builder.set_executor(executor);
+        dice_builder.set_action_cache(action_cache);
+        dice_builder.set_scheduler(scheduler.dupe());
 
         let dice = dice_builder.build(DetectCycles::Enabled);
 
@@ -363,6 +495,10 @@ impl CommandGraph {
             dice,
             rx_chan,
             all_commands: vec![],
+            command_index: HashMap::new(),
+            output_owners: HashMap::new(),
+            sweeps: vec![],
+            scheduler,
         };
 
         tracing::trace!("Successfully made graph!");
@@ -376,18 +512,30 @@ impl CommandGraph {
                 message:
                     ClientCommand {
                         client_commands: Some(command),
+                        subscription,
                     },
                 oneshot_confirmer,
                 event_streamer,
             }) = self.rx_chan.recv().await
             {
                 let rv = self
-                    .eat_command(command, event_streamer.clone())
+                    .eat_command(
+                        command,
+                        EventSender::new(event_streamer.clone(), subscription),
+                    )
                     .await
                     .map_err(|err| err.to_string())
                     .map(|val| ClientResp {
                         client_responses: val,
                     });
+                let stats = event_streamer.stats();
+                if stats.blocked_sends > 0 {
+                    tracing::warn!(
+                        "Commands waited {}ms for the client to read events ({} blocked sends)",
+                        stats.blocked_us / 1000,
+                        stats.blocked_sends
+                    );
+                }
                 if let Err(ref err) = rv {
                     let _ = event_streamer
                         .send(Event::runtime_error(
@@ -404,13 +552,36 @@ impl CommandGraph {
     async fn eat_command(
         &mut self,
         command: ClientCommands,
-        event_streamer: Sender<Event>,
+        event_streamer: EventSender,
     ) -> Result<Option<ClientResponses>, SmeltErr> {
         match command {
             ClientCommands::Setter(SetCommands { command_content }) => {
                 let script = serde_yaml::from_str(&command_content)?;
                 self.set_commands(script).await?;
             }
+            ClientCommands::Setdefs(SetCommandDefs { commands }) => {
+                let mut sweeps = vec![];
+                let mut plain = vec![];
+                for mut def in commands {
+                    match def.sweep.take() {
+                        Some(SweepDef { axes }) => sweeps.push(Sweep::new(
+                            Command::try_from(def)?,
+                            axes.into_iter().map(SweepAxis::from).collect(),
+                        )?),
+                        None => plain.push(Command::try_from(def)?),
+                    }
+                }
+                self.set_commands(plain).await?;
+                self.set_sweeps(sweeps).await?;
+            }
+            ClientCommands::Update(UpdateCommands {
+                add,
+                replace,
+                remove,
+            }) => {
+                self.update_commands(from_defs(add)?, from_defs(replace)?, remove)
+                    .await?;
+            }
             ClientCommands::Runone(RunOne { command_name }) => {
                 self.run_one_test(command_name, event_streamer).await?;
             }
@@ -459,6 +630,7 @@ impl CommandGraph {
             Ok(())
         }
         check_unique_outputs_and_names(&commands)?;
+        self.sweeps.clear();
 
         let commands: Vec<CommandRef> = commands
             .into_iter()
@@ -466,8 +638,25 @@ impl CommandGraph {
             .collect();
         ctx.add_commands(commands.iter().cloned())?;
         self.all_commands = commands;
+        self.command_index = self
+            .all_commands
+            .iter()
+            .enumerate()
+            .map(|(idx, command)| (command.0.name.clone(), idx))
+            .collect();
+        self.output_owners = self
+            .all_commands
+            .iter()
+            .flat_map(|command| {
+                command
+                    .0
+                    .outputs
+                    .iter()
+                    .map(|output| (output.clone(), command.0.name.clone()))
+            })
+            .collect();
         let mut ctx = ctx.commit().await;
-        self.validate_graph(&mut ctx)
+        self.validate_commands(&mut ctx, &self.all_commands)
             .await
             .map_err(|vals| SmeltErr::CommandSettingFailed {
                 reason: format!("{} invalid dependencies found", vals.len()),
@@ -476,7 +665,231 @@ impl CommandGraph {
         Ok(())
     }
 
-    async fn start_tx(&self, tx: Sender<Event>) -> Result<DiceTransaction, SmeltErr> {
+    /// Sets the sweeps that run alongside the commands -- only the templates are checked, since every
+    /// instance shares the template's dependencies
+    pub async fn set_sweeps(&mut self, sweeps: Vec<Sweep>) -> Result<(), SmeltErr> {
+        let mut names = HashSet::new();
+        for sweep in sweeps.iter() {
+            let name = &sweep.template.name;
+            if self.command_index.contains_key(name) || !names.insert(name) {
+                return Err(SmeltErr::DuplicateCommandName { name: name.clone() });
+            }
+        }
+        let templates: Vec<CommandRef> = sweeps
+            .iter()
+            .map(|sweep| CommandRef(Arc::new(sweep.template.clone())))
+            .collect();
+        let mut ctx = self.dice.updater().commit().await;
+        self.validate_commands(&mut ctx, &templates)
+            .await
+            .map_err(|vals| SmeltErr::CommandSettingFailed {
+                reason: format!("{} invalid dependencies found", vals.len()),
+            })?;
+        self.sweeps = sweeps
+            .into_iter()
+            .map(|sweep| SweepRef(Arc::new(sweep)))
+            .collect();
+        Ok(())
+    }
+
+    /// Adds, replaces and removes commands, without touching the rest of the graph
+    ///
+    /// Only the dice keys of the commands that changed are updated, so only they and the commands
+    /// that depend on them are invalidated, and only the new definitions are re-validated. The
+    /// update is checked against the current commands before anything is applied -- if it would
+    /// leave a dependency dangling, the graph is left as it was
+    pub async fn update_commands(
+        &mut self,
+        add: Vec<Command>,
+        replace: Vec<Command>,
+        remove: Vec<String>,
+    ) -> Result<(), SmeltErr> {
+        let removed: HashSet<String> = remove.into_iter().collect();
+        for name in removed.iter() {
+            if !self.command_index.contains_key(name) {
+                return Err(SmeltErr::UnknownCommand { name: name.clone() });
+            }
+        }
+        for command in replace.iter() {
+            if !self.command_index.contains_key(&command.name) || removed.contains(&command.name) {
+                return Err(SmeltErr::UnknownCommand {
+                    name: command.name.clone(),
+                });
+            }
+        }
+
+        let mut new_names = HashSet::new();
+        for command in replace.iter().chain(add.iter()) {
+            // a command named after a sweep, or one of its instances, would shadow it in lookups
+            let shadows_sweep = self
+                .sweeps
+                .iter()
+                .any(|sweep| sweep.0.template.name == sweep_name(&command.name));
+            if shadows_sweep || !new_names.insert(command.name.as_str()) {
+                return Err(SmeltErr::DuplicateCommandName {
+                    name: command.name.clone(),
+                });
+            }
+        }
+        for command in add.iter() {
+            if self.command_index.contains_key(&command.name) && !removed.contains(&command.name) {
+                return Err(SmeltErr::DuplicateCommandName {
+                    name: command.name.clone(),
+                });
+            }
+        }
+
+        // every output of a command that is removed or replaced is free to be claimed again
+        let is_retired = |name: &str| removed.contains(name) || new_names.contains(name);
+        let mut new_outputs = HashSet::new();
+        for command in replace.iter().chain(add.iter()) {
+            for output in command.outputs.iter() {
+                let taken = match self.output_owners.get(output) {
+                    Some(owner) => !is_retired(owner),
+                    None => false,
+                };
+                if taken || !new_outputs.insert(output) {
+                    return Err(SmeltErr::DuplicateOutput {
+                        output: output.clone(),
+                    });
+                }
+            }
+        }
+
+        // the new definitions can only depend on what the graph declares after this update -- checked
+        // here, rather than once the update is committed, so a bad update never reaches the graph
+        let declares_name = |name: &str| {
+            new_names.contains(name)
+                || (self.command_index.contains_key(name) && !removed.contains(name))
+        };
+        let declares_output = |output: &CommandDefPath| {
+            new_outputs.contains(&output)
+                || self
+                    .output_owners
+                    .get(output)
+                    .is_some_and(|owner| !is_retired(owner))
+        };
+        for command in replace.iter().chain(add.iter()) {
+            for dep in command.dependencies.iter() {
+                if !declares_name(dep.get_command_name()) {
+                    return Err(SmeltErr::MissingCommandDependency {
+                        missing_dep_name: dep.get_command_name().to_string(),
+                    });
+                }
+            }
+            for file in command.dependent_files.iter() {
+                if !declares_output(file) {
+                    return Err(SmeltErr::MissingFileDependency {
+                        missing_file_name: file.to_string(),
+                    });
+                }
+            }
+        }
+
+        // names and outputs that nothing declares after this update
+        let dangling_names: HashSet<&str> = removed
+            .iter()
+            .map(|name| name.as_str())
+            .filter(|name| !new_names.contains(name))
+            .collect();
+        let dangling_outputs: HashSet<&CommandDefPath> = removed
+            .iter()
+            .chain(replace.iter().map(|command| &command.name))
+            .flat_map(|name| self.all_commands[self.command_index[name]].0.outputs.iter())
+            .filter(|output| !new_outputs.contains(output))
+            .collect();
+        if !dangling_names.is_empty() || !dangling_outputs.is_empty() {
+            // sweeps are never updated, so their templates always stay
+            let kept = self
+                .all_commands
+                .iter()
+                .map(|command| command.0.as_ref())
+                .filter(|command| !is_retired(&command.name))
+                .chain(self.sweeps.iter().map(|sweep| &sweep.0.template));
+            for command in kept.chain(replace.iter()).chain(add.iter()) {
+                for dep in command.dependencies.iter() {
+                    if dangling_names.contains(dep.get_command_name()) {
+                        return Err(SmeltErr::MissingCommandDependency {
+                            missing_dep_name: dep.get_command_name().to_string(),
+                        });
+                    }
+                }
+                for file in command.dependent_files.iter() {
+                    if dangling_outputs.contains(file) {
+                        return Err(SmeltErr::MissingFileDependency {
+                            missing_file_name: file.to_string(),
+                        });
+                    }
+                }
+            }
+        }
+
+        let mut ctx = self.dice.updater();
+        for name in dangling_names.iter() {
+            let lookup = LookupCommand::from_str_ref(name);
+            ctx.changed_to(vec![(lookup.dupe(), Err(lookup))])?;
+        }
+        for output in dangling_outputs.iter() {
+            let file_maker = LookupFileMaker::from_ref(output);
+            ctx.changed_to(vec![(file_maker.dupe(), Err(file_maker))])?;
+        }
+        let new_commands: Vec<CommandRef> = replace
+            .into_iter()
+            .chain(add)
+            .map(|val| CommandRef(Arc::new(val)))
+            .collect();
+        ctx.add_commands(new_commands.iter().cloned())?;
+
+        for name in removed.iter() {
+            self.forget_command(name);
+        }
+        for command in new_commands.iter() {
+            self.remember_command(command.dupe());
+        }
+
+        ctx.commit().await;
+        tracing::trace!(
+            "Updated {} commands, removed {}",
+            new_commands.len(),
+            removed.len()
+        );
+        Ok(())
+    }
+
+    fn forget_command(&mut self, name: &str) {
+        if let Some(idx) = self.command_index.remove(name) {
+            let command = self.all_commands.swap_remove(idx);
+            for output in command.0.outputs.iter() {
+                self.output_owners.remove(output);
+            }
+            if let Some(moved) = self.all_commands.get(idx) {
+                self.command_index.insert(moved.0.name.clone(), idx);
+            }
+        }
+    }
+
+    /// Adds `command` to the tables, in place of any command with the same name
+    fn remember_command(&mut self, command: CommandRef) {
+        match self.command_index.get(&command.0.name) {
+            Some(&idx) => {
+                let old = std::mem::replace(&mut self.all_commands[idx], command.dupe());
+                for output in old.0.outputs.iter() {
+                    self.output_owners.remove(output);
+                }
+            }
+            None => {
+                self.command_index
+                    .insert(command.0.name.clone(), self.all_commands.len());
+                self.all_commands.push(command.dupe());
+            }
+        }
+        for output in command.0.outputs.iter() {
+            self.output_owners
+                .insert(output.clone(), command.0.name.clone());
+        }
+    }
+
+    async fn start_tx(&self, tx: EventSender) -> Result<DiceTransaction, SmeltErr> {
         let ctx = self.dice.updater();
         let mut data = UserComputationData::new();
 
@@ -495,45 +908,109 @@ impl CommandGraph {
     pub async fn run_all_typed(
         &self,
         maybe_type: String,
-        event_streamer: Sender<Event>,
+        event_streamer: EventSender,
     ) -> Result<(), SmeltErr> {
         let tt = TargetType::from_str(maybe_type.as_str())?;
         let tx = self.start_tx(event_streamer).await?;
-        let refs = self
+        let commands = self
             .all_commands
             .iter()
             .filter(|&val| val.0.target_type == tt)
             .cloned()
-            .collect();
+            .map(Runnable::Command);
+        let sweeps = self
+            .sweeps
+            .iter()
+            .filter(|&sweep| sweep.0.template.target_type == tt)
+            .cloned()
+            .map(Runnable::Sweep);
 
-        self.run_tests(refs, tx).await
+        self.run_tests(commands.chain(sweeps).collect(), tx).await
     }
 
     async fn run_tests(
         &self,
-        refs: Vec<CommandRef>,
-        mut tx: DiceTransaction,
+        runnables: Vec<Runnable>,
+        tx: DiceTransaction,
     ) -> Result<(), SmeltErr> {
+        let templates = self.sweeps.iter().map(|sweep| &sweep.0.template);
+        self.scheduler.plan(
+            self.all_commands
+                .iter()
+                .map(|command| command.0.as_ref())
+                .chain(templates),
+        );
         tokio::task::spawn(async move {
-            let _out = tx.execute_commands(refs).await;
+            // sweeps are expanded lazily, and a command is only started once an earlier one has
+            // finished -- so at most RUN_WINDOW commands or sweep instances exist at once
+            let mut instances = runnables.into_iter().flat_map(Runnable::expand);
+            let mut running = JoinSet::new();
+            let mut failed = vec![];
+            loop {
+                while running.len() < RUN_WINDOW {
+                    match instances.next() {
+                        Some(runnable) => {
+                            running.spawn(execute_runnable(tx.dupe(), runnable));
+                        }
+                        None => break,
+                    }
+                }
+                let result = match running.join_next().await {
+                    Some(Ok(result)) => result,
+                    Some(Err(join_err)) => Err(Arc::new(SmeltErr::IoError(join_err.into()))),
+                    None => break,
+                };
+                if result.is_err() {
+                    failed.push(result);
+                }
+            }
+            if let Some(cache) = tx.global_data().get_action_cache() {
+                if let Err(err) = cache.save().await {
+                    tracing::warn!("Could not save the action cache: {err}");
+                }
+            }
+            if let Err(err) = tx.global_data().get_scheduler().save().await {
+                tracing::warn!("Could not save the durations of commands: {err}");
+            }
             let val = tx.per_transaction_data().get_tx_channel();
             let trace = tx.per_transaction_data().get_trace_id();
 
-            handle_result(_out, val, trace).await;
+            handle_result(failed, val, trace).await;
         });
         Ok(())
     }
+
+    /// A command by name -- or, for sweeps, a single instance by its instance name, or every
+    /// instance by the name of the sweep
+    async fn lookup_runnable(
+        &self,
+        tx: &mut DiceTransaction,
+        name: String,
+    ) -> Result<Runnable, SmeltErr> {
+        for sweep in self.sweeps.iter() {
+            if sweep.0.template.name == name {
+                return Ok(Runnable::Sweep(sweep.dupe()));
+            }
+            if let Some(index) = sweep.0.index_of(&name) {
+                return Ok(Runnable::Instance(SweepInstance {
+                    sweep: sweep.dupe(),
+                    index,
+                }));
+            }
+        }
+        let command = tx.compute(&LookupCommand(Arc::new(name))).await??;
+        Ok(Runnable::Command(command))
+    }
     pub async fn run_many_tests(
         &self,
         test_names: Vec<String>,
-        event_streamer: Sender<Event>,
+        event_streamer: EventSender,
     ) -> Result<(), SmeltErr> {
         let mut tx = self.start_tx(event_streamer).await?;
         let mut refs = Vec::new();
 
         for test_name in test_names {
-            let val = tx.compute(&LookupCommand(Arc::new(test_name))).await??;
-            refs.push(val);
+            refs.push(self.lookup_runnable(&mut tx, test_name).await?);
         }
         self.run_tests(refs, tx).await
     }
@@ -541,17 +1018,19 @@ impl CommandGraph {
     pub async fn run_one_test(
         &self,
         test_name: impl Into<String>,
-        event_streamer: Sender<Event>,
+        event_streamer: EventSender,
     ) -> Result<(), SmeltErr> {
         let mut tx = self.start_tx(event_streamer).await?;
-        let command = tx
-            .compute(&LookupCommand(Arc::new(test_name.into())))
-            .await??;
-        self.run_tests(vec![command], tx).await
+        let runnable = self.lookup_runnable(&mut tx, test_name.into()).await?;
+        self.run_tests(vec![runnable], tx).await
     }
 
-    async fn validate_graph(&self, tx: &mut DiceTransaction) -> Result<(), Vec<SmeltErr>> {
-        let futs = tx.compute_many(self.all_commands.iter().map(|val| {
+    async fn validate_commands(
+        &self,
+        tx: &mut DiceTransaction,
+        commands: &[CommandRef],
+    ) -> Result<(), Vec<SmeltErr>> {
+        let futs = tx.compute_many(commands.iter().map(|val| {
             DiceComputations::declare_closure(move |ctx: &mut DiceComputations| {
                 get_command_deps(
                     ctx,
@@ -584,6 +1063,63 @@ impl CommandGraph {
     }
 }
 
+fn from_defs(defs: Vec<CommandDef>) -> Result<Vec<Command>, SmeltErr> {
+    defs.into_iter()
+        .map(|def| match def.sweep {
+            Some(_) => Err(SmeltErr::CommandSettingFailed {
+                reason: format!(
+                    "sweep {} can only be set along with every command",
+                    def.name
+                ),
+            }),
+            None => Command::try_from(def),
+        })
+        .collect()
+}
+
+/// Number of commands that are in flight at once -- bounds how many sweep instances exist at any
+/// one time, without waiting on the slowest command of a batch before starting the next
+const RUN_WINDOW: usize = 16 * 1024;
+
+/// Something that can be run -- a command, a single sweep instance, or every instance of a sweep
+#[derive(Clone)]
+enum Runnable {
+    Command(CommandRef),
+    Instance(SweepInstance),
+    Sweep(SweepRef),
+}
+
+impl Runnable {
+    /// Sweeps become their instances, lazily -- everything else is left as it is
+    fn expand(self) -> Box<dyn Iterator<Item = Runnable> + Send> {
+        match self {
+            Runnable::Sweep(sweep) => Box::new((0..sweep.0.len()).map(move |index| {
+                Runnable::Instance(SweepInstance {
+                    sweep: sweep.dupe(),
+                    index,
+                })
+            })),
+            other => Box::new(std::iter::once(other)),
+        }
+    }
+}
+
+async fn execute_runnable(mut tx: DiceTransaction, runnable: Runnable) -> CommandResult {
+    let computed = match runnable {
+        Runnable::Command(command) => tx.compute(&command).await,
+        Runnable::Instance(instance) => tx.compute(&instance).await,
+        Runnable::Sweep(sweep) => {
+            return Err(Arc::new(SmeltErr::CommandSettingFailed {
+                reason: format!("sweep {sweep} was not expanded"),
+            }))
+        }
+    };
+    match computed {
+        Ok(val) => val,
+        Err(err) => Err(Arc::new(SmeltErr::DiceFail(err))),
+    }
+}
+
 /// Handling logic for each command that is executed
 ///
 /// We check each command that was executed for a runtime error -- a runtime error is an error that
@@ -591,7 +1127,7 @@ impl CommandGraph {
 /// be spawned off that needs to be spawned off, etc
 async fn handle_result(
     compute_result: Vec<Result<Arc<ExecutedTestResult>, Arc<SmeltErr>>>,
-    tx: Sender<Event>,
+    tx: EventSender,
     trace: String,
 ) {
     for res in compute_result {
@@ -609,12 +1145,14 @@ async fn handle_result(
 pub struct SmeltServerHandle {
     /// Channel for sending client commands -- covers stuff like running tests
     pub tx_client: UnboundedSender<ClientCommandBundle>,
+    /// Handle to the runtime that the graph server runs on -- lets clients spawn small helper
+    /// tasks next to the server, instead of standing up a thread of their own
+    pub rt_handle: tokio::runtime::Handle,
 }
 
 pub fn spawn_graph_server(cfg: ConfigureSmelt) -> SmeltServerHandle {
     let (tx_client, rx_client) = tokio::sync::mpsc::unbounded_channel();
-
-    let server_handle = SmeltServerHandle { tx_client };
+    let (tx_rt_handle, rx_rt_handle) = std::sync::mpsc::channel();
 
     use tokio::runtime::Builder;
 
@@ -624,6 +1162,7 @@ pub fn spawn_graph_server(cfg: ConfigureSmelt) -> SmeltServerHandle {
             .enable_all()
             .build()
             .unwrap();
+        let _ = tx_rt_handle.send(rt.handle().clone());
 
         //todo -- add failure handling here
         let mut graph = rt.block_on(CommandGraph::new(rx_client, cfg)).unwrap();
@@ -634,23 +1173,26 @@ pub fn spawn_graph_server(cfg: ConfigureSmelt) -> SmeltServerHandle {
             }
         });
     });
-    server_handle
+    let rt_handle = rx_rt_handle
+        .recv()
+        .expect("Graph server thread exited before its runtime was created");
+    SmeltServerHandle {
+        tx_client,
+        rt_handle,
+    }
 }
 
 #[cfg(test)]
 mod tests {
     use std::path::Path;
 
-    use tokio::{
-        fs::File,
-        io::AsyncReadExt,
-        sync::mpsc::{channel, unbounded_channel, Receiver},
-    };
+    use tokio::{fs::File, io::AsyncReadExt, sync::mpsc::unbounded_channel};
 
     use super::*;
+    use smelt_events::{EventBuffer, EventReceiver};
 
     struct TestGraphHandle {
-        rx_chan: Receiver<Event>,
+        rx_chan: EventReceiver,
     }
 
     impl TestGraphHandle {
@@ -681,8 +1223,13 @@ mod tests {
             }),
             smelt_root: std::env!("CARGO_MANIFEST_DIR").to_string(),
             test_only: false,
+            stdout_cfg: None,
+            event_buffer: None,
+            cache: None,
             job_slots: 1,
             init_executor: Some(configure_smelt::InitExecutor::Local(CfgLocal {})),
+            memory_budget_mb: 0,
+            enforce_limits: true,
         }
     }
 
@@ -700,12 +1247,12 @@ mod tests {
 
         let _script = script.unwrap();
         let (_tx, rx) = unbounded_channel();
-        let (tx, rx_handle) = channel(100);
+        let (tx, rx_handle) = EventBuffer::default().channel();
 
         let graph = CommandGraph::new(rx, testing_cfg(yaml_path)).await.unwrap();
         let mut gh = TestGraphHandle { rx_chan: rx_handle };
         graph
-            .run_all_typed("test".to_string(), tx.clone())
+            .run_all_typed("test".to_string(), EventSender::unfiltered(tx.clone()))
             .await
             .unwrap();
         let events = gh.async_blocking_events().await;
@@ -736,4 +1283,97 @@ mod tests {
         let yaml_path = "test_data/command_lists/cl3.yaml";
         execute_all_tests_in_file(yaml_path).await
     }
+
+    #[tokio::test]
+    async fn incremental_updates() {
+        let yaml_data =
+            std::fs::read_to_string(manifest_rel_path("test_data/command_lists/cl2.yaml")).unwrap();
+        let commands: Vec<Command> = serde_yaml::from_str(yaml_data.as_str()).unwrap();
+        let (_tx, rx) = unbounded_channel();
+        let mut graph = CommandGraph::new(rx, testing_cfg(String::new()))
+            .await
+            .unwrap();
+        graph.set_commands(commands.clone()).await.unwrap();
+        let stim = commands.iter().find(|val| val.name == "stim").unwrap();
+        let test = commands.iter().find(|val| val.name == "test").unwrap();
+
+        let rv = graph
+            .update_commands(vec![stim.clone()], vec![], vec![])
+            .await;
+        assert!(matches!(rv, Err(SmeltErr::DuplicateCommandName { .. })));
+        // test depends on stim, so it can't go on its own -- and the graph is left as it was
+        let rv = graph
+            .update_commands(vec![], vec![], vec!["stim".into()])
+            .await;
+        assert!(matches!(rv, Err(SmeltErr::MissingCommandDependency { .. })));
+        assert_eq!(graph.all_commands.len(), commands.len());
+        // nor can a new command depend on something that isn't there
+        let mut orphan = test.clone();
+        orphan.name = "orphan".to_string();
+        orphan.dependencies = vec![serde_yaml::from_str("nowhere").unwrap()];
+        let rv = graph.update_commands(vec![orphan], vec![], vec![]).await;
+        assert!(matches!(rv, Err(SmeltErr::MissingCommandDependency { .. })));
+        let mut orphan = test.clone();
+        orphan.name = "orphan".to_string();
+        orphan.dependent_files = vec![CommandDefPath::new("nowhere.log".to_string())];
+        let rv = graph.update_commands(vec![orphan], vec![], vec![]).await;
+        assert!(matches!(rv, Err(SmeltErr::MissingFileDependency { .. })));
+        assert!(!graph.command_index.contains_key("orphan"));
+        assert_eq!(graph.all_commands.len(), commands.len());
+
+        let mut new_stim = stim.clone();
+        new_stim.script = vec!["echo changed".to_string()];
+        graph
+            .update_commands(vec![], vec![new_stim], vec![])
+            .await
+            .unwrap();
+        let idx = graph.command_index["stim"];
+        assert_eq!(graph.all_commands[idx].0.script, vec!["echo changed"]);
+
+        graph
+            .update_commands(vec![], vec![], vec!["test".into(), "stim".into()])
+            .await
+            .unwrap();
+        assert_eq!(graph.all_commands.len(), commands.len() - 2);
+        graph
+            .update_commands(vec![stim.clone(), test.clone()], vec![], vec![])
+            .await
+            .unwrap();
+        assert_eq!(graph.all_commands.len(), commands.len());
+        for (name, idx) in graph.command_index.iter() {
+            assert_eq!(&graph.all_commands[*idx].0.name, name);
+        }
+
+        // a sweep keeps the commands it depends on too
+        let mut template = test.clone();
+        template.name = "regress".to_string();
+        template.script = vec!["./simv +seed={{seed}}".to_string()];
+        let axes = vec![SweepAxis::Range {
+            name: "seed".to_string(),
+            start: 0,
+            stop: 4,
+            step: 1,
+        }];
+        graph
+            .set_sweeps(vec![Sweep::new(template, axes).unwrap()])
+            .await
+            .unwrap();
+        graph
+            .update_commands(vec![], vec![], vec!["test".into()])
+            .await
+            .unwrap();
+        let rv = graph
+            .update_commands(vec![], vec![], vec!["stim".into()])
+            .await;
+        assert!(matches!(rv, Err(SmeltErr::MissingCommandDependency { .. })));
+        let mut no_sim = commands
+            .iter()
+            .find(|val| val.name == "sim")
+            .unwrap()
+            .clone();
+        no_sim.outputs.clear();
+        let rv = graph.update_commands(vec![], vec![no_sim], vec![]).await;
+        assert!(matches!(rv, Err(SmeltErr::MissingFileDependency { .. })));
+        assert_eq!(graph.all_commands.len(), commands.len() - 1);
+    }
 }
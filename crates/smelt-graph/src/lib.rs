@@ -1,9 +1,21 @@
+mod action_cache;
+mod cas;
 mod commands;
 mod digest;
 mod dispatcher;
 mod executor;
+mod file_index;
 mod graph;
+mod remote_cache;
+mod schedule;
+mod sweep;
 mod utils;
 
+pub use action_cache::*;
+pub use cas::*;
 pub use commands::*;
+pub use file_index::*;
 pub use graph::*;
+pub use remote_cache::*;
+pub use schedule::*;
+pub use sweep::*;
@@ -0,0 +1,707 @@
+//! Action results and blobs shared between machines, through a remote cache that speaks the
+//! ActionCache and ContentAddressableStorage services of the bazel remote execution api
+//!
+//! The local [`ActionCache`](crate::ActionCache) goes to the remote cache when it misses, and
+//! uploads every result it stores -- so a simulator image that was built on CI is restored on a
+//! developer's machine, rather than built again.
+//!
+//! Action digests are smelt's own -- no Action or Command message is uploaded -- so only caches
+//! that store results for any action digest can be used, which rules out caches that validate
+//! results against their actions.
+//!
+//! Blobs go through the batch rpcs in batches of about [`BATCH_MAX_BYTES`]. Blobs that are larger
+//! than that are streamed through ByteStream, straight from or to their file, so no more than a
+//! chunk of them is ever held in memory. [`StandInRemote`] is an in memory server for tests, and
+//! for trying a remote cache out locally
+
+use std::{
+    collections::HashMap,
+    io,
+    path::Path,
+    pin::Pin,
+    sync::{
+        atomic::{AtomicU64, Ordering},
+        Mutex,
+    },
+};
+
+use futures::Stream;
+use sha2::{Digest as _, Sha256};
+use smelt_data::{
+    bytestream::{
+        byte_stream_client::ByteStreamClient,
+        byte_stream_server::{self, ByteStreamServer},
+        ReadRequest, ReadResponse, WriteRequest, WriteResponse,
+    },
+    executed_tests::{self, Digest},
+    remote_execution::{
+        action_cache_client::ActionCacheClient,
+        action_cache_server::{self, ActionCacheServer},
+        batch_read_blobs_response, batch_update_blobs_request, batch_update_blobs_response,
+        content_addressable_storage_client::ContentAddressableStorageClient,
+        content_addressable_storage_server::{self, ContentAddressableStorageServer},
+        ActionResult, BatchReadBlobsRequest, BatchReadBlobsResponse, BatchUpdateBlobsRequest,
+        BatchUpdateBlobsResponse, FindMissingBlobsRequest, FindMissingBlobsResponse,
+        GetActionResultRequest, OutputFile, Status as RpcStatus, UpdateActionResultRequest,
+    },
+};
+use tokio::{
+    io::{AsyncReadExt, AsyncWriteExt},
+    net::TcpListener,
+    sync::mpsc,
+};
+use tokio_stream::wrappers::{ReceiverStream, TcpListenerStream};
+use tonic::{
+    transport::{Channel, Endpoint, Server},
+    Code, Request, Response, Status, Streaming,
+};
+
+/// Blobs are grouped in to batches of about this many bytes -- larger blobs are streamed
+pub const BATCH_MAX_BYTES: i64 = 3 << 20;
+
+/// Size of each message when a blob is streamed
+const STREAM_CHUNK_BYTES: usize = 1 << 20;
+
+#[derive(Clone)]
+pub struct RemoteCache {
+    instance_name: String,
+    action_cache: ActionCacheClient<Channel>,
+    cas: ContentAddressableStorageClient<Channel>,
+    bytestream: ByteStreamClient<Channel>,
+}
+
+impl RemoteCache {
+    /// `url` is e.g. `http://cache.internal:9092` -- nothing is sent until the first lookup, so a
+    /// cache that is down only costs the commands that go to it
+    pub fn connect(url: &str, instance_name: String) -> Result<Self, tonic::transport::Error> {
+        let channel = Endpoint::from_shared(url.to_string())?.connect_lazy();
+        Ok(Self {
+            instance_name,
+            action_cache: ActionCacheClient::new(channel.clone()),
+            cas: ContentAddressableStorageClient::new(channel.clone())
+                .max_decoding_message_size(usize::MAX)
+                .max_encoding_message_size(usize::MAX),
+            bytestream: ByteStreamClient::new(channel),
+        })
+    }
+
+    /// None if the remote cache has no result for `action`
+    pub async fn get_action_result(&self, action: &Digest) -> io::Result<Option<ActionResult>> {
+        let request = GetActionResultRequest {
+            instance_name: self.instance_name.clone(),
+            action_digest: Some(action.clone()),
+        };
+        match self.action_cache.clone().get_action_result(request).await {
+            Ok(response) => Ok(Some(response.into_inner())),
+            Err(status) if status.code() == Code::NotFound => Ok(None),
+            Err(status) => Err(rpc_err(status)),
+        }
+    }
+
+    pub async fn update_action_result(
+        &self,
+        action: &Digest,
+        result: ActionResult,
+    ) -> io::Result<()> {
+        let request = UpdateActionResultRequest {
+            instance_name: self.instance_name.clone(),
+            action_digest: Some(action.clone()),
+            action_result: Some(result),
+        };
+        self.action_cache
+            .clone()
+            .update_action_result(request)
+            .await
+            .map_err(rpc_err)?;
+        Ok(())
+    }
+
+    /// The digests in `digests` that the remote cache doesn't have
+    pub async fn find_missing_blobs(&self, digests: Vec<Digest>) -> io::Result<Vec<Digest>> {
+        let request = FindMissingBlobsRequest {
+            instance_name: self.instance_name.clone(),
+            blob_digests: digests,
+        };
+        let response = self
+            .cas
+            .clone()
+            .find_missing_blobs(request)
+            .await
+            .map_err(rpc_err)?;
+        Ok(response.into_inner().missing_blob_digests)
+    }
+
+    pub async fn update_blobs(&self, blobs: Vec<(Digest, Vec<u8>)>) -> io::Result<()> {
+        let request = BatchUpdateBlobsRequest {
+            instance_name: self.instance_name.clone(),
+            requests: blobs
+                .into_iter()
+                .map(|(digest, data)| batch_update_blobs_request::Request {
+                    digest: Some(digest),
+                    data,
+                })
+                .collect(),
+        };
+        let response = self
+            .cas
+            .clone()
+            .batch_update_blobs(request)
+            .await
+            .map_err(rpc_err)?;
+        for blob in response.into_inner().responses {
+            check_status(blob.status)?;
+        }
+        Ok(())
+    }
+
+    /// Contents of every blob in `digests` -- errors if any of them are missing
+    pub async fn read_blobs(&self, digests: Vec<Digest>) -> io::Result<Vec<(Digest, Vec<u8>)>> {
+        let request = BatchReadBlobsRequest {
+            instance_name: self.instance_name.clone(),
+            digests,
+        };
+        let response = self
+            .cas
+            .clone()
+            .batch_read_blobs(request)
+            .await
+            .map_err(rpc_err)?;
+        let mut blobs = vec![];
+        for blob in response.into_inner().responses {
+            check_status(blob.status)?;
+            blobs.push((blob.digest.unwrap_or_default(), blob.data));
+        }
+        Ok(blobs)
+    }
+
+    /// Streams the blob for `digest` in to a new file at `path`
+    pub async fn read_blob(&self, digest: &Digest, path: &Path) -> io::Result<()> {
+        let request = ReadRequest {
+            resource_name: self.resource_name(&blob_resource(digest)),
+            read_offset: 0,
+            read_limit: 0,
+        };
+        let mut chunks = self
+            .bytestream
+            .clone()
+            .read(request)
+            .await
+            .map_err(rpc_err)?
+            .into_inner();
+        let mut file = tokio::fs::File::create(path).await?;
+        while let Some(chunk) = chunks.message().await.map_err(rpc_err)? {
+            file.write_all(&chunk.data).await?;
+        }
+        file.flush().await
+    }
+
+    /// Streams the file at `path`, whose contents hash to `digest`, to the remote cache
+    pub async fn write_blob(&self, digest: &Digest, path: &Path) -> io::Result<()> {
+        static NEXT_UPLOAD: AtomicU64 = AtomicU64::new(0);
+        let upload = format!(
+            "uploads/{}-{}/{}",
+            std::process::id(),
+            NEXT_UPLOAD.fetch_add(1, Ordering::Relaxed),
+            blob_resource(digest)
+        );
+        let mut resource_name = self.resource_name(&upload);
+        let mut file = tokio::fs::File::open(path).await?;
+        let (tx, rx) = mpsc::channel(2);
+        let send = async move {
+            let mut write_offset = 0;
+            loop {
+                let mut data = Vec::with_capacity(STREAM_CHUNK_BYTES);
+                (&mut file)
+                    .take(STREAM_CHUNK_BYTES as u64)
+                    .read_to_end(&mut data)
+                    .await?;
+                let len = data.len() as i64;
+                let finish_write = data.len() < STREAM_CHUNK_BYTES;
+                let request = WriteRequest {
+                    resource_name: std::mem::take(&mut resource_name),
+                    write_offset,
+                    finish_write,
+                    data,
+                };
+                // the rpc has already failed if it stopped taking chunks
+                if tx.send(request).await.is_err() || finish_write {
+                    return io::Result::Ok(());
+                }
+                write_offset += len;
+            }
+        };
+        let write = self.bytestream.clone().write(ReceiverStream::new(rx));
+        let (sent, written) = tokio::join!(send, write);
+        sent?;
+        let committed_size = written.map_err(rpc_err)?.into_inner().committed_size;
+        if committed_size != digest.size_bytes {
+            return Err(io::Error::other(format!(
+                "remote cache committed {committed_size} bytes of {}, rather than {}",
+                digest.hash, digest.size_bytes
+            )));
+        }
+        Ok(())
+    }
+
+    fn resource_name(&self, resource: &str) -> String {
+        if self.instance_name.is_empty() {
+            resource.to_string()
+        } else {
+            format!("{}/{resource}", self.instance_name)
+        }
+    }
+}
+
+fn blob_resource(digest: &Digest) -> String {
+    format!("blobs/{}/{}", digest.hash, digest.size_bytes)
+}
+
+/// The hash in a ByteStream resource name
+fn resource_hash(resource_name: &str) -> Option<&str> {
+    let (_, blob) = resource_name.rsplit_once("blobs/")?;
+    Some(blob.split_once('/')?.0)
+}
+
+/// The REAPI shape of a result in the local action cache
+pub(crate) fn to_remote(result: &executed_tests::ActionResult) -> ActionResult {
+    ActionResult {
+        output_files: result
+            .output_files
+            .iter()
+            .map(|output| OutputFile {
+                path: output.path.clone(),
+                digest: output.digest.clone(),
+                is_executable: output.is_executable,
+            })
+            .collect(),
+        exit_code: result.exit_code,
+        stdout_digest: result.stdout_digest.clone(),
+    }
+}
+
+pub(crate) fn from_remote(result: ActionResult) -> executed_tests::ActionResult {
+    executed_tests::ActionResult {
+        exit_code: result.exit_code,
+        output_files: result
+            .output_files
+            .into_iter()
+            .map(|output| executed_tests::OutputFile {
+                path: output.path,
+                digest: output.digest,
+                is_executable: output.is_executable,
+            })
+            .collect(),
+        stdout_digest: result.stdout_digest,
+    }
+}
+
+/// Splits `digests` in to batches of about [`BATCH_MAX_BYTES`], and the blobs that are too large
+/// for any batch, which have to be streamed
+pub(crate) fn batches(digests: Vec<Digest>) -> (Vec<Vec<Digest>>, Vec<Digest>) {
+    let mut batches: Vec<Vec<Digest>> = vec![];
+    let mut streamed = vec![];
+    let mut batch_bytes = 0;
+    for digest in digests {
+        if digest.size_bytes > BATCH_MAX_BYTES {
+            streamed.push(digest);
+            continue;
+        }
+        match batches.last_mut() {
+            Some(batch) if batch_bytes + digest.size_bytes <= BATCH_MAX_BYTES => {
+                batch_bytes += digest.size_bytes;
+                batch.push(digest);
+            }
+            _ => {
+                batch_bytes = digest.size_bytes;
+                batches.push(vec![digest]);
+            }
+        }
+    }
+    (batches, streamed)
+}
+
+fn rpc_err(status: Status) -> io::Error {
+    io::Error::other(status)
+}
+
+fn check_status(status: Option<RpcStatus>) -> io::Result<()> {
+    match status {
+        Some(status) if status.code != Code::Ok as i32 => Err(rpc_err(Status::new(
+            Code::from_i32(status.code),
+            status.message,
+        ))),
+        _ => Ok(()),
+    }
+}
+
+fn rpc_status(code: Code, message: &str) -> Option<RpcStatus> {
+    Some(RpcStatus {
+        code: code as i32,
+        message: message.to_string(),
+    })
+}
+
+/// An in memory remote cache -- results and blobs last as long as the server does
+#[derive(Default)]
+pub struct StandInRemote {
+    /// Keyed by instance name and action hash
+    actions: Mutex<HashMap<(String, String), ActionResult>>,
+    /// Blobs are shared between instances, since they're addressed by their contents
+    blobs: Mutex<HashMap<String, Vec<u8>>>,
+}
+
+impl StandInRemote {
+    /// Serves every service on `listener`, until the future is dropped
+    pub async fn serve(self, listener: TcpListener) -> Result<(), tonic::transport::Error> {
+        let remote = std::sync::Arc::new(self);
+        Server::builder()
+            .add_service(ActionCacheServer::from_arc(remote.clone()))
+            .add_service(ByteStreamServer::from_arc(remote.clone()))
+            .add_service(
+                ContentAddressableStorageServer::from_arc(remote)
+                    .max_decoding_message_size(usize::MAX)
+                    .max_encoding_message_size(usize::MAX),
+            )
+            .serve_with_incoming(TcpListenerStream::new(listener))
+            .await
+    }
+}
+
+#[tonic::async_trait]
+impl action_cache_server::ActionCache for StandInRemote {
+    async fn get_action_result(
+        &self,
+        request: Request<GetActionResultRequest>,
+    ) -> Result<Response<ActionResult>, Status> {
+        let request = request.into_inner();
+        let hash = request.action_digest.unwrap_or_default().hash;
+        self.actions
+            .lock()
+            .unwrap()
+            .get(&(request.instance_name, hash))
+            .cloned()
+            .map(Response::new)
+            .ok_or_else(|| Status::not_found("no result for this action"))
+    }
+
+    async fn update_action_result(
+        &self,
+        request: Request<UpdateActionResultRequest>,
+    ) -> Result<Response<ActionResult>, Status> {
+        let request = request.into_inner();
+        let hash = request.action_digest.unwrap_or_default().hash;
+        let result = request
+            .action_result
+            .ok_or_else(|| Status::invalid_argument("action_result is required"))?;
+        self.actions
+            .lock()
+            .unwrap()
+            .insert((request.instance_name, hash), result.clone());
+        Ok(Response::new(result))
+    }
+}
+
+#[tonic::async_trait]
+impl content_addressable_storage_server::ContentAddressableStorage for StandInRemote {
+    async fn find_missing_blobs(
+        &self,
+        request: Request<FindMissingBlobsRequest>,
+    ) -> Result<Response<FindMissingBlobsResponse>, Status> {
+        let blobs = self.blobs.lock().unwrap();
+        let missing_blob_digests = request
+            .into_inner()
+            .blob_digests
+            .into_iter()
+            .filter(|digest| !blobs.contains_key(&digest.hash))
+            .collect();
+        Ok(Response::new(FindMissingBlobsResponse {
+            missing_blob_digests,
+        }))
+    }
+
+    async fn batch_update_blobs(
+        &self,
+        request: Request<BatchUpdateBlobsRequest>,
+    ) -> Result<Response<BatchUpdateBlobsResponse>, Status> {
+        let mut blobs = self.blobs.lock().unwrap();
+        let responses = request
+            .into_inner()
+            .requests
+            .into_iter()
+            .map(|blob| {
+                let digest = blob.digest.unwrap_or_default();
+                let status = if hex::encode(Sha256::digest(&blob.data)) == digest.hash {
+                    blobs.insert(digest.hash.clone(), blob.data);
+                    None
+                } else {
+                    rpc_status(Code::InvalidArgument, "data doesn't match its digest")
+                };
+                batch_update_blobs_response::Response {
+                    digest: Some(digest),
+                    status,
+                }
+            })
+            .collect();
+        Ok(Response::new(BatchUpdateBlobsResponse { responses }))
+    }
+
+    async fn batch_read_blobs(
+        &self,
+        request: Request<BatchReadBlobsRequest>,
+    ) -> Result<Response<BatchReadBlobsResponse>, Status> {
+        let blobs = self.blobs.lock().unwrap();
+        let responses = request
+            .into_inner()
+            .digests
+            .into_iter()
+            .map(|digest| match blobs.get(&digest.hash) {
+                Some(data) => batch_read_blobs_response::Response {
+                    digest: Some(digest),
+                    data: data.clone(),
+                    status: None,
+                },
+                None => batch_read_blobs_response::Response {
+                    digest: Some(digest),
+                    data: vec![],
+                    status: rpc_status(Code::NotFound, "blob is missing"),
+                },
+            })
+            .collect();
+        Ok(Response::new(BatchReadBlobsResponse { responses }))
+    }
+}
+
+type BlobChunks = Pin<Box<dyn Stream<Item = Result<ReadResponse, Status>> + Send>>;
+
+#[tonic::async_trait]
+impl byte_stream_server::ByteStream for StandInRemote {
+    type ReadStream = BlobChunks;
+
+    async fn read(&self, request: Request<ReadRequest>) -> Result<Response<BlobChunks>, Status> {
+        let resource_name = request.into_inner().resource_name;
+        let hash = resource_hash(&resource_name)
+            .ok_or_else(|| Status::invalid_argument("resource_name isn't a blob"))?;
+        let data = self
+            .blobs
+            .lock()
+            .unwrap()
+            .get(hash)
+            .cloned()
+            .ok_or_else(|| Status::not_found("blob is missing"))?;
+        let chunks: Vec<Result<ReadResponse, Status>> = data
+            .chunks(STREAM_CHUNK_BYTES)
+            .map(|chunk| {
+                Ok(ReadResponse {
+                    data: chunk.to_vec(),
+                })
+            })
+            .collect();
+        Ok(Response::new(Box::pin(tokio_stream::iter(chunks))))
+    }
+
+    async fn write(
+        &self,
+        request: Request<Streaming<WriteRequest>>,
+    ) -> Result<Response<WriteResponse>, Status> {
+        let mut chunks = request.into_inner();
+        let mut resource_name = String::new();
+        let mut data = vec![];
+        while let Some(chunk) = chunks.message().await? {
+            if resource_name.is_empty() {
+                resource_name = chunk.resource_name;
+            }
+            if chunk.write_offset != data.len() as i64 {
+                return Err(Status::invalid_argument(
+                    "chunks have to be written in order",
+                ));
+            }
+            data.extend_from_slice(&chunk.data);
+            if chunk.finish_write {
+                let hash = resource_hash(&resource_name)
+                    .ok_or_else(|| Status::invalid_argument("resource_name isn't a blob"))?;
+                if hex::encode(Sha256::digest(&data)) != hash {
+                    return Err(Status::invalid_argument("data doesn't match its digest"));
+                }
+                let committed_size = data.len() as i64;
+                self.blobs.lock().unwrap().insert(hash.to_string(), data);
+                return Ok(Response::new(WriteResponse { committed_size }));
+            }
+        }
+        Err(Status::invalid_argument("the write was never finished"))
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use crate::{cas::is_executable, commands::Command, executor::create_test_result, ActionCache};
+    use dice::{Dice, DiceTransaction};
+    use smelt_data::client_commands::ConfigureSmelt;
+    use smelt_events::runtime_support::SetSmeltCfg;
+    use std::path::{Path, PathBuf};
+
+    async fn checkout(root: &Path) -> (Command, DiceTransaction) {
+        let _ = std::fs::remove_dir_all(root);
+        std::fs::create_dir_all(root.join("smelt-out/build")).unwrap();
+        std::fs::write(root.join("src.v"), "module top;").unwrap();
+        let command = serde_yaml::from_str(&format!(
+            r#"
+name: build
+target_type: build
+script: ["make"]
+dependent_files: ["src.v"]
+outputs: ["simv"]
+working_dir: {}
+runtime:
+  num_cpus: 1
+  max_memory_mb: 1024
+  timeout: 600
+  env: {{}}
+"#,
+            root.display()
+        ))
+        .unwrap();
+
+        let mut builder = Dice::builder();
+        builder.set_smelt_cfg(ConfigureSmelt {
+            smelt_root: root.to_string_lossy().to_string(),
+            job_slots: 1,
+            ..Default::default()
+        });
+        let dice = builder.build(dice::DetectCycles::Enabled);
+        (command, dice.updater().commit().await)
+    }
+
+    #[tokio::test]
+    async fn results_are_shared_through_the_remote() {
+        let listener = TcpListener::bind("127.0.0.1:0").await.unwrap();
+        let url = format!("http://{}", listener.local_addr().unwrap());
+        tokio::spawn(StandInRemote::default().serve(listener));
+        let remote = || RemoteCache::connect(&url, "smelt".to_string()).unwrap();
+
+        let tmp = std::env::temp_dir().join(format!("smelt-remote-{}", std::process::id()));
+        let (ci_root, dev_root): (PathBuf, PathBuf) = (tmp.join("ci"), tmp.join("dev"));
+
+        // ci builds simv, and uploads it -- simv is too large for a batch, so it's streamed
+        let simv = "binary".repeat(BATCH_MAX_BYTES as usize / 6 + 1);
+        let (command, tx) = checkout(&ci_root).await;
+        std::fs::write(ci_root.join("simv"), &simv).unwrap();
+        #[cfg(unix)]
+        {
+            use std::os::unix::fs::PermissionsExt;
+            let executable = std::fs::Permissions::from_mode(0o755);
+            std::fs::set_permissions(ci_root.join("simv"), executable).unwrap();
+        }
+        std::fs::write(ci_root.join("smelt-out/build/command.out"), "built").unwrap();
+        let ci = ActionCache::new(ci_root.clone(), 0).with_remote(remote());
+        let action = ci.action_digest(&command, &[]).await.unwrap().unwrap();
+        let mut executed = create_test_result(&command, 0, tx.global_data());
+        ci.record(Some(&action), &command, &mut executed)
+            .await
+            .unwrap();
+
+        // a checkout somewhere else has the same action, and restores simv rather than building it
+        let (command, tx) = checkout(&dev_root).await;
+        let dev = ActionCache::new(dev_root.clone(), 0).with_remote(remote());
+        assert_eq!(
+            dev.action_digest(&command, &[]).await.unwrap(),
+            Some(action.clone())
+        );
+        let result = dev.lookup(&action).await.unwrap();
+        let restored = dev
+            .restore(&command, &result, tx.global_data())
+            .await
+            .unwrap();
+        assert_eq!(
+            std::fs::read_to_string(dev_root.join("simv")).unwrap(),
+            simv
+        );
+        // still something that can be run
+        #[cfg(unix)]
+        assert!(is_executable(
+            &std::fs::metadata(dev_root.join("simv"))
+                .unwrap()
+                .permissions()
+        ));
+        assert_eq!(restored.result_digest(), executed.result_digest());
+
+        // which is in the local cache from then on
+        let offline = ActionCache::new(dev_root.clone(), 0);
+        assert!(offline.lookup(&action).await.is_some());
+
+        // and a blob that doesn't match its digest is refused
+        let bogus = Digest {
+            hash: "00".repeat(32),
+            size_bytes: 4,
+        };
+        assert!(remote()
+            .update_blobs(vec![(bogus, b"oops".to_vec())])
+            .await
+            .is_err());
+
+        let _ = std::fs::remove_dir_all(&tmp);
+    }
+
+    #[test]
+    fn large_blobs_are_streamed() {
+        let digest = |size_bytes| Digest {
+            hash: String::new(),
+            size_bytes,
+        };
+        let (batched, streamed) = batches(vec![
+            digest(1 << 20),
+            digest(1 << 20),
+            digest(BATCH_MAX_BYTES * 2),
+            digest(BATCH_MAX_BYTES),
+            digest(1),
+        ]);
+        let sizes: Vec<Vec<i64>> = batched
+            .into_iter()
+            .map(|batch| batch.iter().map(|digest| digest.size_bytes).collect())
+            .collect();
+        assert_eq!(
+            sizes,
+            vec![vec![1 << 20, 1 << 20], vec![BATCH_MAX_BYTES], vec![1]]
+        );
+        assert_eq!(streamed, vec![digest(BATCH_MAX_BYTES * 2)]);
+    }
+
+    #[tokio::test]
+    async fn blobs_stream_from_and_to_files() {
+        let listener = TcpListener::bind("127.0.0.1:0").await.unwrap();
+        let url = format!("http://{}", listener.local_addr().unwrap());
+        tokio::spawn(StandInRemote::default().serve(listener));
+        let remote = RemoteCache::connect(&url, "smelt".to_string()).unwrap();
+
+        let tmp = std::env::temp_dir().join(format!("smelt-stream-{}", std::process::id()));
+        std::fs::create_dir_all(&tmp).unwrap();
+        // a chunk and a bit, then exactly two chunks, so the last chunk is empty
+        for len in [STREAM_CHUNK_BYTES + 7, STREAM_CHUNK_BYTES * 2] {
+            let data: Vec<u8> = (0..len).map(|idx| (idx % 251) as u8).collect();
+            std::fs::write(tmp.join("blob"), &data).unwrap();
+            let digest = Digest {
+                hash: hex::encode(Sha256::digest(&data)),
+                size_bytes: len as i64,
+            };
+            remote.write_blob(&digest, &tmp.join("blob")).await.unwrap();
+            assert!(remote
+                .find_missing_blobs(vec![digest.clone()])
+                .await
+                .unwrap()
+                .is_empty());
+            remote.read_blob(&digest, &tmp.join("read")).await.unwrap();
+            assert_eq!(std::fs::read(tmp.join("read")).unwrap(), data);
+        }
+
+        // a blob that doesn't match its digest is refused, and one that isn't there can't be read
+        let bogus = Digest {
+            hash: "00".repeat(32),
+            size_bytes: 4,
+        };
+        std::fs::write(tmp.join("blob"), "oops").unwrap();
+        assert!(remote.write_blob(&bogus, &tmp.join("blob")).await.is_err());
+        assert!(remote.read_blob(&bogus, &tmp.join("read")).await.is_err());
+
+        let _ = std::fs::remove_dir_all(&tmp);
+    }
+}
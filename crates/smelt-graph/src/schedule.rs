@@ -0,0 +1,452 @@
+//! Orders the commands that are waiting for job slots by their critical path
+//!
+//! How long each command ran for is remembered across invocations, in `smelt-out/.durations`.
+//! Before every run, each command's priority is set to the longest path from it to the end of the
+//! graph: its own estimate, plus the longest path of any command that depends on it. The
+//! [`ResourceGate`](smelt_events::runtime_support::ResourceGate) admits the waiting command with
+//! the longest path first, so a long build that a whole regression waits on isn't queued behind
+//! hundreds of short tests.
+//!
+//! Commands that have never run are estimated at the median of the durations that are known.
+//! Every instance of a sweep shares one estimate, under the name of the sweep
+
+use std::{
+    collections::HashMap,
+    io,
+    path::PathBuf,
+    sync::{
+        atomic::{AtomicBool, Ordering},
+        Arc, Mutex, RwLock,
+    },
+    time::Duration,
+};
+
+use dice::{DiceData, DiceDataBuilder};
+use prost::Message;
+use smelt_data::executed_tests::{CommandDuration, CommandDurations};
+
+use crate::{cas::tmp_path, commands::Command, sweep::sweep_name};
+
+pub const DURATIONS_FILE: &str = ".durations";
+
+/// What commands are estimated at before anything has run -- priorities then only count how many
+/// commands are downstream
+const DEFAULT_ESTIMATE_MS: u64 = 1000;
+
+/// The latest run of a command makes up 1/SMOOTHING of its estimate
+const SMOOTHING: u64 = 4;
+
+pub struct Scheduler {
+    path: PathBuf,
+    /// How long each command is expected to run for, in ms
+    history: Mutex<HashMap<String, u64>>,
+    /// Longest path from each command in the graph to the end of it, in ms
+    priorities: RwLock<HashMap<String, u64>>,
+    dirty: AtomicBool,
+}
+
+impl Scheduler {
+    /// Reads the durations at `path` -- starts out empty if there aren't any, or they can't be
+    /// read
+    pub fn load(path: PathBuf) -> Self {
+        let history = std::fs::read(&path)
+            .ok()
+            .and_then(|encoded| CommandDurations::decode(encoded.as_slice()).ok())
+            .map(|durations| {
+                durations
+                    .commands
+                    .into_iter()
+                    .map(|command| (command.name, command.estimate_ms))
+                    .collect()
+            })
+            .unwrap_or_default();
+        Self {
+            path,
+            history: Mutex::new(history),
+            priorities: RwLock::new(HashMap::new()),
+            dirty: AtomicBool::new(false),
+        }
+    }
+
+    /// Folds a run of the command `name` in to its estimate
+    pub fn record(&self, name: &str, elapsed: Duration) {
+        let elapsed_ms = elapsed.as_millis() as u64;
+        self.history
+            .lock()
+            .unwrap()
+            .entry(sweep_name(name).to_string())
+            .and_modify(|estimate| {
+                *estimate = (*estimate * (SMOOTHING - 1) + elapsed_ms) / SMOOTHING
+            })
+            .or_insert(elapsed_ms);
+        self.dirty.store(true, Ordering::Relaxed);
+    }
+
+    /// Sets the priority of every command in `commands` from their critical paths
+    pub fn plan<'a>(&self, commands: impl IntoIterator<Item = &'a Command>) {
+        let commands: Vec<&Command> = commands.into_iter().collect();
+        let estimates: Vec<u64> = {
+            let history = self.history.lock().unwrap();
+            let fallback = median(&history);
+            commands
+                .iter()
+                .map(|command| history.get(&command.name).copied().unwrap_or(fallback))
+                // so that commands that take no time still count towards the length of a path
+                .map(|estimate| estimate.max(1))
+                .collect()
+        };
+        let paths = critical_paths(&estimates, &dependents(&commands));
+        *self.priorities.write().unwrap() = commands
+            .iter()
+            .map(|command| command.name.clone())
+            .zip(paths)
+            .collect();
+    }
+
+    /// Longest path from the command `name` to the end of the graph, in ms -- a command that
+    /// wasn't planned only counts itself
+    pub fn priority(&self, name: &str) -> u64 {
+        let name = sweep_name(name);
+        if let Some(&priority) = self.priorities.read().unwrap().get(name) {
+            return priority;
+        }
+        let history = self.history.lock().unwrap();
+        history
+            .get(name)
+            .copied()
+            .unwrap_or_else(|| median(&history))
+    }
+
+    /// Writes the durations back, if anything ran since they were loaded
+    pub async fn save(&self) -> io::Result<()> {
+        if !self.dirty.swap(false, Ordering::Relaxed) {
+            return Ok(());
+        }
+        let encoded = {
+            let history = self.history.lock().unwrap();
+            CommandDurations {
+                commands: history
+                    .iter()
+                    .map(|(name, &estimate_ms)| CommandDuration {
+                        name: name.clone(),
+                        estimate_ms,
+                    })
+                    .collect(),
+            }
+            .encode_to_vec()
+        };
+        if let Some(parent) = self.path.parent() {
+            tokio::fs::create_dir_all(parent).await?;
+        }
+        let tmp = tmp_path(&self.path);
+        tokio::fs::write(&tmp, encoded).await?;
+        tokio::fs::rename(&tmp, &self.path).await
+    }
+}
+
+fn median(history: &HashMap<String, u64>) -> u64 {
+    let mut known: Vec<u64> = history.values().copied().collect();
+    if known.is_empty() {
+        return DEFAULT_ESTIMATE_MS;
+    }
+    let mid = known.len() / 2;
+    *known.select_nth_unstable(mid).1
+}
+
+/// For each command, the commands that depend on it -- by name, or on a file that it outputs
+fn dependents(commands: &[&Command]) -> Vec<Vec<usize>> {
+    let mut index = HashMap::new();
+    let mut owners = HashMap::new();
+    for (idx, command) in commands.iter().enumerate() {
+        index.insert(command.name.as_str(), idx);
+        for output in command.outputs.iter() {
+            owners.insert(output, idx);
+        }
+    }
+    let mut dependents = vec![vec![]; commands.len()];
+    for (idx, command) in commands.iter().enumerate() {
+        let by_name = command
+            .dependencies
+            .iter()
+            .filter_map(|dep| index.get(dep.get_command_name()));
+        let by_file = command
+            .dependent_files
+            .iter()
+            .filter_map(|file| owners.get(file));
+        for &dep in by_name.chain(by_file) {
+            dependents[dep].push(idx);
+        }
+    }
+    dependents
+}
+
+/// Longest path from each node to the end of the graph, counting the estimate of every node on it
+///
+/// Cycles are cut where they're found, rather than reported -- dice reports them once the graph
+/// runs
+pub fn critical_paths(estimates: &[u64], dependents: &[Vec<usize>]) -> Vec<u64> {
+    let mut paths: Vec<Option<u64>> = vec![None; estimates.len()];
+    let mut visiting = vec![false; estimates.len()];
+    for root in 0..estimates.len() {
+        // depth first, with the position in each node's dependents -- graphs can be deep enough to
+        // overflow the stack if this recursed
+        let mut stack = vec![(root, 0)];
+        while let Some(&(node, next)) = stack.last() {
+            if paths[node].is_some() {
+                stack.pop();
+                continue;
+            }
+            visiting[node] = true;
+            match dependents[node].get(next) {
+                Some(&child) => {
+                    stack.last_mut().unwrap().1 += 1;
+                    if paths[child].is_none() && !visiting[child] {
+                        stack.push((child, 0));
+                    }
+                }
+                None => {
+                    let longest = dependents[node]
+                        .iter()
+                        .filter_map(|&child| paths[child])
+                        .max()
+                        .unwrap_or(0);
+                    paths[node] = Some(estimates[node].saturating_add(longest));
+                    visiting[node] = false;
+                    stack.pop();
+                }
+            }
+        }
+    }
+    paths.into_iter().map(Option::unwrap_or_default).collect()
+}
+
+pub trait SetScheduler {
+    fn set_scheduler(&mut self, scheduler: Arc<Scheduler>);
+}
+
+pub trait GetScheduler {
+    fn get_scheduler(&self) -> Arc<Scheduler>;
+}
+
+impl SetScheduler for DiceDataBuilder {
+    fn set_scheduler(&mut self, scheduler: Arc<Scheduler>) {
+        self.set(scheduler)
+    }
+}
+
+impl GetScheduler for DiceData {
+    fn get_scheduler(&self) -> Arc<Scheduler> {
+        self.get::<Arc<Scheduler>>()
+            .expect("Scheduler should be set")
+            .clone()
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use std::{
+        cmp::Reverse,
+        collections::{BTreeSet, BinaryHeap},
+    };
+
+    fn commands(yaml: &str) -> Vec<Command> {
+        serde_yaml::from_str(yaml).unwrap()
+    }
+
+    #[tokio::test]
+    async fn priorities_follow_the_critical_path() {
+        let root = std::env::temp_dir().join(format!("smelt-sched-{}", std::process::id()));
+        let _ = std::fs::remove_dir_all(&root);
+        let commands = commands(
+            r#"
+- name: build
+  target_type: build
+  script: []
+  outputs: ["simv"]
+  runtime: {num_cpus: 1, max_memory_mb: 1024, timeout: 600, env: {}}
+- name: sim
+  target_type: test
+  script: []
+  dependent_files: ["simv"]
+  runtime: {num_cpus: 1, max_memory_mb: 1024, timeout: 600, env: {}}
+- name: lint
+  target_type: test
+  script: []
+  runtime: {num_cpus: 1, max_memory_mb: 1024, timeout: 600, env: {}}
+- name: regress
+  target_type: test
+  script: []
+  dependencies: ["build"]
+  runtime: {num_cpus: 1, max_memory_mb: 1024, timeout: 600, env: {}}
+"#,
+        );
+        let scheduler = Scheduler::load(root.join(DURATIONS_FILE));
+        scheduler.plan(commands.iter());
+        // nothing has run, so only the number of commands on each path counts
+        assert_eq!(scheduler.priority("build"), 2 * DEFAULT_ESTIMATE_MS);
+        assert_eq!(scheduler.priority("lint"), DEFAULT_ESTIMATE_MS);
+
+        scheduler.record("build", Duration::from_secs(300));
+        scheduler.record("sim", Duration::from_secs(20));
+        scheduler.record("lint", Duration::from_secs(30));
+        scheduler.record("regress[seed=1]", Duration::from_secs(40));
+        scheduler.record("regress[seed=2]", Duration::from_secs(80));
+        scheduler.save().await.unwrap();
+
+        let reloaded = Scheduler::load(root.join(DURATIONS_FILE));
+        reloaded.plan(commands.iter());
+        // the regression waits on the build through its name, the sim through its file
+        assert_eq!(reloaded.priority("regress[seed=3]"), 50_000);
+        assert_eq!(reloaded.priority("build"), 350_000);
+        // commands that never ran are estimated at the median
+        assert_eq!(reloaded.priority("new"), 50_000);
+
+        let _ = std::fs::remove_dir_all(&root);
+    }
+
+    #[test]
+    fn cycles_are_cut() {
+        let paths = critical_paths(&[1, 2, 4], &[vec![1], vec![2], vec![0]]);
+        assert_eq!(paths, vec![7, 6, 4]);
+    }
+
+    /// How long `durations` take on `slots` job slots, when ready commands are admitted highest
+    /// priority first and in the order they became ready within a priority -- like the gate
+    fn makespan(
+        durations: &[u64],
+        dependents: &[Vec<usize>],
+        slots: usize,
+        priorities: &[u64],
+    ) -> u64 {
+        let mut waiting_on = vec![0; durations.len()];
+        for &dependent in dependents.iter().flatten() {
+            waiting_on[dependent] += 1;
+        }
+        let mut arrivals = 0;
+        let mut ready = BinaryHeap::new();
+        for (idx, _) in waiting_on
+            .iter()
+            .enumerate()
+            .filter(|(_, deps)| **deps == 0)
+        {
+            ready.push((priorities[idx], Reverse(arrivals), idx));
+            arrivals += 1;
+        }
+        let mut running = BinaryHeap::new();
+        let (mut now, mut done) = (0, 0);
+        while done < durations.len() {
+            while running.len() < slots {
+                let Some((_, _, idx)) = ready.pop() else {
+                    break;
+                };
+                running.push(Reverse((now + durations[idx], idx)));
+            }
+            let Some(&Reverse((finished_at, _))) = running.peek() else {
+                panic!("nothing can run -- the graph has a cycle");
+            };
+            now = finished_at;
+            while let Some(&Reverse((finish, idx))) = running.peek() {
+                if finish != now {
+                    break;
+                }
+                running.pop();
+                done += 1;
+                for &dependent in dependents[idx].iter() {
+                    waiting_on[dependent] -= 1;
+                    if waiting_on[dependent] == 0 {
+                        ready.push((priorities[dependent], Reverse(arrivals), dependent));
+                        arrivals += 1;
+                    }
+                }
+            }
+        }
+        now
+    }
+
+    struct Lcg(u64);
+
+    impl Lcg {
+        fn next(&mut self, bound: u64) -> u64 {
+            self.0 = self
+                .0
+                .wrapping_mul(6364136223846793005)
+                .wrapping_add(1442695040888963407);
+            (self.0 >> 33) % bound
+        }
+    }
+
+    /// Mostly short tests, with a long build every so often -- each command depends on up to two
+    /// of the ones before it
+    fn random_graph(seed: u64, len: usize) -> (Vec<u64>, Vec<Vec<usize>>) {
+        let mut rng = Lcg(seed);
+        let mut durations = vec![];
+        let mut dependents = vec![vec![]; len];
+        for idx in 0..len {
+            durations.push(if rng.next(10) == 0 {
+                200 + rng.next(400)
+            } else {
+                5 + rng.next(25)
+            });
+            let mut deps = BTreeSet::new();
+            if idx > 0 {
+                for _ in 0..rng.next(3) {
+                    deps.insert(rng.next(idx as u64) as usize);
+                }
+            }
+            for dep in deps {
+                dependents[dep].push(idx);
+            }
+        }
+        (durations, dependents)
+    }
+
+    /// Makespans of synthetic graphs, against admitting commands in the order they became ready
+    /// -- which is what the gate did before it had priorities. Run with --nocapture to see them
+    #[test]
+    fn critical_path_first_shortens_the_makespan() {
+        const SLOTS: usize = 8;
+
+        // 64 short tests that happen to be declared first, and a long build -> elab -> sim chain
+        let mut durations = vec![10; 64];
+        durations.extend([300, 200, 100]);
+        let mut dependents = vec![vec![]; durations.len()];
+        dependents[64].push(65);
+        dependents[65].push(66);
+        let in_order = makespan(&durations, &dependents, SLOTS, &vec![0; durations.len()]);
+        let critical = critical_paths(&durations, &dependents);
+        let prioritized = makespan(&durations, &dependents, SLOTS, &critical);
+        // nothing known about the commands is still enough to see the chain is longer
+        let unknown = critical_paths(&vec![DEFAULT_ESTIMATE_MS; durations.len()], &dependents);
+        let estimated = makespan(&durations, &dependents, SLOTS, &unknown);
+        println!("long chain: {in_order} in order, {prioritized} critical path first");
+        println!("long chain: {estimated} critical path first, without any history");
+        assert_eq!(in_order, 680);
+        assert_eq!(prioritized, 600);
+        assert_eq!(estimated, 600);
+
+        let (mut total_in_order, mut total_prioritized) = (0, 0);
+        for seed in 1..=8 {
+            let (durations, dependents) = random_graph(seed, 300);
+            let critical = critical_paths(&durations, &dependents);
+            let in_order = makespan(&durations, &dependents, SLOTS, &vec![0; durations.len()]);
+            let prioritized = makespan(&durations, &dependents, SLOTS, &critical);
+            let total: u64 = durations.iter().sum();
+            let lower_bound = critical
+                .iter()
+                .copied()
+                .max()
+                .unwrap()
+                .max(total.div_ceil(SLOTS as u64));
+            println!(
+                "graph {seed}: {in_order} in order, {prioritized} critical path first, {lower_bound} at best"
+            );
+            assert!(prioritized <= in_order);
+            // within 1% of the best any order could do
+            assert!(prioritized * 100 <= lower_bound * 101);
+            total_in_order += in_order;
+            total_prioritized += prioritized;
+        }
+        assert!(total_prioritized * 10 <= total_in_order * 9);
+    }
+}
@@ -0,0 +1,381 @@
+use allocative::Allocative;
+use dupe::Dupe;
+use smelt_core::{CommandDefPath, SmeltErr};
+use smelt_data::client_commands::SweepAxisDef;
+
+use std::{
+    fmt,
+    hash::{Hash, Hasher},
+    sync::Arc,
+};
+
+use crate::commands::Command;
+
+/// One parameter of a sweep -- either an explicit list of values, or the integers from `start`
+/// towards `stop` (exclusive), every `step` -- like python's `range`, `step` can be negative
+#[derive(Clone, PartialEq, Eq, Hash, Debug, Allocative)]
+pub enum SweepAxis {
+    Values {
+        name: String,
+        values: Vec<String>,
+    },
+    Range {
+        name: String,
+        start: i64,
+        stop: i64,
+        step: i64,
+    },
+}
+
+impl SweepAxis {
+    pub fn name(&self) -> &str {
+        match self {
+            SweepAxis::Values { name, .. } | SweepAxis::Range { name, .. } => name,
+        }
+    }
+
+    pub fn len(&self) -> u64 {
+        match self {
+            SweepAxis::Values { values, .. } => values.len() as u64,
+            SweepAxis::Range {
+                start, stop, step, ..
+            } => {
+                let (span, stride) = if *step > 0 {
+                    (stop - start, *step)
+                } else {
+                    (start - stop, -step)
+                };
+                if span <= 0 || stride == 0 {
+                    0
+                } else {
+                    ((span - 1) / stride + 1) as u64
+                }
+            }
+        }
+    }
+
+    fn value(&self, index: u64) -> String {
+        match self {
+            SweepAxis::Values { values, .. } => values[index as usize].clone(),
+            SweepAxis::Range { start, step, .. } => (start + step * index as i64).to_string(),
+        }
+    }
+
+    fn position(&self, value: &str) -> Option<u64> {
+        match self {
+            SweepAxis::Values { values, .. } => values
+                .iter()
+                .position(|val| val == value)
+                .map(|idx| idx as u64),
+            SweepAxis::Range { start, step, .. } => {
+                let value: i64 = value.parse().ok()?;
+                let offset = value - start;
+                if *step == 0 || offset % step != 0 || offset / step < 0 {
+                    return None;
+                }
+                let index = (offset / step) as u64;
+                (index < self.len()).then_some(index)
+            }
+        }
+    }
+}
+
+impl From<SweepAxisDef> for SweepAxis {
+    fn from(def: SweepAxisDef) -> Self {
+        let SweepAxisDef {
+            name,
+            values,
+            start,
+            stop,
+            step,
+        } = def;
+        if values.is_empty() {
+            SweepAxis::Range {
+                name,
+                start,
+                stop,
+                step,
+            }
+        } else {
+            SweepAxis::Values { name, values }
+        }
+    }
+}
+
+/// A command template that runs once for every combination of its axes
+///
+/// Instances are never stored -- `instance` builds the command for a single index when it is
+/// about to run, so a sweep costs the same to hold no matter how many instances it has.
+/// `{{axis}}` in the script, env and outputs of the template is replaced with the value of the
+/// instance; every instance shares the template's dependencies, and each output has to use every
+/// axis, so that no two instances write the same file
+#[derive(Clone, PartialEq, Eq, Hash, Debug, Allocative)]
+pub struct Sweep {
+    pub template: Command,
+    pub axes: Vec<SweepAxis>,
+    len: u64,
+}
+
+impl Sweep {
+    pub fn new(template: Command, axes: Vec<SweepAxis>) -> Result<Self, SmeltErr> {
+        let invalid = |reason: String| SmeltErr::CommandSettingFailed {
+            reason: format!("sweep {}: {}", template.name, reason),
+        };
+        if axes.is_empty() {
+            return Err(invalid("a sweep needs at least one axis".to_string()));
+        }
+        let mut len: u64 = 1;
+        for (idx, axis) in axes.iter().enumerate() {
+            if axes[..idx].iter().any(|prev| prev.name() == axis.name()) {
+                return Err(invalid(format!("axis {} is declared twice", axis.name())));
+            }
+            if let SweepAxis::Range { step: 0, .. } = axis {
+                return Err(invalid(format!("axis {} has a step of 0", axis.name())));
+            }
+            len = len
+                .checked_mul(axis.len())
+                .ok_or_else(|| invalid("too many instances".to_string()))?;
+        }
+        let deps = template
+            .dependencies
+            .iter()
+            .map(|dep| dep.get_command_name().to_string())
+            .chain(template.dependent_files.iter().map(|file| file.to_string()));
+        for dep in deps {
+            if axes
+                .iter()
+                .any(|axis| dep.contains(&placeholder(axis.name())))
+            {
+                return Err(invalid(format!(
+                    "dependency {dep} can't depend on a sweep parameter"
+                )));
+            }
+        }
+        for output in template.outputs.iter() {
+            let output = output.to_string();
+            // an axis with a single value doesn't tell instances apart, so it can be left out
+            let missing = axes
+                .iter()
+                .find(|axis| axis.len() > 1 && !output.contains(&placeholder(axis.name())));
+            if let Some(axis) = missing {
+                return Err(invalid(format!(
+                    "output {output} doesn't use {}, so instances would overwrite each other",
+                    placeholder(axis.name())
+                )));
+            }
+        }
+        Ok(Sweep {
+            template,
+            axes,
+            len,
+        })
+    }
+
+    /// Number of instances
+    pub fn len(&self) -> u64 {
+        self.len
+    }
+
+    /// Value of each axis for instance `index` -- the last axis varies fastest
+    pub fn params(&self, index: u64) -> Vec<(&str, String)> {
+        let mut rest = index;
+        let mut params: Vec<_> = self
+            .axes
+            .iter()
+            .rev()
+            .map(|axis| {
+                let axis_len = axis.len();
+                let value = axis.value(rest % axis_len);
+                rest /= axis_len;
+                (axis.name(), value)
+            })
+            .collect();
+        params.reverse();
+        params
+    }
+
+    /// `<template>[axis=value,...]`
+    pub fn instance_name(&self, index: u64) -> String {
+        let params: Vec<String> = self
+            .params(index)
+            .into_iter()
+            .map(|(name, value)| format!("{name}={value}"))
+            .collect();
+        format!("{}[{}]", self.template.name, params.join(","))
+    }
+
+    /// Inverse of `instance_name`
+    pub fn index_of(&self, instance_name: &str) -> Option<u64> {
+        let params = instance_name
+            .strip_prefix(self.template.name.as_str())?
+            .strip_prefix('[')?
+            .strip_suffix(']')?;
+        let values: Vec<&str> = params.split(',').collect();
+        if values.len() != self.axes.len() {
+            return None;
+        }
+        let mut index = 0;
+        for (axis, param) in self.axes.iter().zip(values) {
+            let value = param.strip_prefix(axis.name())?.strip_prefix('=')?;
+            index = index * axis.len() + axis.position(value)?;
+        }
+        Some(index)
+    }
+
+    pub fn instance(&self, index: u64) -> Command {
+        let params = self.params(index);
+        let fill = |text: &String| {
+            params.iter().fold(text.clone(), |text, (name, value)| {
+                text.replace(&placeholder(name), value)
+            })
+        };
+        let mut command = self.template.clone();
+        command.name = self.instance_name(index);
+        command.script = self.template.script.iter().map(&fill).collect();
+        command.outputs = self
+            .template
+            .outputs
+            .iter()
+            .map(|output| CommandDefPath::new(fill(&output.to_string())))
+            .collect();
+        for value in command.runtime.env.values_mut() {
+            *value = fill(&*value);
+        }
+        command
+    }
+}
+
+/// The sweep that `name` is an instance of, or `name` itself if it isn't an instance
+pub fn sweep_name(name: &str) -> &str {
+    match name.strip_suffix(']').and_then(|name| name.split_once('[')) {
+        Some((template, _)) => template,
+        None => name,
+    }
+}
+
+fn placeholder(name: &str) -> String {
+    format!("{{{{{name}}}}}")
+}
+
+/// Handle to a sweep that is set in the graph -- compared by identity, so the dice keys of its
+/// instances are cheap to hash
+#[derive(Clone, Dupe, Debug, Allocative)]
+pub struct SweepRef(pub Arc<Sweep>);
+
+impl fmt::Display for SweepRef {
+    fn fmt(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        write!(f, "{}", self.0.template.name)
+    }
+}
+
+impl PartialEq for SweepRef {
+    fn eq(&self, other: &Self) -> bool {
+        Arc::ptr_eq(&self.0, &other.0)
+    }
+}
+
+impl Eq for SweepRef {}
+
+impl Hash for SweepRef {
+    fn hash<H: Hasher>(&self, state: &mut H) {
+        Arc::as_ptr(&self.0).hash(state)
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn seed_sweep() -> Sweep {
+        let template: Command = serde_yaml::from_str(
+            r#"
+name: regress
+target_type: test
+script: ["./simv +seed={{seed}} +mode={{mode}}"]
+dependencies: [build]
+outputs: ["{{mode}}/{{seed}}.log"]
+runtime:
+  num_cpus: 1
+  max_memory_mb: 1024
+  timeout: 600
+  env: {}
+"#,
+        )
+        .unwrap();
+        let axes = vec![
+            SweepAxis::Values {
+                name: "mode".to_string(),
+                values: vec!["fast".to_string(), "slow".to_string()],
+            },
+            SweepAxis::Range {
+                name: "seed".to_string(),
+                start: 10,
+                stop: 20,
+                step: 3,
+            },
+        ];
+        Sweep::new(template, axes).unwrap()
+    }
+
+    #[test]
+    fn instances_are_expanded_on_demand() {
+        let sweep = seed_sweep();
+        // seeds 10, 13, 16, 19
+        assert_eq!(sweep.len(), 8);
+
+        let instance = sweep.instance(5);
+        assert_eq!(instance.name, "regress[mode=slow,seed=13]");
+        assert_eq!(instance.script, vec!["./simv +seed=13 +mode=slow"]);
+        assert_eq!(
+            instance.outputs,
+            vec![CommandDefPath::new("slow/13.log".into())]
+        );
+        assert_eq!(instance.dependencies, sweep.template.dependencies);
+
+        for index in 0..sweep.len() {
+            assert_eq!(sweep.index_of(&sweep.instance_name(index)), Some(index));
+            assert_eq!(sweep_name(&sweep.instance_name(index)), "regress");
+        }
+        assert_eq!(sweep.index_of("regress[mode=slow,seed=14]"), None);
+        assert_eq!(sweep.index_of("other[mode=slow,seed=13]"), None);
+    }
+
+    #[test]
+    fn dependencies_cant_be_swept() {
+        let mut sweep = seed_sweep();
+        sweep.template.dependencies = serde_yaml::from_str("['build_{{mode}}']").unwrap();
+        assert!(Sweep::new(sweep.template, sweep.axes).is_err());
+    }
+
+    #[test]
+    fn ranges_can_count_down() {
+        let axis = SweepAxis::Range {
+            name: "seed".to_string(),
+            start: 10,
+            stop: 0,
+            step: -4,
+        };
+        // seeds 10, 6, 2
+        assert_eq!(axis.len(), 3);
+        assert_eq!(axis.value(2), "2");
+        assert_eq!(axis.position("6"), Some(1));
+        assert_eq!(axis.position("14"), None);
+        assert_eq!(axis.position("-2"), None);
+
+        let mut sweep = seed_sweep();
+        sweep.axes[1] = SweepAxis::Range {
+            name: "seed".to_string(),
+            start: 10,
+            stop: 0,
+            step: 0,
+        };
+        assert!(Sweep::new(sweep.template, sweep.axes).is_err());
+    }
+
+    #[test]
+    fn outputs_have_to_tell_instances_apart() {
+        let mut sweep = seed_sweep();
+        sweep.template.outputs = vec![CommandDefPath::new("{{seed}}.log".into())];
+        assert!(Sweep::new(sweep.template, sweep.axes).is_err());
+    }
+}
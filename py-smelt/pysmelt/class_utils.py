@@ -1 +1,8 @@
+import sys
+from typing import Any, Dict
 
+SLOTS: Dict[str, Any] = {"slots": True} if sys.version_info >= (3, 10) else {}
+"""
+Use as `@dataclass(**SLOTS)` for classes that there is one of per command -- on python 3.10+ they are slotted, and
+don't carry a `__dict__` each
+"""
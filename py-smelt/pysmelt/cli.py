@@ -93,26 +93,48 @@ def execute(
     ),
     test_only: bool = typer.Option(
         False,
-        help="If set, assumes non-test commands have passed successfully and will not run them",
+        help="If set, non-test commands are only run if they aren't up to date in the action cache -- needs action_cache in .smeltrc",
         is_flag=True,
     ),
     jobs: Optional[int] = typer.Option(
         None, "--jobs", help="max number of jobslots allowed"
     ),
+    threaded_dispatch: bool = typer.Option(
+        False,
+        help="If set, runs the event subscribers on a worker thread, so slow output can't hold up the run",
+        is_flag=True,
+    ),
 ):
 
     if jobs:
         SmeltRcHolder.set_jobs(jobs)
 
     def configure_cb(cfg: ConfigureSmelt) -> ConfigureSmelt:
+        if test_only and not cfg.cache.action_cache:
+            raise typer.BadParameter(
+                "the action cache is off -- set action_cache in .smeltrc",
+                param_hint="'--test-only'",
+            )
         cfg.test_only = test_only
         return cfg
 
-    graph = create_graph(str(smelt_file), cfg_init=configure_cb)
+    graph = create_graph(
+        str(smelt_file),
+        cfg_init=configure_cb,
+        target_names=[target_name] if target_name else None,
+    )
+    graph.threaded_dispatch = threaded_dispatch
     if target_name:
         graph.run_one_test_interactive(target_name)
     else:
         graph.run_all_tests(tt)
+    if graph.dispatch_stats:
+        smelt_console.log(f"Event dispatch: {graph.dispatch_stats}")
+    if graph.channel_stats and graph.channel_stats["blocked_us"]:
+        smelt_console.log(
+            f"Commands waited {graph.channel_stats['blocked_us'] / 1e6:.2f}s on events to be read -- "
+            "consider setting event_overflow in .smeltrc"
+        )
     if rerun:
         graph.rerun()
 
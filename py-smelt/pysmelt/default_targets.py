@@ -1,7 +1,8 @@
 from dataclasses import dataclass, field
 from functools import partial
 from pysmelt.interfaces import Target, SmeltFilePath, SmeltTargetType, TargetRef
-from typing import Any, List, Dict
+from pysmelt.interfaces.sweep import SweepAxis
+from typing import Any, List, Dict, Optional, Union
 
 
 @dataclass
@@ -52,3 +53,60 @@ class test_group(Target):
 
     def get_dependencies(self) -> List[TargetRef]:
         return self.tests
+
+
+SweepParam = Union[List[Any], Dict[str, int], range]
+
+
+@dataclass
+class sweep(Target):
+    """
+    Runs `cmds` once for every combination of `params`
+
+    Each param is either a list of values, or a range -- `{start, stop, step}` in a testlist, or a `range` from python.
+    `{{param}}` in `cmds` and `outputs` is replaced with the value of each instance -- every output has to use each
+    param that has more than one value, so that no two instances write the same file. Instances are named
+    `<name>[param=value,...]`, e.g. `regress[seed=3]`; they are only created by the runtime as they are scheduled,
+    so a sweep with millions of instances is as cheap to load as a single target
+
+    Running the sweep by name runs every instance. Every instance shares `deps`, so they can't use a param, and other
+    targets can't depend on a sweep
+    """
+
+    cmds: List[str] = field(default_factory=list)
+    params: Dict[str, SweepParam] = field(default_factory=dict)
+    deps: List[TargetRef] = field(default_factory=list)
+    outputs: Dict[str, str] = field(default_factory=dict)
+
+    def gen_script(self) -> List[str]:
+        return self.cmds
+
+    def get_dependencies(self) -> List[TargetRef]:
+        return self.deps
+
+    def get_outputs(self) -> Dict[str, str]:
+        return self.outputs
+
+    def sweep_axes(self) -> Optional[List[SweepAxis]]:
+        axes = []
+        for name, param in self.params.items():
+            if isinstance(param, range):
+                axes.append(
+                    SweepAxis(
+                        name=name, start=param.start, stop=param.stop, step=param.step
+                    )
+                )
+            elif isinstance(param, dict):
+                axes.append(
+                    SweepAxis(
+                        name=name,
+                        start=param.get("start", 0),
+                        stop=param["stop"],
+                        step=param.get("step", 1),
+                    )
+                )
+            else:
+                axes.append(
+                    SweepAxis(name=name, values=[str(value) for value in param])
+                )
+        return axes
@@ -1,7 +1,7 @@
 from importlib.util import module_from_spec, spec_from_file_location
 from pathlib import Path
 import sys
-from typing import List
+from typing import Iterator, List, Optional
 from pysmelt.importer import import_procedural_testlist
 
 
@@ -15,6 +15,10 @@ from pysmelt.path_utils import get_git_root
 
 _import_depth = 0
 
+_declared_inputs: Optional[List[str]] = None
+
+GENERATOR_NAME = "generate_targets"
+
 
 def get_import_depth() -> int:
     return _import_depth
@@ -30,6 +34,29 @@ def dec_import_depth():
     _import_depth -= 1
 
 
+def declare_inputs(*paths: str):
+    """
+    Called from a procedural testlist, to say which files its targets are generated from -- paths are relative to the
+    testlist, unless absolute
+
+    Once a testlist has declared its inputs, its targets are cached, and it is only re-run when the script or one of
+    the inputs changes. Testlists that never call this are re-run on every load
+    """
+    global _declared_inputs
+    if _declared_inputs is None:
+        _declared_inputs = []
+    _declared_inputs.extend(paths)
+
+
+def take_declared_inputs() -> Optional[List[str]]:
+    """
+    Inputs declared since the last call -- None if `declare_inputs` wasn't called at all
+    """
+    global _declared_inputs
+    inputs, _declared_inputs = _declared_inputs, None
+    return inputs
+
+
 @contextlib.contextmanager
 def capture_targets():
     instances: List[Target] = []
@@ -50,12 +77,25 @@ def capture_targets():
     return
 
 
-def get_procedural_targets(py_path: str) -> List[Target]:
+def iter_procedural_targets(py_path: str) -> Iterator[Target]:
+    """
+    Runs a procedural testlist, and yields its targets
 
-    with capture_targets() as a:
+    Targets that the script creates as it runs are collected, and yielded first. If the script also defines a
+    `generate_targets` generator, whatever it yields is streamed straight through -- so large sweeps can be lowered
+    one target at a time, rather than all being held in memory
+    """
+    with capture_targets() as captured:
         mod = import_procedural_testlist(py_path)
 
-    return a
+    yield from captured
+    generator = getattr(mod, GENERATOR_NAME, None)
+    if generator is not None:
+        yield from generator()
+
+
+def get_procedural_targets(py_path: str) -> List[Target]:
+    return list(iter_procedural_targets(py_path))
 
 
 def init_local_rules():
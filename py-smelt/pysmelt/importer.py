@@ -1,11 +1,14 @@
 import importlib
 import inspect
-from typing import List, TypedDict, Dict, Type, Optional
+import json
+import os
+from types import ModuleType
+from typing import Any, ClassVar, Iterable, List, TypedDict, Dict, Type, Optional
 from pysmelt.interfaces import Target
 from pathlib import Path
 from pysmelt.interfaces.command import Command
 from pysmelt.interfaces.paths import TempTarget
-from pysmelt.rc import SmeltRC
+from pysmelt.rc import SmeltRC, SmeltRcHolder
 from pysmelt.path_utils import get_git_root
 import sys
 from importlib.util import spec_from_file_location, module_from_spec
@@ -36,39 +39,181 @@ def get_default_targets(cfg: SmeltRC) -> Dict[str, DocumentedTarget]:
     return _get_all_targets(None)
 
 
-def _get_all_targets(targets_dir: Optional[Path]) -> Dict[str, DocumentedTarget]:
-    default_target_modules = ["pysmelt.default_targets"]
-    classes = {}
+DEFAULT_TARGET_MODULE = "pysmelt.default_targets"
+
+RULE_INDEX_FILE = ".rule_index.json"
+
+RULE_INDEX_VERSION = 1
+
+
+def _targets_in_module(module: ModuleType) -> Dict[str, DocumentedTarget]:
     base_class_name = "Target"
+    classes: Dict[str, DocumentedTarget] = {}
+    for name, cls in inspect.getmembers(module, inspect.isclass):
+        if issubclass(cls, Target) and name != base_class_name:
+            classes[name] = {"target": cls, "doc": inspect.getdoc(cls)}
+    return classes
 
-    if targets_dir:
-        all_paths = get_all_files(targets_dir=targets_dir)
-        paths = default_target_modules + all_paths
-    else:
-        paths = default_target_modules
-
-    for path in paths:
-        try:
-
-            if isinstance(path, str):
-                module = importlib.import_module(str(path))
-            elif isinstance(path, Path):
-                module_name = path.stem  # get filename without extension
-                spec = spec_from_file_location(module_name, str(path))
-                module = module_from_spec(spec)
-                spec.loader.exec_module(module)
-
-            for name, cls in inspect.getmembers(module, inspect.isclass):
-                if issubclass(cls, Target):
-                    if name in classes:
-                        raise ValueError(f"Duplicate target name: {name}")
-                    if name != base_class_name:
-                        classes[name] = cls
-                        classes[name] = {"target": cls, "doc": inspect.getdoc(cls)}
-
-        except ImportError as e:
-            print(f"Failed to import rule definitions at {path} with error {e}")
 
+def _import_rule_file(path: Path) -> Optional[Dict[str, DocumentedTarget]]:
+    module_name = path.stem  # get filename without extension
+    spec = spec_from_file_location(module_name, str(path))
+    module = module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+    except ImportError as e:
+        print(f"Failed to import rule definitions at {path} with error {e}")
+        return None
+    return _targets_in_module(module)
+
+
+def _add_rules(
+    classes: Dict[str, DocumentedTarget], new_rules: Dict[str, DocumentedTarget]
+):
+    for name, rule in new_rules.items():
+        if name in classes:
+            raise ValueError(f"Duplicate target name: {name}")
+        classes[name] = rule
+
+
+class RuleRegistry:
+    """
+    Process wide cache of rule modules
+
+    Each rule file is executed at most once per process. `resolve` only imports the rule files that define the
+    rules a testlist asks for -- which files those are comes from an index under smelt-out, which is kept up to date
+    with the size and mtime of every rule file
+    """
+
+    _loaded: ClassVar[Dict[str, Optional[Dict[str, DocumentedTarget]]]] = {}
+    _indexes: ClassVar[Dict[str, Dict[str, Path]]] = {}
+
+    @staticmethod
+    def clear():
+        RuleRegistry._loaded = {}
+        RuleRegistry._indexes = {}
+
+    @staticmethod
+    def default_rules() -> Dict[str, DocumentedTarget]:
+        return _targets_in_module(importlib.import_module(DEFAULT_TARGET_MODULE))
+
+    @staticmethod
+    def rules_in_file(path: Path) -> Dict[str, DocumentedTarget]:
+        """
+        Rules defined in `path` -- empty if the file could not be imported
+        """
+        return RuleRegistry._load(path) or {}
+
+    @staticmethod
+    def _load(path: Path) -> Optional[Dict[str, DocumentedTarget]]:
+        key = str(path)
+        if key not in RuleRegistry._loaded:
+            RuleRegistry._loaded[key] = _import_rule_file(path)
+        return RuleRegistry._loaded[key]
+
+    @staticmethod
+    def rule_index(rules_dir: Path) -> Dict[str, Path]:
+        """
+        Maps every rule name in `rules_dir` to the file that defines it
+        """
+        key = str(rules_dir)
+        if key not in RuleRegistry._indexes:
+            RuleRegistry._indexes[key] = _load_rule_index(rules_dir)
+        return RuleRegistry._indexes[key]
+
+    @staticmethod
+    def resolve(
+        rule_names: Iterable[str], rules_dir: Optional[Path]
+    ) -> Dict[str, DocumentedTarget]:
+        """
+        The default rules, plus every rule defined in a file under `rules_dir` that defines one of `rule_names`
+        """
+        rules = RuleRegistry.default_rules()
+        if rules_dir is None:
+            return rules
+        index = RuleRegistry.rule_index(rules_dir)
+        needed = sorted({index[name] for name in rule_names if name in index})
+        for path in needed:
+            rules.update(RuleRegistry.rules_in_file(path))
+        return rules
+
+
+def _rule_index_path() -> Path:
+    return Path(SmeltRcHolder.current_smelt_root()) / "smelt-out" / RULE_INDEX_FILE
+
+
+def _read_rule_index(rules_dir: Path) -> Dict[str, Any]:
+    try:
+        on_disk = json.loads(_rule_index_path().read_text())
+    except (OSError, ValueError):
+        return {}
+    if (
+        not isinstance(on_disk, dict)
+        or on_disk.get("version") != RULE_INDEX_VERSION
+        or on_disk.get("rules_dir") != str(rules_dir)
+    ):
+        return {}
+    return on_disk.get("files", {})
+
+
+def _write_rule_index(rules_dir: Path, files: Dict[str, Any]):
+    index_path = _rule_index_path()
+    content = {
+        "version": RULE_INDEX_VERSION,
+        "rules_dir": str(rules_dir),
+        "files": files,
+    }
+    try:
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = index_path.with_name(f"{index_path.name}.{os.getpid()}")
+        tmp_path.write_text(json.dumps(content, indent=1))
+        os.replace(tmp_path, index_path)
+    except OSError:
+        # the index is best effort -- without it, we just import more rule files than we need to
+        pass
+
+
+def _load_rule_index(rules_dir: Path) -> Dict[str, Path]:
+    on_disk = _read_rule_index(rules_dir)
+    files: Dict[str, Any] = {}
+    for path in sorted(get_all_files(rules_dir)):
+        stat = path.stat()
+        entry = on_disk.get(str(path))
+        if (
+            entry is None
+            or entry["mtime_ns"] != stat.st_mtime_ns
+            or entry["size"] != stat.st_size
+        ):
+            rules = RuleRegistry._load(path)
+            if rules is None:
+                # left out of the index, so the next process tries it again
+                continue
+            entry = {
+                "mtime_ns": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "rules": sorted(rules),
+            }
+        files[str(path)] = entry
+    if files != on_disk:
+        _write_rule_index(rules_dir, files)
+
+    seen = set(RuleRegistry.default_rules())
+    by_name: Dict[str, Path] = {}
+    for path, entry in files.items():
+        for name in entry["rules"]:
+            if name in seen:
+                raise ValueError(f"Duplicate target name: {name}")
+            seen.add(name)
+            by_name[name] = Path(path)
+    return by_name
+
+
+def _get_all_targets(targets_dir: Optional[Path]) -> Dict[str, DocumentedTarget]:
+    classes: Dict[str, DocumentedTarget] = {}
+    _add_rules(classes, RuleRegistry.default_rules())
+    if targets_dir:
+        for path in get_all_files(targets_dir=targets_dir):
+            _add_rules(classes, RuleRegistry.rules_in_file(path))
     return classes
 
 
@@ -1,7 +1,10 @@
-from typing import List, Literal, Dict, Any
+from typing import List, Literal, Dict, Any, Optional, Tuple
 from enum import Enum
+import sys
+from pysmelt.class_utils import SLOTS
 from pysmelt.interfaces.paths import SmeltPath, TempTarget
 from pysmelt.interfaces.runtime import RuntimeRequirements
+from pysmelt.interfaces.sweep import SweepAxis, SweepAxisTuple
 from pysmelt.interfaces.target import SmeltTargetType, Target
 from dataclasses import dataclass, asdict
 
@@ -13,12 +16,15 @@ CommandRef = str
 CommandLiterals = Literal["test", "stimulus", "build"]
 
 
-@dataclass
+@dataclass(**SLOTS)
 class Command:
     """
     The simplest unit of compute in smelt -- commands are the nodes that are scheduled and executed by the runtime
 
     Functionally, Command is a simple wrapper around a `bash` script
+
+    Graphs can hold hundreds of thousands of commands, so commands are slotted where python allows, and the values
+    that repeat across commands (target type, working dir, script lines, environments) are interned
     """
 
     name: str
@@ -38,6 +44,17 @@ class Command:
     outputs: List[str]
     runtime: RuntimeRequirements
     working_dir: str
+    sweep: Optional[List[SweepAxis]] = None
+    """
+    Set for sweeps -- the command is a template that runs once per combination of these axes, see `sweep` in the
+    default targets
+    """
+
+    def __post_init__(self):
+        self.target_type = sys.intern(self.target_type)  # type: ignore
+        self.working_dir = sys.intern(self.working_dir)
+        self.script = [sys.intern(line) for line in self.script]
+        self.outputs = [sys.intern(output) for output in self.outputs]
 
     @classmethod
     def from_target(cls, target: Target, working_dir: str):
@@ -49,6 +66,7 @@ class Command:
         dependent_files = target.get_dependent_files()
 
         outputs = list(map(lambda path: str(path), target.get_outputs().values()))
+        sweep = target.sweep_axes()
 
         return cls(
             name=name,
@@ -59,6 +77,7 @@ class Command:
             dependent_files=dependent_files,
             outputs=outputs,
             working_dir=working_dir,
+            sweep=sweep,
         )
 
     @classmethod
@@ -76,6 +95,9 @@ class Command:
         )
 
         runtime = RuntimeRequirements.from_dict(data["runtime"])
+        sweep = (
+            [SweepAxis(**axis) for axis in data["sweep"]] if data.get("sweep") else None
+        )
 
         return cls(
             name=name,
@@ -86,13 +108,78 @@ class Command:
             outputs=outputs,
             runtime=runtime,
             working_dir=working_dir,
+            sweep=sweep,
+        )
+
+    @classmethod
+    def from_tuple(cls, flat: "CommandTuple"):
+        (
+            name,
+            target_type,
+            script,
+            dependent_files,
+            dependencies,
+            outputs,
+            (num_cpus, max_memory_mb, timeout, env),
+            working_dir,
+            sweep,
+        ) = flat
+        return cls(
+            name=name,
+            target_type=target_type,  # type: ignore
+            script=script,
+            dependent_files=dependent_files,
+            dependencies=dependencies,
+            outputs=outputs,
+            runtime=RuntimeRequirements(
+                num_cpus=num_cpus, max_memory_mb=max_memory_mb, timeout=timeout, env=env
+            ),
+            working_dir=working_dir,
+            sweep=(
+                None
+                if sweep is None
+                else [SweepAxis.from_tuple(axis) for axis in sweep]
+            ),
         )
 
     def to_dict(self) -> Dict[str, Any]:
         rv = asdict(self)
+        # a plain dict, rather than the shared one, so the result can go through any serializer
+        rv["runtime"]["env"] = dict(self.runtime.env)
 
         return rv
 
+    def to_tuple(self) -> "CommandTuple":
+        """
+        Flat form of the command that `PyController.set_graph_structured` takes -- much cheaper to build and hand to
+        rust than `to_dict` and a yaml dump
+        """
+        runtime = self.runtime
+        return (
+            self.name,
+            self.target_type,
+            self.script,
+            self.dependent_files,
+            self.dependencies,
+            self.outputs,
+            (runtime.num_cpus, runtime.max_memory_mb, runtime.timeout, runtime.env),
+            self.working_dir,
+            None if self.sweep is None else [axis.to_tuple() for axis in self.sweep],
+        )
+
+
+CommandTuple = Tuple[
+    str,
+    str,
+    List[str],
+    List[str],
+    List[CommandRef],
+    List[str],
+    Tuple[int, int, int, Dict[str, str]],
+    str,
+    Optional[List[SweepAxisTuple]],
+]
+
 
 class CStatus(Enum):
     PASS = "pass"
@@ -1,8 +1,51 @@
 from dataclasses import dataclass
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
 
+from pysmelt.class_utils import SLOTS
 
-@dataclass
+MAX_SHARED_ENVS = 4096
+
+
+class _SharedEnv(Dict[str, str]):
+    """
+    An environment that commands share -- still a dict, so it goes to rust and through pickle like any other, but one
+    that can't be changed in place, since that would change it under every other command
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError(
+            "Command environments are shared between commands, so they can't be changed in place -- assign a new dict"
+        )
+
+    __setitem__ = __delitem__ = __ior__ = _read_only  # type: ignore
+    clear = pop = popitem = setdefault = update = _read_only  # type: ignore
+
+    def __reduce__(self):
+        return (shared_env, (dict(self),))
+
+
+_shared_envs: Dict[Tuple[Tuple[str, str], ...], _SharedEnv] = {}
+
+
+def shared_env(env: Dict[str, str]) -> Dict[str, str]:
+    """
+    Returns a read only dict equal to `env`, that every command with the same environment shares
+
+    Only the first `MAX_SHARED_ENVS` distinct environments are shared, so per-command environments can't grow the table
+    without bound -- past that, commands get their own copy
+    """
+    key = tuple(sorted(env.items()))
+    shared = _shared_envs.get(key)
+    if shared is not None:
+        return shared
+    if len(_shared_envs) >= MAX_SHARED_ENVS:
+        return dict(env)
+    # a copy, so whoever handed us `env` can't change it under every other command
+    shared = _shared_envs[key] = _SharedEnv(env)
+    return shared
+
+
+@dataclass(**SLOTS)
 class RuntimeRequirements:
     num_cpus: int
     # This number is in MB
@@ -12,6 +55,9 @@ class RuntimeRequirements:
     # working_directory
     env: Dict[str, str]
 
+    def __post_init__(self):
+        self.env = shared_env(self.env)
+
     @classmethod
     def default(cls, env: Optional[Dict[str, str]] = None):
         if env is None:
@@ -0,0 +1,49 @@
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from pysmelt.class_utils import SLOTS
+
+SweepAxisTuple = Tuple[str, List[str], int, int, int]
+
+
+@dataclass(**SLOTS)
+class SweepAxis:
+    """
+    One parameter of a sweep -- either an explicit list of `values`, or the integers in `range(start, stop, step)`,
+    so `step` can be negative but not 0
+    """
+
+    name: str
+    values: Optional[List[str]] = None
+    start: int = 0
+    stop: int = 0
+    step: int = 1
+
+    def __post_init__(self):
+        if self.values is None and self.step == 0:
+            raise ValueError(f"sweep param {self.name} has a step of 0")
+
+    def __len__(self) -> int:
+        if self.values is not None:
+            return len(self.values)
+        return len(range(self.start, self.stop, self.step))
+
+    def to_tuple(self) -> SweepAxisTuple:
+        return (self.name, self.values or [], self.start, self.stop, self.step)
+
+    @classmethod
+    def from_tuple(cls, flat: SweepAxisTuple) -> "SweepAxis":
+        name, values, start, stop, step = flat
+        if values:
+            return cls(name=name, values=values)
+        return cls(name=name, start=start, stop=stop, step=step)
+
+
+def sweep_name(name: str) -> str:
+    """
+    The sweep that `name` is an instance of, e.g. "regress" for "regress[seed=2]", or `name` itself if it isn't an
+    instance -- the same as `sweep_name` in smelt-graph
+    """
+    if name.endswith("]") and "[" in name:
+        return name[: name.index("[")]
+    return name
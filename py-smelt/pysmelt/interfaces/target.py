@@ -2,8 +2,9 @@ from dataclasses import dataclass, field, asdict
 from abc import ABC
 from enum import Enum
 from functools import partial
-from typing import Any, List, Dict, Literal
+from typing import Any, List, Dict, Literal, Optional
 from pysmelt.interfaces.runtime import RuntimeRequirements
+from pysmelt.interfaces.sweep import SweepAxis
 from pysmelt.interfaces.paths import SmeltFilePath
 from pysmelt.rc import SmeltRcHolder
 
@@ -55,6 +56,12 @@ class Target(ABC):
     def runtime_requirements(self) -> RuntimeRequirements:
         return RuntimeRequirements.default(self.runtime_env_vars())
 
+    def sweep_axes(self) -> Optional[List[SweepAxis]]:
+        """
+        Axes of the sweep this target expands to -- None for targets that run a single command
+        """
+        return None
+
     def get_dependencies(self) -> List[TargetRef]:
         """
         Returns the targets that this target depends on
@@ -24,6 +24,8 @@ class Digest(betterproto.Message):
 class ArtifactPointer(betterproto.Message):
     path: str = betterproto.string_field(1, group="pointer")
     artifact_name: str = betterproto.string_field(3)
+    # Digest of the file's contents, if it was ingested in to smelt-out/.cas
+    cas_hash: "Digest" = betterproto.message_field(4)
 
 
 @dataclass
@@ -44,6 +46,87 @@ class TestOutputs(betterproto.Message):
     artifacts: List["ArtifactPointer"] = betterproto.message_field(1)
     # exit code of the test
     exit_code: int = betterproto.int32_field(2)
+    # Digest of the exit code and the contents of every output -- only set for
+    # commands that go through the action cache, and what the action digests of
+    # their dependents are built from
+    result_digest: "Digest" = betterproto.message_field(3)
+
+
+@dataclass
+class ActionResult(betterproto.Message):
+    """
+    What the action cache holds for a command that succeeded, keyed by its
+    action digest
+    """
+
+    exit_code: int = betterproto.int32_field(1)
+    output_files: List["OutputFile"] = betterproto.message_field(2)
+    # the command's log
+    stdout_digest: "Digest" = betterproto.message_field(3)
+
+
+@dataclass
+class OutputFile(betterproto.Message):
+    # as the command declares it
+    path: str = betterproto.string_field(1)
+    digest: "Digest" = betterproto.message_field(2)
+    # blobs hold contents only, so the mode of the output is restored from here
+    is_executable: bool = betterproto.bool_field(3)
+
+
+@dataclass
+class FileState(betterproto.Message):
+    """
+    What smelt-out/.file_index remembers about a file, so that unchanged files
+    are never re-read
+    """
+
+    path: str = betterproto.string_field(1)
+    size_bytes: int = betterproto.uint64_field(2)
+    mtime_ns: int = betterproto.int64_field(3)
+    inode: int = betterproto.uint64_field(4)
+    digest: "Digest" = betterproto.message_field(5)
+    # when the digest was taken -- files modified too close to this can't be
+    # trusted
+    hashed_ns: int = betterproto.int64_field(6)
+
+
+@dataclass
+class FileStates(betterproto.Message):
+    files: List["FileState"] = betterproto.message_field(1)
+
+
+@dataclass
+class CasEntry(betterproto.Message):
+    """
+    A blob in smelt-out/.cas, and when it was last ingested or materialized
+    """
+
+    hash: str = betterproto.string_field(1)
+    size_bytes: int = betterproto.int64_field(2)
+    last_used_ns: int = betterproto.int64_field(3)
+
+
+@dataclass
+class CasEntries(betterproto.Message):
+    blobs: List["CasEntry"] = betterproto.message_field(1)
+
+
+@dataclass
+class CommandDuration(betterproto.Message):
+    """
+    How long a command usually runs for, in smelt-out/.durations -- used to start
+    the commands on the critical path first
+    """
+
+    name: str = betterproto.string_field(1)
+    # moving average over the invocations that ran the command
+    estimate_ms: int = betterproto.uint64_field(2)
+
+
+@dataclass
+class CommandDurations(betterproto.Message):
+    commands: List["CommandDuration"] = betterproto.message_field(1)
 
 
 @dataclass
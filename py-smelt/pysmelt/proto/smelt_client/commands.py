@@ -13,6 +13,16 @@ class ProfilingSelection(betterproto.Enum):
     SIMPLE_PROF = 1
 
 
+class OverflowPolicy(betterproto.Enum):
+    # running commands wait until the client catches up
+    BLOCK = 0
+    # stdout that doesn't fit is dropped, every other event waits
+    DROP_STDOUT = 1
+    # events that don't fit are written under smelt-out/events, and are read back
+    # once the client catches up
+    SPILL = 2
+
+
 @dataclass
 class ClientCommand(betterproto.Message):
     setter: "SetCommands" = betterproto.message_field(1, group="ClientCommands")
@@ -20,6 +30,24 @@ class ClientCommand(betterproto.Message):
     runtype: "RunType" = betterproto.message_field(3, group="ClientCommands")
     runmany: "RunMany" = betterproto.message_field(4, group="ClientCommands")
     getcfg: "GetConfig" = betterproto.message_field(5, group="ClientCommands")
+    setdefs: "SetCommandDefs" = betterproto.message_field(7, group="ClientCommands")
+    update: "UpdateCommands" = betterproto.message_field(8, group="ClientCommands")
+    # Only used by the run commands -- if unset, every event is streamed back
+    subscription: "EventSubscription" = betterproto.message_field(6)
+
+
+@dataclass
+class EventSubscription(betterproto.Message):
+    """
+    Narrows down which events get streamed back to the client Events that
+    aren't subscribed to are dropped by the graph server, before they are ever
+    sent to the client. Invoke events and errors are always sent
+    """
+
+    # CommandVariants to send, by name e.g. "finished", "stdout"
+    command_variants: List[str] = betterproto.string_field(1)
+    # If non-empty, stdout is only sent for the commands named here
+    stdout_commands: List[str] = betterproto.string_field(2)
 
 
 @dataclass
@@ -27,6 +55,78 @@ class SetCommands(betterproto.Message):
     command_content: str = betterproto.string_field(1)
 
 
+@dataclass
+class SetCommandDefs(betterproto.Message):
+    """
+    Same as SetCommands, but the commands arrive already structured -- nothing
+    has to be parsed
+    """
+
+    commands: List["CommandDef"] = betterproto.message_field(1)
+
+
+@dataclass
+class CommandDef(betterproto.Message):
+    """Mirrors the Command that smelt-graph executes"""
+
+    name: str = betterproto.string_field(1)
+    # "test", "stimulus" or "build"
+    target_type: str = betterproto.string_field(2)
+    script: List[str] = betterproto.string_field(3)
+    dependent_files: List[str] = betterproto.string_field(4)
+    dependencies: List[str] = betterproto.string_field(5)
+    outputs: List[str] = betterproto.string_field(6)
+    runtime: "CommandRuntime" = betterproto.message_field(7)
+    working_dir: str = betterproto.string_field(8)
+    # If set, this command is a template that is run once for every combination
+    # of the axes -- instances are only expanded by the graph as they run
+    sweep: "SweepDef" = betterproto.message_field(9)
+
+
+@dataclass
+class SweepDef(betterproto.Message):
+    axes: List["SweepAxisDef"] = betterproto.message_field(1)
+
+
+@dataclass
+class SweepAxisDef(betterproto.Message):
+    """Either values, or the integers in [start, stop) every step"""
+
+    name: str = betterproto.string_field(1)
+    values: List[str] = betterproto.string_field(2)
+    start: int = betterproto.int64_field(3)
+    stop: int = betterproto.int64_field(4)
+    # 1 if unset
+    step: int = betterproto.int64_field(5)
+
+
+@dataclass
+class UpdateCommands(betterproto.Message):
+    """
+    Changes some of the commands that are already set, leaving the rest of the
+    graph as it is Every name in replace and remove must already be set, and
+    every name in add must not be (unless it is removed in the same update)
+    """
+
+    add: List["CommandDef"] = betterproto.message_field(1)
+    # swapped in for the command that has the same name
+    replace: List["CommandDef"] = betterproto.message_field(2)
+    # names of the commands to drop
+    remove: List[str] = betterproto.string_field(3)
+
+
+@dataclass
+class CommandRuntime(betterproto.Message):
+    num_cpus: int = betterproto.uint32_field(1)
+    max_memory_mb: int = betterproto.uint32_field(2)
+    timeout: int = betterproto.uint32_field(3)
+    env: Dict[str, str] = betterproto.map_field(
+        4, betterproto.TYPE_STRING, betterproto.TYPE_STRING
+    )
+    # empty if the command runs in its default directory
+    command_run_dir: str = betterproto.string_field(5)
+
+
 @dataclass
 class RunOne(betterproto.Message):
     command_name: str = betterproto.string_field(1)
@@ -73,10 +173,38 @@ class ConfigureSmelt(betterproto.Message):
     prof_cfg: "ProfilerCfg" = betterproto.message_field(3)
     # If true, we ignore the non test commands
     test_only: bool = betterproto.bool_field(4)
+    # configures how command stdout is sent to clients
+    stdout_cfg: "StdoutCfg" = betterproto.message_field(5)
+    # configures the channel that carries events back to clients
+    event_buffer: "EventBufferCfg" = betterproto.message_field(6)
+    # configures how results are reused across invocations
+    cache: "CacheCfg" = betterproto.message_field(7)
+    # Memory the commands that run at once can reserve between them, with their
+    # max_memory_mb -- zero means memory isn't budgeted
+    memory_budget_mb: int = betterproto.uint64_field(8)
+    # If true, commands are killed when they run past their timeout, or use more
+    # than their max_memory_mb
+    enforce_limits: bool = betterproto.bool_field(9)
     local: "CfgLocal" = betterproto.message_field(10, group="InitExecutor")
     docker: "CfgDocker" = betterproto.message_field(11, group="InitExecutor")
 
 
+@dataclass
+class CacheCfg(betterproto.Message):
+    # If true, non-test commands that are up to date are restored from smelt-
+    # out/.action_cache rather than run, and the outputs of every command are
+    # ingested in to smelt-out/.cas
+    action_cache: bool = betterproto.bool_field(1)
+    # Size budget of smelt-out/.cas, in bytes -- the blobs used least recently
+    # are evicted past it. Zero means there's no budget
+    cas_max_bytes: int = betterproto.uint64_field(2)
+    # REAPI cache that results and blobs are looked up in and uploaded to, e.g.
+    # http://cache.internal:9092 -- no remote cache if empty
+    remote_url: str = betterproto.string_field(3)
+    # Instance name sent with every remote request
+    remote_instance_name: str = betterproto.string_field(4)
+
+
 @dataclass
 class ProfilerCfg(betterproto.Message):
     # if we enable simple profiling
@@ -84,6 +212,27 @@ class ProfilerCfg(betterproto.Message):
     sampling_period: int = betterproto.uint64_field(2)
 
 
+@dataclass
+class StdoutCfg(betterproto.Message):
+    # If non zero, stdout lines are coalesced in to chunks of roughly this many
+    # bytes, and each chunk is sent as a single event. If zero, every line is
+    # sent as its own event
+    chunk_bytes: int = betterproto.uint64_field(1)
+    # Longest a partial chunk is held before it is sent, in milliseconds
+    flush_ms: int = betterproto.uint64_field(2)
+    # If non zero, at most this many bytes of stdout are sent per command --
+    # the full output is always written to the command's log
+    max_forwarded_bytes: int = betterproto.uint64_field(3)
+
+
+@dataclass
+class EventBufferCfg(betterproto.Message):
+    # Number of events that can be waiting on the client -- 100 if zero
+    capacity: int = betterproto.uint64_field(1)
+    # What happens once the client has fallen that far behind
+    overflow: "OverflowPolicy" = betterproto.enum_field(2)
+
+
 @dataclass
 class CfgLocal(betterproto.Message):
     pass
@@ -18,6 +18,11 @@ class SmeltErrorType(betterproto.Enum):
     INTERNAL_WARN = 2
 
 
+class KillReason(betterproto.Enum):
+    TIMED_OUT = 0
+    OUT_OF_MEMORY = 1
+
+
 @dataclass
 class Event(betterproto.Message):
     """Event flows from server -> client only"""
@@ -43,6 +48,7 @@ class CommandEvent(betterproto.Message):
     stdout: "CommandStdout" = betterproto.message_field(8, group="CommandVariant")
     profile: "CommandProfile" = betterproto.message_field(9, group="CommandVariant")
     skipped: "CommandSkipped" = betterproto.message_field(10, group="CommandVariant")
+    killed: "CommandKilled" = betterproto.message_field(11, group="CommandVariant")
 
 
 @dataclass
@@ -65,14 +71,34 @@ class CommandSkipped(betterproto.Message):
     pass
 
 
+@dataclass
+class CommandKilled(betterproto.Message):
+    """
+    Sent when a command is killed for going over one of its limits -- the
+    command still finishes, with the exit code for `reason`
+    """
+
+    reason: "KillReason" = betterproto.enum_field(1)
+    # The limit that was exceeded -- seconds for a timeout, MB for memory
+    limit: int = betterproto.uint64_field(2)
+
+
 @dataclass
 class CommandStdout(betterproto.Message):
+    # One or more lines of output -- multiple lines are separated by newlines
     output: str = betterproto.string_field(1)
+    # Bytes of output that were written to the command's log, but never sent
+    # because the command went over its forwarding limit. Only set on the last
+    # stdout event of a command
+    dropped_bytes: int = betterproto.uint64_field(2)
 
 
 @dataclass
 class CommandFinished(betterproto.Message):
     outputs: executed_tests.TestOutputs = betterproto.message_field(1)
+    # true if the command was up to date, and its outputs were restored from
+    # the action cache rather than running it
+    cached: bool = betterproto.bool_field(2)
 
 
 @dataclass
@@ -1,4 +1,15 @@
-from typing import Callable, Dict, Generator, List, Optional, Tuple, cast
+from typing import (
+    AsyncIterator,
+    Callable,
+    Dict,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    cast,
+)
 
 from dataclasses import replace
 import betterproto
@@ -10,32 +21,80 @@ from pysmelt.path_utils import relatavize_inp_path
 from pysmelt.pysmelt import PyController, PyEventStream
 from pysmelt.rc import SmeltRcHolder
 from pysmelt.rerun import DerivedTarget, RerunCallback
-from pysmelt.subscribers import SmeltSub
-import yaml
+from pysmelt.target_index import create_target_universe
+from pysmelt.subscribers import (
+    ClassifiedEvent,
+    EventDispatcher,
+    SmeltSub,
+    classify_native,
+)
 import time
+import asyncio
+import os
+from contextlib import contextmanager
+from functools import partial
 
 
 
 from pysmelt.proto.smelt_telemetry import Event
-from pysmelt.proto.smelt_client.commands import CfgDocker, CfgLocal, ConfigureSmelt
+from pysmelt.proto.smelt_client.commands import (
+    CacheCfg,
+    CfgDocker,
+    CfgLocal,
+    ConfigureSmelt,
+    EventBufferCfg,
+    EventSubscription,
+    OverflowPolicy,
+    StdoutCfg,
+)
 
 
 from pysmelt.subscribers.error_handler import SmeltErrorHandler
 from pysmelt.subscribers.invocation_builder import InvocationBuilder
-from pysmelt.subscribers.output_collector import OutputConsole
+from pysmelt.subscribers.output_collector import console_for_output
 from pysmelt.subscribers.retcode import RetcodeTracker
 
 
 from pysmelt.subscribers.stdout import StdoutPrinter, StdoutSink
+from pysmelt.subscribers.threaded import DispatchStats, ThreadedDispatcher
 
 
 
+def host_memory_mb() -> int:
+    """
+    Physical memory of this machine, or 0 if it can't be found
+    """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return 0
+
+
 def default_cfg() -> ConfigureSmelt:
     rv = ConfigureSmelt()
     rc = SmeltRcHolder.current_rc()
 
     rv.job_slots = rc.jobs
     rv.smelt_root = rc.smelt_root
+    rv.stdout_cfg = StdoutCfg(
+        chunk_bytes=rc.stdout_chunk_bytes,
+        flush_ms=rc.stdout_flush_ms,
+        max_forwarded_bytes=rc.stdout_max_forwarded_bytes,
+    )
+    rv.event_buffer = EventBufferCfg(
+        capacity=rc.event_buffer_capacity,
+        overflow=OverflowPolicy[rc.event_overflow.upper()],
+    )
+    rv.cache = CacheCfg(
+        action_cache=rc.action_cache,
+        cas_max_bytes=rc.cas_max_mb * 1024 * 1024,
+        remote_url=rc.remote_cache or "",
+        remote_instance_name=rc.remote_instance_name,
+    )
+    rv.memory_budget_mb = (
+        host_memory_mb() if rc.memory_budget_mb is None else rc.memory_budget_mb
+    )
+    rv.enforce_limits = rc.enforce_limits
     rv.local = CfgLocal()
     return rv
 
@@ -82,6 +141,59 @@ def maybe_get_message(
         return None
 
 
+EVENT_BATCH_SIZE = 1024
+"""
+Maximum number of events we pull across the rust boundary in a single call
+"""
+
+EVENT_WAIT_MS = 100
+"""
+How long we wait for new events before handing control back to the runloop
+"""
+
+
+def drain_messages(
+    listener: PyEventStream,
+    max_events: int = EVENT_BATCH_SIZE,
+    timeout_ms: int = EVENT_WAIT_MS,
+) -> List[Event]:
+    """
+    Returns every event that is ready, waiting up to `timeout_ms` for the first one to arrive
+
+    The wait happens in rust with the GIL released, so draining is driven by events arriving rather than a polling timer
+    """
+    return [
+        Event.FromString(message)
+        for message in listener.pop_batch(max_events, timeout_ms)
+    ]
+
+
+StartInvocation = Callable[[Optional[bytes]], PyEventStream]
+"""
+Starts an invocation on the controller, given a serialized `EventSubscription` (or None, for every event)
+"""
+
+
+def serialize_subscription(
+    subscription: Optional[EventSubscription],
+) -> Optional[bytes]:
+    return bytes(subscription) if subscription is not None else None
+
+
+def drain_events(
+    listener: PyEventStream,
+    max_events: int = EVENT_BATCH_SIZE,
+    timeout_ms: int = EVENT_WAIT_MS,
+) -> List[ClassifiedEvent]:
+    """
+    Same as `drain_messages`, but the events come across from rust as plain tuples -- nothing is encoded or decoded
+    """
+    return [
+        classify_native(native)
+        for native in listener.pop_batch_native(max_events, timeout_ms)
+    ]
+
+
 def spin_for_message(
     listener: PyEventStream, backoff: float = 0.2, time_out: int = 10):
     """
@@ -115,28 +227,61 @@ class PyGraph:
 
     additional_listeners: List[SmeltSub]
 
-    def runloop(self, listener: PyEventStream):
+    threaded_dispatch: bool = False
+    """
+    If true, `runloop` hands events to the subscribers on a worker thread -- so a slow subscriber can't hold up draining
+    events from rust, and with it the commands that are executing
+    """
+
+    dispatch_stats: Optional[DispatchStats] = None
+    """
+    Queue depth and dropped/late event counts from the most recent threaded `runloop`
+    """
+
+    channel_stats: Optional[Dict[str, int]] = None
+    """
+    Counters for the rust -> python event channel from the most recent `runloop` -- `blocked_us` is how long
+    executing commands waited on python to drain events
+    """
+
+    @contextmanager
+    def dispatching(
+        self, dispatcher: EventDispatcher
+    ) -> Iterator[Callable[[ClassifiedEvent], None]]:
+        """
+        Yields the function that hands each drained event to the subscribers, based on `threaded_dispatch`
+        """
+        if not self.threaded_dispatch:
+            yield dispatcher.dispatch_classified
+            return
+        threaded = ThreadedDispatcher(dispatcher)
+        self.dispatch_stats = threaded.stats
+        with threaded:
+            yield threaded.dispatch_classified
+
+    def dispatcher_for(self, *subscribers: SmeltSub) -> EventDispatcher:
+        """
+        Dispatcher for one invocation -- the retcode tracker goes first, then `subscribers`, then any additional listeners
+        """
+        return EventDispatcher(
+            [self.retcode_tracker, *subscribers, *self.additional_listeners]
+        )
+
+    def runloop(self, start: StartInvocation):
         errhandler = SmeltErrorHandler()
         invbuilder = InvocationBuilder()
-        with OutputConsole() as console:
-            while not listener.is_done():
-                # tbh, this could be async
-                # but async interopt with rust is kind of experimental and i dont want to do it yet
-                message = maybe_get_message(listener, blocking=False)
-                if message:
-                    self.retcode_tracker.process_message(message)
-                    console.process_message(message)
-                    errhandler.process_message(message)
-                    invbuilder.process_message(message)
-                    for other_listener in self.additional_listeners:
-                        other_listener.process_message(message)
-                if not message:
-                    # add a little bit of backoff
-                    time.sleep(0.01)
+        with console_for_output() as console:
+            dispatcher = self.dispatcher_for(console, errhandler, invbuilder)
+            listener = start(serialize_subscription(dispatcher.subscription()))
+            with self.dispatching(dispatcher) as dispatch:
+                while not listener.is_done():
+                    for event in drain_events(listener):
+                        dispatch(event)
+            self.channel_stats = listener.channel_stats()
         invbuilder.write_invocation_to_fs()
 
     def console_runloop(
-            self, test_name: str, listener: PyEventStream, sink: StdoutSink
+            self, test_name: str, start: StartInvocation, sink: StdoutSink
     ) -> Generator[bool, None, None]:
         """
         Generator that will try to consume as many `Event` messages as possible
@@ -144,24 +289,65 @@ class PyGraph:
         All of the stdout from the "test_name" command will be given to the `sink`.
         By default, sink should just be print
 
-        The yielded value will be
+        After each batch of events, the yielded value will be true if the invocation is done
         """
         stdout_tracker = StdoutPrinter(test_name, sink)
         errhandler = SmeltErrorHandler()
+        dispatcher = self.dispatcher_for(stdout_tracker, errhandler)
+        subscription = dispatcher.subscription(stdout_commands=[test_name])
+        listener = start(serialize_subscription(subscription))
         while True:
-            # tbh, this could be async
-            # but async interopt with rust is kind of experimental and i dont want to do it yet
-            message = maybe_get_message(listener, blocking=False)
-            if message:
-                self.retcode_tracker.process_message(message)
-                stdout_tracker.process_message(message)
-                errhandler.process_message(message)
-                for other_listener in self.additional_listeners:
-                        other_listener.process_message(message)
-
-            if not message:
-                # add a little bit of backoff
-                yield listener.is_done()
+            for event in drain_events(listener):
+                dispatcher.dispatch_classified(event)
+
+            yield listener.is_done()
+
+    async def aevent_loop(self, listener: PyEventStream) -> AsyncIterator[Event]:
+        """
+        Async generator that yields every `Event` from `listener`, without ever blocking the event loop
+
+        Rust writes to a socket whenever an event is ready, and that socket is registered with the running
+        event loop -- so we only wake up when there is something to read
+        """
+        loop = asyncio.get_running_loop()
+        fd = listener.wakeup_fd()
+        woken = asyncio.Event()
+        closed = False
+
+        def on_wakeup():
+            nonlocal closed
+            try:
+                if not os.read(fd, 4096):
+                    # EOF -- rust has closed the event stream
+                    closed = True
+                    loop.remove_reader(fd)
+            except BlockingIOError:
+                pass
+            woken.set()
+
+        loop.add_reader(fd, on_wakeup)
+        errhandler = SmeltErrorHandler()
+        invbuilder = InvocationBuilder()
+        dispatcher = self.dispatcher_for(errhandler, invbuilder)
+        try:
+            while not listener.is_done():
+                woken.clear()
+                events = drain_events(listener, timeout_ms=0)
+                if not events:
+                    if closed:
+                        break
+                    await woken.wait()
+                    continue
+
+                for event in events:
+                    dispatcher.dispatch_classified(event)
+                    yield event.event
+                # let everything else on the loop breathe between batches
+                await asyncio.sleep(0)
+        finally:
+            loop.remove_reader(fd)
+        invbuilder.write_invocation_to_fs()
+
     def get_current_cfg(self) -> ConfigureSmelt:
         raw_cfg = self.controller.get_current_cfg() 
         return ConfigureSmelt.FromString(raw_cfg)
@@ -178,26 +364,48 @@ class PyGraph:
         By default, this will just print stdout + stderr to the screen -- it looks like you're running the command interactively 
         """
         self.reset()
-        listener = self.controller.run_one_test(name)
-        for is_done in self.console_runloop(name, listener, sink):
+        start = partial(self.controller.run_one_test, name)
+        for is_done in self.console_runloop(name, start, sink):
             if is_done:
                 return
-            time.sleep(0.1)
 
     def run_specific_commands(self, commands: List[Command]):
         self.reset()
         test_names = [command.name for command in commands]
-        listener = self.controller.run_many_tests(test_names)
-        self.runloop(listener)
+        self.runloop(partial(self.controller.run_many_tests, test_names))
 
     def run_all_tests(self, maybe_type: str):
         self.reset()
-        listener = self.controller.run_all_tests(maybe_type)
-        self.runloop(listener)
+        self.runloop(partial(self.controller.run_all_tests, maybe_type))
         
 
     
 
+    def arun_all_tests(self, maybe_type: str) -> AsyncIterator[Event]:
+        """
+        Asyncio flavour of `run_all_tests` -- use as `async for event in graph.arun_all_tests("test")`
+        """
+        self.reset()
+        listener = self.controller.run_all_tests(maybe_type)
+        return self.aevent_loop(listener)
+
+    def arun_specific_commands(self, commands: List[Command]) -> AsyncIterator[Event]:
+        """
+        Asyncio flavour of `run_specific_commands`
+        """
+        self.reset()
+        test_names = [command.name for command in commands]
+        listener = self.controller.run_many_tests(test_names)
+        return self.aevent_loop(listener)
+
+    def arun_one_test(self, name: str) -> AsyncIterator[Event]:
+        """
+        Asyncio flavour of running a single test -- stdout is available in the yielded events
+        """
+        self.reset()
+        listener = self.controller.run_one_test(name)
+        return self.aevent_loop(listener)
+
     def rerun(
         self,
         rerun_callback: RerunCallback = default_target_rerun_callback,
@@ -206,12 +414,41 @@ class PyGraph:
 
     def set_commands(self):
         commands = self.universe.all_commands
-        
-        
-        
+        self.controller.set_graph_structured([command.to_tuple() for command in commands])
+        if SmeltRcHolder.current_rc().release_universe:
+            self.release_universe()
+
+    def release_universe(self):
+        """
+        Drops the python side copy of the commands -- rust holds everything it needs to run them
+
+        The universe is replaced rather than emptied, so anyone else holding it keeps their commands; anything that
+        needs the commands afterwards, e.g. `set_commands`, raises rather than silently seeing an empty graph
+        """
+        self.universe = SmeltUniverse(
+            top_file=self.universe.top_file, commands={}, released=True
+        )
+
+    def update_commands(
+        self,
+        add: Sequence[Command] = (),
+        replace: Sequence[Command] = (),
+        remove: Sequence[str] = (),
+        file: Optional[SmeltPath] = None,
+    ):
+        """
+        Adds, replaces (by name) and removes (by name) commands, without re-sending the rest of the graph
 
-        commands_as_str = yaml.safe_dump([command.to_dict() for command in commands])
-        self.controller.set_graph(commands_as_str)
+        Only the commands that changed, and whatever depends on them, are invalidated and re-validated -- handy for long
+        lived sessions where a few targets change at a time. Added commands are filed under `file` in the universe, the
+        top file by default. If the update would leave a dependency dangling, nothing is changed
+        """
+        self.controller.update_graph(
+            [command.to_tuple() for command in add],
+            [command.to_tuple() for command in replace],
+            list(remove),
+        )
+        self.universe.apply_update(add, replace, remove, file or self.universe.top_file)
         
 
     @classmethod
@@ -238,11 +475,22 @@ def _create_cfg(smelt_test_list: str) -> ConfigureSmelt:
     return cfg
 
 
-def create_graph(smelt_test_list: str, cfg_init: Optional[Callable[[ConfigureSmelt],ConfigureSmelt]] = None) -> PyGraph:
+def create_graph(
+    smelt_test_list: str,
+    cfg_init: Optional[Callable[[ConfigureSmelt], ConfigureSmelt]] = None,
+    target_names: Optional[Sequence[str]] = None,
+) -> PyGraph:
+    """
+    If `target_names` are given, the graph only holds them and what they depend on -- testlists they don't reference
+    are never loaded
+    """
     cfg = _create_cfg(smelt_test_list)
     if cfg_init:
         cfg = cfg_init(cfg)
-    universe = create_universe(SmeltPath.from_str(smelt_test_list))
+    if target_names:
+        universe = create_target_universe(SmeltPath.from_str(smelt_test_list), target_names)
+    else:
+        universe = create_universe(SmeltPath.from_str(smelt_test_list))
     rv = PyGraph.init(cfg, universe)
     return rv
 
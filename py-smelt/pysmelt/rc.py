@@ -1,5 +1,5 @@
 from pydantic.dataclasses import dataclass
-from typing import ClassVar, Dict, Optional, Union
+from typing import ClassVar, Dict, Literal, Optional, Union
 from pathlib import Path
 from pysmelt.path_utils import get_git_root
 import toml
@@ -27,6 +27,85 @@ class SmeltRC:
     Number of job slots that can be used
     """
 
+    stdout_chunk_bytes: int = 0
+    """
+    If non-zero, command stdout is sent back in chunks of roughly this many bytes, rather than a line at a time
+    """
+
+    stdout_flush_ms: int = 100
+    """
+    Longest a partial stdout chunk is held before it is sent back
+    """
+
+    stdout_max_forwarded_bytes: int = 0
+    """
+    If non-zero, at most this many bytes of stdout are sent back per command -- the command log always has everything
+    """
+
+    event_buffer_capacity: int = 100
+    """
+    Number of events that can be waiting to be read by python before `event_overflow` kicks in
+    """
+
+    event_overflow: Literal["block", "drop_stdout", "spill"] = "block"
+    """
+    What happens when python falls behind -- running commands either wait, drop their stdout, or spill events to
+    smelt-out/events until python catches up
+    """
+
+    testlist_cache: bool = True
+    """
+    If true, lowered testlists are cached under smelt-out/.testlist_cache, and unchanged testlists aren't re-parsed
+    """
+
+    release_universe: bool = False
+    """
+    If true, the python copy of every command is dropped once the commands have been handed to the graph -- saves a lot
+    of memory on huge graphs, but `PyGraph.universe` has no commands afterwards, and the graph can't be set again
+    """
+
+    action_cache: bool = False
+    """
+    If true, build and stimulus commands that are up to date -- same definition, environment, dependent files and
+    dependency outputs as a run that passed -- have their outputs restored from smelt-out/.action_cache, rather than
+    being run again. Off by default, since a command that reads anything it doesn't declare (tools, files outside the
+    testlist, the network) would be restored from a stale run. `remote_cache` is only used when this is on, and
+    --test-only refuses to run without it
+    """
+
+    cas_max_mb: int = 20480
+    """
+    Size budget of smelt-out/.cas, where the outputs of cached commands are stored -- the blobs that were used least
+    recently are evicted past it. 0 means there is no budget
+    """
+
+    remote_cache: Optional[str] = None
+    """
+    REAPI cache (e.g. "http://cache.internal:9092") that action results and outputs are looked up in when they aren't
+    cached locally, and uploaded to once they are stored -- lets CI runners and developer machines share builds.
+    Action digests are smelt's own rather than digests of uploaded Action messages, so the cache has to accept
+    results for actions it hasn't seen. Outputs larger than a few MiB are streamed through ByteStream, which the cache
+    has to serve as well
+    """
+
+    remote_instance_name: str = ""
+    """
+    Instance name sent with every remote cache request
+    """
+
+    memory_budget_mb: Optional[int] = None
+    """
+    Memory that the commands running at once can reserve between them with their max_memory_mb -- all of the host's
+    physical memory if unset, 0 to only budget cpus
+    """
+
+    enforce_limits: bool = False
+    """
+    If true, commands that run past their timeout or use more than their max_memory_mb are killed, along with
+    everything they started. Off by default, since every target gets a timeout and max_memory_mb whether or not it
+    sets them -- the limits are still used to decide what can run at once
+    """
+
     @classmethod
     def default(cls):
         default_jobs = 8
@@ -53,10 +132,30 @@ class SmeltRC:
 
         try:
             rc_content = toml.loads(stream)
+            optional_fields = {
+                name: rc_content[name]
+                for name in (
+                    "stdout_chunk_bytes",
+                    "stdout_flush_ms",
+                    "stdout_max_forwarded_bytes",
+                    "event_buffer_capacity",
+                    "event_overflow",
+                    "testlist_cache",
+                    "release_universe",
+                    "action_cache",
+                    "cas_max_mb",
+                    "remote_cache",
+                    "remote_instance_name",
+                    "memory_budget_mb",
+                    "enforce_limits",
+                )
+                if name in rc_content
+            }
             return cls(
                 smelt_root=rc_content["smelt_root"],
                 smelt_rules_dir=rc_content["smelt_rules_dir"],
                 jobs=rc_content["jobs"],
+                **optional_fields,
             )
         except toml.TomlDecodeError as exc:
             print(exc)
@@ -87,6 +186,10 @@ class SmeltRcHolder:
     def current_rc() -> SmeltRC:
         return SmeltRcHolder._current_rc
 
+    @staticmethod
+    def set_current_rc(rc: SmeltRC):
+        SmeltRcHolder._current_rc = rc
+
     @staticmethod
     def set_jobs(jobs: int):
 
@@ -7,3 +7,8 @@ class SafeDataclassDumper(yaml.SafeDumper):
         if dataclasses.is_dataclass(data):
             return self.represent_dict(dataclasses.asdict(data))
         return super().represent_data(data)
+
+
+# commands share read only dict subclasses for their environments, which the safe dumper only represents as dicts
+# when told to
+SafeDataclassDumper.add_multi_representer(dict, SafeDataclassDumper.represent_dict)
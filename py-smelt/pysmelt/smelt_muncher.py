@@ -1,32 +1,23 @@
+from concurrent.futures import Executor, ProcessPoolExecutor
 from dataclasses import dataclass
 import functools
+import os
 import yaml
 import pathlib
-from typing import ClassVar, Dict, Any, Iterable, Set, Tuple, Type, List
-from pydantic import BaseModel
-from pysmelt.generators.procedural import get_procedural_targets
-from pysmelt.importer import (
-    DocumentedTarget,
-    get_all_targets,
-    get_default_targets,
+from typing import ClassVar, Dict, Iterable, Optional, Set, Tuple, List
+from pysmelt.generators.procedural import (
+    get_procedural_targets,
+    iter_procedural_targets,
+    take_declared_inputs,
 )
+from pysmelt.importer import RuleRegistry
 from pysmelt.interfaces import Target, Command
 from pysmelt.interfaces.paths import SmeltPath, TempTarget
 from pysmelt.interfaces.target import TargetRef
 from pysmelt.rc import SmeltRC, SmeltRcHolder
 from pysmelt.path_utils import get_git_root
-
-
-class SerYamlTarget(BaseModel):
-    name: str
-    rule: str
-    rule_args: Dict[str, Any] = {}
-
-
-@dataclass
-class PreTarget:
-    target_typ: Type[Target]
-    rule_args: Dict[str, Any]
+from pysmelt import testlist_cache
+from pysmelt.testlist_formats import TestlistColumns, load_testlist, load_yaml
 
 
 @dataclass
@@ -42,29 +33,6 @@ class ImportTracker:
         return ImportTracker.imported_commands
 
 
-def populate_rule_args(
-    target_name: str,
-    rule_payload: SerYamlTarget,
-    all_rules: Dict[str, DocumentedTarget],
-) -> PreTarget:
-    rule_payload.rule_args["name"] = target_name
-    if rule_payload.rule not in all_rules:
-        print(all_rules)
-
-        # TODO: make a pretty error that
-        #
-        # Says that no rule is visible
-        # Prints out all rules that are visible
-        # Point to the location where end users can create new rules
-        raise RuntimeError(f"Rule named {rule_payload.rule} has not been created!")
-    target_type = all_rules[rule_payload.rule]["target"]
-    return PreTarget(target_typ=target_type, rule_args=rule_payload.rule_args)
-
-
-def to_target(pre_target: PreTarget) -> Target:
-    return pre_target.target_typ(**pre_target.rule_args)
-
-
 def get_targets(
     test_list: SmeltPath, default_rules_only: bool = False
 ) -> Dict[str, Target]:
@@ -77,9 +45,8 @@ def get_targets(
         return {target.name: target for target in targets}
 
     else:
-        yaml_content = open(test_list2).read()
-        return smelt_contents_to_targets(
-            yaml_content, default_rules_only=default_rules_only
+        return columns_to_targets(
+            load_testlist(test_list2), default_rules_only=default_rules_only
         )
 
 
@@ -95,69 +62,203 @@ def parse_smelt(
     return targets, command_list
 
 
+def load_smelt_commands(
+    test_list: SmeltPath, default_rules_only: bool = False
+) -> List[Command]:
+    """
+    Same commands as `parse_smelt`, but yaml testlists are served from `testlist_cache` when neither they nor the
+    rules have changed
+
+    Procedural (.py) testlists go through `load_procedural_commands`
+    """
+    abs_path = test_list.to_abs_path()
+    if pathlib.Path(abs_path).suffix == ".py":
+        return load_procedural_commands(test_list, default_rules_only)
+    if not SmeltRcHolder.current_rc().testlist_cache:
+        return parse_smelt(test_list, default_rules_only)[1]
+
+    content = pathlib.Path(abs_path).read_bytes()
+    key = testlist_cache.cache_key(abs_path, content, default_rules_only)
+    commands = testlist_cache.load_cached(key)
+    if commands is None:
+        _, commands = parse_smelt(test_list, default_rules_only)
+        testlist_cache.store(key, commands)
+    return commands
+
+
+def load_procedural_commands(
+    test_list: SmeltPath, default_rules_only: bool = False
+) -> List[Command]:
+    """
+    Runs a procedural testlist, lowering each target as soon as it is generated -- so targets that come from a
+    `generate_targets` generator are never all held at once
+
+    Testlists that `declare_inputs` are served from `testlist_cache` while neither the script, the rules, nor any of
+    the declared inputs (or testlists pulled in with `import_as_target`) have changed
+    """
+    abs_path = test_list.to_abs_path()
+    use_cache = SmeltRcHolder.current_rc().testlist_cache
+    key = ""
+    if use_cache:
+        content = pathlib.Path(abs_path).read_bytes()
+        key = testlist_cache.cache_key(abs_path, content, default_rules_only)
+        entry = testlist_cache.load_procedural(key)
+        if entry is not None:
+            ImportTracker.imported_commands.update(entry.imported)
+            return entry.commands
+
+    already_imported = set(ImportTracker.imported_commands)
+    take_declared_inputs()
+    working_dir = str(pathlib.Path(abs_path).parent)
+    commands = [
+        target_to_command(target, working_dir)
+        for target in iter_procedural_targets(abs_path)
+    ]
+    inputs = take_declared_inputs()
+    if use_cache and inputs is not None:
+        imported = {
+            path: imported_commands
+            for path, imported_commands in ImportTracker.imported_commands.items()
+            if path not in already_imported
+        }
+        input_paths = [str(pathlib.Path(working_dir, path)) for path in inputs]
+        input_paths.extend(path.to_abs_path() for path in imported)
+        testlist_cache.store_procedural(
+            key,
+            testlist_cache.ProceduralEntry(
+                inputs=testlist_cache.input_digests(input_paths),
+                commands=commands,
+                imported=imported,
+            ),
+        )
+    return commands
+
+
 @dataclass
 class SmeltUniverse:
     top_file: SmeltPath
     commands: Dict[SmeltPath, List[Command]]
+    released: bool = False
+    """
+    Set once the commands have been dropped after being handed to the graph, see `PyGraph.release_universe`
+    """
 
     @property
     def all_commands(self) -> List[Command]:
+        if self.released:
+            raise RuntimeError(
+                "The python copy of the commands was released once they were handed to the graph -- "
+                "turn off release_universe in the .smeltrc to keep it around"
+            )
         return [
             command
             for command_list in self.commands.values()
             for command in command_list
         ]
 
+    def apply_update(
+        self,
+        add: Iterable[Command],
+        replace: Iterable[Command],
+        remove: Iterable[str],
+        file: SmeltPath,
+    ):
+        """
+        Mirrors an incremental graph update -- replaced commands keep their place, added ones go under `file`
+
+        A released universe has nothing to mirror the update in to, so it is left as it is
+        """
+        if self.released:
+            return
+        replaced = {command.name: command for command in replace}
+        removed = set(remove)
+        if replaced or removed:
+            for path, command_list in self.commands.items():
+                self.commands[path] = [
+                    replaced.get(command.name, command)
+                    for command in command_list
+                    if command.name not in removed
+                ]
+        self.commands.setdefault(file, []).extend(add)
+
+
+ParsedFile = Tuple[List[Command], Dict[SmeltPath, List[Command]]]
+"""
+Commands lowered from a single smelt file, and the commands of every file it imported along the way
+"""
+
+
+def _init_universe_worker(rc: SmeltRC):
+    SmeltRcHolder.set_current_rc(rc)
+
+
+def _parse_for_universe(file: SmeltPath, default_rules_only: bool) -> ParsedFile:
+    commands = load_smelt_commands(file, default_rules_only)
+    imported = ImportTracker.get_all_imported()
+    ImportTracker.clear()
+    return commands, imported
+
+
+def _parse_wave(
+    wave: List[SmeltPath],
+    default_rules_only: bool,
+    pool: Optional[Executor],
+) -> List[ParsedFile]:
+    if pool is None or len(wave) == 1:
+        return [_parse_for_universe(file, default_rules_only) for file in wave]
+    return list(
+        pool.map(
+            _parse_for_universe, wave, [default_rules_only] * len(wave), chunksize=1
+        )
+    )
+
 
 def create_universe(
     starting_file: SmeltPath,
     default_rules_only: bool = False,
+    max_workers: Optional[int] = None,
 ) -> SmeltUniverse:
-    # Initialize the top file, seen files, visible files, and all commands
+    """
+    Parses `starting_file`, and every smelt file that is reachable through command dependencies
+
+    Files are parsed a frontier at a time: every file that became visible in the last wave is parsed in parallel, in a
+    process pool of `max_workers` processes (all cores by default, 1 parses everything in this process). Waves are
+    merged in path order, so the universe doesn't depend on which worker finished first
+    """
     top_file = starting_file
     seen_files = {starting_file}
-    visible_files = {starting_file}
-    all_commands = {}
-
-    # Parse the "initial" file under consideration and all of the testlists seen to visible files
-    _, commands = parse_smelt(starting_file, default_rules_only)
-    for comm in commands:
-        for dep in comm.dependencies:
-            tt = TempTarget.parse_string_smelt_target(dep, starting_file.to_abs_path())
-            visible_files.add(tt.file_path)
-    all_commands[top_file] = commands
-    all_commands.update(ImportTracker.imported_commands)
-    ImportTracker.clear()
-
-    # Determine new files that are visible but not yet parsed
-    new_files = visible_files - seen_files
-
-    # Continue to parse new files until we've seen everything
-    while True:
-        if len(new_files) != 0:
-            file = new_files.pop()
-            seen_files.add(file)
-            _, new_commands = parse_smelt(
-                file,
-                default_rules_only,
-            )
-
-            # Add dependencies of new commands to new files if not seen
-            for command in new_commands:
-                for dep in command.dependencies:
-                    tt = TempTarget.parse_string_smelt_target(
-                        dep, starting_file.to_abs_path()
-                    )
-                    if tt.file_path not in seen_files:
-                        new_files.add(tt.file_path)
-
-            all_commands[file] = new_commands
-            all_commands.update(ImportTracker.imported_commands)
-            ImportTracker.clear()
-
-        else:
-            # Break the loop if there are no new files
-            break
+    all_commands: Dict[SmeltPath, List[Command]] = {}
+
+    workers = max_workers or os.cpu_count() or 1
+    pool: Optional[ProcessPoolExecutor] = None
+    wave = [starting_file]
+    try:
+        while wave:
+            if pool is None and workers > 1 and len(wave) > 1:
+                pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    initializer=_init_universe_worker,
+                    initargs=(SmeltRcHolder.current_rc(),),
+                )
+            new_files: Set[SmeltPath] = set()
+            for file, (commands, imported) in zip(
+                wave, _parse_wave(wave, default_rules_only, pool)
+            ):
+                # Add dependencies of new commands to new files if not seen
+                for command in commands:
+                    for dep in command.dependencies:
+                        tt = TempTarget.parse_string_smelt_target(
+                            dep, starting_file.to_abs_path()
+                        )
+                        if tt.file_path not in seen_files:
+                            new_files.add(tt.file_path)
+                all_commands[file] = commands
+                all_commands.update(imported)
+            seen_files |= new_files
+            wave = sorted(new_files, key=str)
+    finally:
+        if pool is not None:
+            pool.shutdown()
 
     # Should have everything in the Universe now
     return SmeltUniverse(top_file=top_file, commands=all_commands)
@@ -174,19 +275,34 @@ def lower_targets_to_commands(targets: Iterable[Target], path: str) -> List[Comm
 
 def smelt_contents_to_targets(
     smelt_content: str,
-    rc: SmeltRC = SmeltRcHolder.current_rc(),
+    rc: Optional[SmeltRC] = None,
+    default_rules_only: bool = False,
+) -> Dict[str, Target]:
+    return columns_to_targets(load_yaml(smelt_content), rc, default_rules_only)
+
+
+def columns_to_targets(
+    columns: TestlistColumns,
+    rc: Optional[SmeltRC] = None,
     default_rules_only: bool = False,
 ) -> Dict[str, Target]:
-    rule_inst = yaml.safe_load(smelt_content)
     # NOTE: semantically we split up validation of the smelt file -> converting to target objects -> generating a command list
     # while dependency based
-    if default_rules_only:
-        all_rules = get_default_targets(rc)
-    else:
-        all_rules = get_all_targets(rc)
-    yaml_targets = [SerYamlTarget(**target) for target in rule_inst]
-    pre_targets = {
-        target.name: populate_rule_args(target.name, target, all_rules)
-        for target in yaml_targets
+    used_rules = set(columns.rules)
+    if rc is None:
+        rc = SmeltRcHolder.current_rc()
+    # only the rule files that define a rule this file uses get imported
+    all_rules = RuleRegistry.resolve(
+        used_rules, None if default_rules_only else rc.abs_rules_dir
+    )
+    for rule in sorted(used_rules):
+        if rule not in all_rules:
+            raise RuntimeError(f"Rule named {rule} has not been created!")
+    # each rule is looked up once, rather than once per target
+    target_types = {rule: all_rules[rule]["target"] for rule in used_rules}
+    return {
+        name: target_types[rule](**{**rule_args, "name": name})
+        for name, rule, rule_args in zip(
+            columns.names, columns.rules, columns.rule_args
+        )
     }
-    return {name: to_target(pre_target) for name, pre_target in pre_targets.items()}
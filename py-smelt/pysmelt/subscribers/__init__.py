@@ -1,7 +1,291 @@
-from typing import Protocol
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Protocol,
+    Set,
+    Tuple,
+    cast,
+)
 
-from pysmelt.proto.smelt_telemetry import Event
+import betterproto
+
+from pysmelt.proto.executed_tests import ArtifactPointer, Digest, TestOutputs
+from pysmelt.proto.smelt_client.commands import EventSubscription
+from pysmelt.proto.smelt_telemetry import (
+    AllCommandsDone,
+    CommandCancelled,
+    CommandEvent,
+    CommandFinished,
+    CommandKilled,
+    CommandProfile,
+    CommandScheduled,
+    CommandSkipped,
+    CommandStarted,
+    CommandStdout,
+    Event,
+    ExecutionStart,
+    InvokeEvent,
+    KillReason,
+    SetGraph,
+    SmeltError,
+    SmeltErrorType,
+)
 
 
 class SmeltSub(Protocol):
     def process_message(self, message: Event) -> None: ...
+
+
+@dataclass(frozen=True)
+class ClassifiedEvent:
+    """
+    An `Event`, along with the variant it was classified as
+    """
+
+    kind: str
+    """
+    "<et>.<variant>" for command and invoke events, e.g. "command.finished" or "invoke.start" -- "error" for errors
+    """
+    payload: Any
+    """
+    The innermost message of the event -- e.g. the `CommandFinished` of a "command.finished" event
+    """
+    command_ref: Optional[str] = None
+    """
+    Name of the command this event is about, for command events
+    """
+    trace_id: str = ""
+    time: Optional[datetime] = None
+    _event: Optional[Event] = field(default=None, repr=False, compare=False)
+
+    @property
+    def variant(self) -> str:
+        """
+        The variant without its top level prefix, e.g. "finished" for "command.finished"
+        """
+        return self.kind.partition(".")[2]
+
+    @property
+    def event(self) -> Event:
+        """
+        The full `Event` -- for events that came straight from rust, this is only built the first time it's asked for
+        """
+        if self._event is None:
+            object.__setattr__(self, "_event", self._build_event())
+        return cast(Event, self._event)
+
+    def _build_event(self) -> Event:
+        rv = Event(trace_id=self.trace_id)
+        if self.time is not None:
+            rv.time = self.time
+        et, _, variant = self.kind.partition(".")
+        # events without a variant, e.g. a bare "command.", have no payload to set
+        fields = {variant: self.payload} if self.payload is not None else {}
+        if et == "command":
+            rv.command = CommandEvent(command_ref=self.command_ref or "", **fields)
+        elif et == "invoke":
+            rv.invoke = InvokeEvent(**fields)
+        elif et == "error":
+            rv.error = self.payload
+        return rv
+
+
+def classify_event(message: Event) -> ClassifiedEvent:
+    variant, event_payload = betterproto.which_one_of(message, "et")
+    if variant == "command":
+        inner, payload = betterproto.which_one_of(event_payload, "CommandVariant")
+        return ClassifiedEvent(
+            kind=f"command.{inner}",
+            payload=payload,
+            command_ref=event_payload.command_ref,
+            trace_id=message.trace_id,
+            time=message.time,
+            _event=message,
+        )
+    if variant == "invoke":
+        inner, payload = betterproto.which_one_of(event_payload, "InvokeVariant")
+        return ClassifiedEvent(
+            kind=f"invoke.{inner}",
+            payload=payload,
+            trace_id=message.trace_id,
+            time=message.time,
+            _event=message,
+        )
+    return ClassifiedEvent(
+        kind=variant,
+        payload=event_payload,
+        trace_id=message.trace_id,
+        time=message.time,
+        _event=message,
+    )
+
+
+NativeEvent = Tuple[str, str, int, int, Optional[str], Any]
+"""
+An event as it comes out of `PyEventStream.pop_batch_native` -- `(kind, trace_id, secs, nanos, command_ref, payload)`
+"""
+
+
+NativeDigest = Optional[Tuple[str, int]]
+
+
+def _native_digest(digest: Tuple[str, int]) -> Digest:
+    return Digest(hash=digest[0], size_bytes=digest[1])
+
+
+def _native_finished(
+    payload: Tuple[
+        int, List[Tuple[str, Optional[str], NativeDigest]], bool, NativeDigest
+    ],
+):
+    exit_code, artifacts, cached, result_digest = payload
+    pointers = []
+    for name, path, cas_hash in artifacts:
+        # unset fields are left alone, so they match an event that went through protobuf
+        pointer = ArtifactPointer(artifact_name=name)
+        if path is not None:
+            pointer.path = path
+        if cas_hash is not None:
+            pointer.cas_hash = _native_digest(cas_hash)
+        pointers.append(pointer)
+    outputs = TestOutputs(exit_code=exit_code, artifacts=pointers)
+    if result_digest is not None:
+        outputs.result_digest = _native_digest(result_digest)
+    return CommandFinished(outputs=outputs, cached=cached)
+
+
+_NATIVE_PAYLOADS: Dict[str, Callable[[Any], Any]] = {
+    "command.scheduled": lambda _: CommandScheduled(),
+    "command.started": lambda _: CommandStarted(),
+    "command.cancelled": lambda _: CommandCancelled(),
+    "command.skipped": lambda _: CommandSkipped(),
+    "command.finished": _native_finished,
+    "command.stdout": lambda payload: CommandStdout(
+        output=payload[0], dropped_bytes=payload[1]
+    ),
+    "command.profile": lambda payload: CommandProfile(
+        memory_used=payload[0], cpu_load=payload[1]
+    ),
+    "command.killed": lambda payload: CommandKilled(
+        reason=KillReason(payload[0]), limit=payload[1]
+    ),
+    "invoke.start": lambda payload: ExecutionStart(*payload),
+    "invoke.done": lambda _: AllCommandsDone(),
+    "invoke.set": lambda _: SetGraph(),
+    "error": lambda payload: SmeltError(
+        sig=SmeltErrorType(payload[0]), error_payload=payload[1]
+    ),
+}
+
+
+def classify_native(native: NativeEvent) -> ClassifiedEvent:
+    """
+    Builds a `ClassifiedEvent` from the tuple form of an event, without going through protobuf
+
+    Kinds without a payload builder -- events with no variant set, e.g. "command." -- get a payload of None
+    """
+    kind, trace_id, secs, nanos, command_ref, payload = native
+    time = datetime.fromtimestamp(secs, tz=timezone.utc) + timedelta(
+        microseconds=nanos // 1000
+    )
+    build_payload = _NATIVE_PAYLOADS.get(kind)
+    return ClassifiedEvent(
+        kind=kind,
+        payload=None if build_payload is None else build_payload(payload),
+        command_ref=command_ref,
+        trace_id=trace_id,
+        time=time,
+    )
+
+
+class FilteredSub(SmeltSub, Protocol):
+    """
+    A subscriber that declares which kinds of events it wants
+
+    The runloop classifies every event once, and only calls `process_event` for the kinds in `event_kinds`
+    """
+
+    event_kinds: FrozenSet[str]
+    """
+    e.g. {"command.finished", "invoke.start"} -- a bare "command" or "invoke" matches all of its variants
+    """
+
+    def process_event(self, event: ClassifiedEvent) -> None: ...
+
+
+def wants_kind(event_kinds: FrozenSet[str], kind: str) -> bool:
+    return kind in event_kinds or kind.partition(".")[0] in event_kinds
+
+
+def process_filtered(sub: FilteredSub, message: Event):
+    """
+    Implementation of `process_message` for a `FilteredSub`, for when it is driven by hand
+    """
+    event = classify_event(message)
+    if wants_kind(sub.event_kinds, event.kind):
+        sub.process_event(event)
+
+
+EventHandler = Callable[[ClassifiedEvent], None]
+
+
+class EventDispatcher:
+    """
+    Hands each event to the subscribers that want it
+
+    Subscribers that don't declare `event_kinds` get every event through `process_message`
+    """
+
+    def __init__(self, subscribers: Iterable[SmeltSub]):
+        self.subscribers = list(subscribers)
+        self._routes: Dict[str, List[EventHandler]] = {}
+
+    def _route(self, kind: str) -> List[EventHandler]:
+        handlers: List[EventHandler] = []
+        for sub in self.subscribers:
+            event_kinds = getattr(sub, "event_kinds", None)
+            if event_kinds is None:
+                handlers.append(lambda event, sub=sub: sub.process_message(event.event))
+            elif wants_kind(event_kinds, kind):
+                handlers.append(sub.process_event)
+        return handlers
+
+    def subscription(
+        self, stdout_commands: Iterable[str] = ()
+    ) -> Optional[EventSubscription]:
+        """
+        The narrowest `EventSubscription` that still gets every subscriber the events it wants
+
+        None if some subscriber wants every command event. If `stdout_commands` is non-empty, stdout
+        is only sent for those commands
+        """
+        variants: Set[str] = set()
+        for sub in self.subscribers:
+            event_kinds = getattr(sub, "event_kinds", None)
+            if event_kinds is None or "command" in event_kinds:
+                return None
+            variants.update(
+                kind.partition(".")[2]
+                for kind in event_kinds
+                if kind.startswith("command.")
+            )
+        return EventSubscription(
+            command_variants=sorted(variants), stdout_commands=list(stdout_commands)
+        )
+
+    def dispatch(self, message: Event):
+        self.dispatch_classified(classify_event(message))
+
+    def dispatch_classified(self, event: ClassifiedEvent):
+        handlers = self._routes.get(event.kind)
+        if handlers is None:
+            handlers = self._routes[event.kind] = self._route(event.kind)
+        for handler in handlers:
+            handler(event)
@@ -1,7 +1,7 @@
 from dataclasses import dataclass
-from typing import cast
-import betterproto
+from typing import ClassVar, FrozenSet, cast
 from pysmelt.proto.smelt_telemetry import Event, SmeltError, SmeltErrorType
+from pysmelt.subscribers import ClassifiedEvent, process_filtered
 
 
 class ClientErr(RuntimeError):
@@ -26,13 +26,14 @@ class SmeltErrorHandler:
     Simple subscriber that tells us if we're done executing
     """
 
+    event_kinds: ClassVar[FrozenSet[str]] = frozenset({"error"})
+
     def process_message(self, message: Event):
-        (variant, event_payload) = betterproto.which_one_of(message, "et")
-        if variant == "error":
-            error = cast(SmeltError, event_payload)
-            if error.sig == SmeltErrorType.CLIENT_ERROR:
-                raise ClientErr(error.error_payload)
-            if error.sig == SmeltErrorType.INTERNAL_ERROR:
-                raise SmeltErrEx(error.error_payload)
-        else:
-            pass
+        process_filtered(self, message)
+
+    def process_event(self, event: ClassifiedEvent):
+        error = cast(SmeltError, event.payload)
+        if error.sig == SmeltErrorType.CLIENT_ERROR:
+            raise ClientErr(error.error_payload)
+        if error.sig == SmeltErrorType.INTERNAL_ERROR:
+            raise SmeltErrEx(error.error_payload)
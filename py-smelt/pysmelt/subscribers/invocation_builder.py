@@ -1,16 +1,14 @@
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Dict, List, Optional, cast
-import betterproto
+from typing import ClassVar, Dict, FrozenSet, List, Optional, cast
 from pysmelt.interfaces.analysis import most_recent_invoke_path
 from pysmelt.proto.smelt_telemetry import (
-    CommandEvent,
     CommandFinished,
     Event,
     ExecutionStart,
-    InvokeEvent,
 )
 from pysmelt.proto.executed_tests import Invocation, TestResult
+from pysmelt.subscribers import ClassifiedEvent, process_filtered
 
 
 @dataclass
@@ -28,43 +26,29 @@ class InvocationBuilder:
     smelt_root: Optional[str] = None
     tests: List[TestResult] = field(default_factory=list)
 
-    def process_message(self, message: Event):
-        (variant, event_payload) = betterproto.which_one_of(message, "et")
-        if variant == "command":
-            event_payload = cast(CommandEvent, event_payload)
-            command_name = event_payload.command_ref
-            (command_variant, command_payload) = betterproto.which_one_of(
-                event_payload, "CommandVariant"
-            )
-
-            if command_variant == "finished":
-                command_payload = cast(CommandFinished, command_payload)
+    event_kinds: ClassVar[FrozenSet[str]] = frozenset(
+        {"command.finished", "invoke.start", "invoke.done"}
+    )
 
-                self.tests.append(
-                    TestResult(test_name=command_name, outputs=command_payload.outputs)
-                )
+    def process_message(self, message: Event):
+        process_filtered(self, message)
 
-            else:
-                pass
-        elif variant == "invoke":
-            event_payload = cast(InvokeEvent, event_payload)
-            (invoke_variant, invoke_payload) = betterproto.which_one_of(
-                event_payload, "InvokeVariant"
+    def process_event(self, event: ClassifiedEvent):
+        if event.kind == "command.finished":
+            command_payload = cast(CommandFinished, event.payload)
+            self.tests.append(
+                TestResult(test_name=event.command_ref, outputs=command_payload.outputs)
             )
-
-            if invoke_variant == "start":
-                invoke_payload = cast(ExecutionStart, invoke_payload)
-                self.branch = invoke_payload.git_branch
-                self.repo = invoke_payload.git_repo
-                self.hostname = invoke_payload.hostname
-                self.smelt_root = invoke_payload.smelt_root
-                self.invoke_id = message.trace_id
-                self.user = invoke_payload.username
-            if invoke_variant == "done":
-                self.rundate = message.time
-
-        else:
-            pass
+        elif event.kind == "invoke.start":
+            invoke_payload = cast(ExecutionStart, event.payload)
+            self.branch = invoke_payload.git_branch
+            self.repo = invoke_payload.git_repo
+            self.hostname = invoke_payload.hostname
+            self.smelt_root = invoke_payload.smelt_root
+            self.invoke_id = event.trace_id
+            self.user = invoke_payload.username
+        elif event.kind == "invoke.done":
+            self.rundate = event.time
 
     def create_invocation_object(self) -> Invocation:
         assert self.invoke_id, "invoke_id is required"
@@ -1,6 +1,7 @@
 from dataclasses import dataclass
-import betterproto
+from typing import ClassVar, FrozenSet
 from pysmelt.proto.smelt_telemetry import Event
+from pysmelt.subscribers import ClassifiedEvent, process_filtered
 
 
 @dataclass
@@ -9,21 +10,14 @@ class IsDoneSubscriber:
     Simple subscriber that tells us if we're done executing
     """
 
+    event_kinds: ClassVar[FrozenSet[str]] = frozenset({"invoke.done"})
     is_done: bool = False
 
     def process_message(self, message: Event):
-        (variant, event_payload) = betterproto.which_one_of(message, "et")
-        if variant == "invoke":
-            (invoke_name, invoke_payload) = betterproto.which_one_of(
-                event_payload, "InvokeVariant"
-            )
+        process_filtered(self, message)
 
-            if invoke_name == "done":
-                self.is_done = True
-            else:
-                pass
-        else:
-            pass
+    def process_event(self, event: ClassifiedEvent):
+        self.is_done = True
 
     def reset(self):
         self.is_done = False
@@ -1,7 +1,8 @@
 import collections
 from datetime import datetime
 import enum
-from typing import Dict, List, Optional, Tuple
+import itertools
+from typing import Dict, FrozenSet, List, Optional, Tuple
 from pysmelt.rc import SmeltRcHolder
 from rich.table import Table
 from typing_extensions import cast
@@ -12,12 +13,14 @@ from pysmelt.interfaces.target import SmeltTargetType, Target
 from pysmelt.output import smelt_console
 from dataclasses import dataclass, field
 from pysmelt.proto.smelt_telemetry import (
-    CommandEvent,
     CommandFinished,
+    CommandKilled,
     CommandStdout,
     Event,
+    KillReason,
 )
-import betterproto
+from pysmelt.subscribers import ClassifiedEvent, process_filtered
+from pysmelt.subscribers.stdout import stdout_text
 from rich.progress import (
     Progress,
     RenderableColumn,
@@ -34,6 +37,7 @@ class Status(enum.Enum):
     finished = "finished"
     cancelled = "cancelled"
     skipped = "skipped"
+    killed = "killed"
 
 
 @dataclass
@@ -44,16 +48,36 @@ class StatusObj:
     status: Status
 
 
+MAX_VISIBLE_RUNNING = 20
+"""
+Most running commands that are drawn in the live display -- the rest are summed up in a single line
+"""
+
+REFRESH_PER_SECOND = 4
+"""
+Frame rate of the live display
+"""
+
+
 class RenderableTree(RenderableColumn):
-    """Renders completed filesize."""
+    """
+    Renders the running commands, and how far along the invocation is
+
+    Only looks at the console's running set and counters, so a frame costs the same no matter how many commands
+    the invocation has
+    """
 
     def render(self, task: Task):
-        """Show data completed."""
-        status_dict: Dict[str, Status] = task.fields["fields"]["status"]
-        root = Tree("Running tasks")
-        for command, status in status_dict.items():
-            if status == Status.started:
-                sub1 = root.add(f"Running {command}")
+        console: "OutputConsole" = task.fields["fields"]["console"]
+        root = Tree(
+            f"Running tasks -- {console.total_finished}/{console.total_scheduled} done, "
+            f"{console.total_passed} passed"
+        )
+        for command in itertools.islice(console.running, console.max_visible):
+            root.add(f"Running {command}")
+        hidden = len(console.running) - console.max_visible
+        if hidden > 0:
+            root.add(f"and {hidden} more running")
         return root
 
 
@@ -66,6 +90,34 @@ def get_logs_from_command_name(command_name: str, num_lines_tail: int = 3) -> st
         return f"Could not read {command_name}'s log"
 
 
+TIMED_OUT_EXIT_CODE = -124
+"""
+Exit code of a command that was killed for running past its timeout
+"""
+
+OUT_OF_MEMORY_EXIT_CODE = -137
+"""
+Exit code of a command that was killed for using more than its max_memory_mb
+"""
+
+
+def result_text(finished: CommandFinished) -> str:
+    if finished.cached:
+        return "CACHED"
+    exit_code = finished.outputs.exit_code
+    if exit_code == TIMED_OUT_EXIT_CODE:
+        return "TIMED OUT"
+    if exit_code == OUT_OF_MEMORY_EXIT_CODE:
+        return "OUT OF MEMORY"
+    return "PASSED" if exit_code == 0 else f"FAILED, code: {exit_code}"
+
+
+def killed_text(killed: CommandKilled) -> str:
+    if killed.reason == KillReason.TIMED_OUT:
+        return f"KILLED, ran past its {killed.limit}s timeout"
+    return f"KILLED, used more than {killed.limit}MB"
+
+
 @dataclass
 class OutputConsole:
     """
@@ -74,16 +126,31 @@ class OutputConsole:
 
     print_stdout: bool = False
     is_done: bool = False
+    max_visible: int = MAX_VISIBLE_RUNNING
+    total_scheduled: int = 0
     total_run: int = 0
     total_executing: int = 0
+    total_finished: int = 0
     total_passed: int = 0
+    total_cached: int = 0
+    """
+    Commands that were up to date, and restored from the action cache rather than run
+    """
     status_dict: Dict[str, Status] = field(default_factory=dict)
+    running: Dict[str, datetime] = field(default_factory=dict)
+    """
+    Commands that have started but not finished, in the order they started
+    """
     progress: Optional[Progress] = None
     task: Optional[TaskID] = None
     finished_list: List[Tuple[CommandFinished, str, datetime]] = field(
         default_factory=list
     )
     skipped_list: List[str] = field(default_factory=list)
+    killed_list: List[str] = field(default_factory=list)
+    """
+    Commands that were killed for going over their timeout or memory limit
+    """
 
     start_time: Dict[str, datetime] = field(default_factory=dict)
 
@@ -93,11 +160,13 @@ class OutputConsole:
             RenderableTree(),
             SpinnerColumn(),
             TimeElapsedColumn(),
+            console=smelt_console,
+            refresh_per_second=REFRESH_PER_SECOND,
         )
 
         self.progress.start()
         self.task = self.progress.add_task(
-            "Executing smelt...", fields={"status": self.status_dict}
+            "Executing smelt...", fields={"console": self}
         )
 
         return self
@@ -138,15 +207,7 @@ class OutputConsole:
             elif milliseconds > 0:
                 time_str += f"{milliseconds:.2f}ms "
 
-            table.add_row(
-                command_name,
-                (
-                    "PASSED"
-                    if obj.outputs.exit_code == 0
-                    else f"FAILED, code: {obj.outputs.exit_code}"
-                ),
-                time_str,
-            )
+            table.add_row(command_name, result_text(obj), time_str)
         if len(new_finished_list) > topn:
             unseen = len(new_finished_list) - topn
             table.add_row(f"and {unseen} other commands...", "")
@@ -170,47 +231,70 @@ class OutputConsole:
 
         failed = self.total_run - self.total_passed
         smelt_console.print(f"[green] {self.total_passed} commands passed ")
+        if self.total_cached != 0:
+            smelt_console.print(f"[green] {self.total_cached} commands were up to date")
         if len(self.skipped_list) != 0:
             smelt_console.print(f"[red] {len(self.skipped_list)} commands skipped")
+        if len(self.killed_list) != 0:
+            smelt_console.print(
+                f"[red] {len(self.killed_list)} commands were killed for going over their limits"
+            )
         if failed != 0:
             smelt_console.print(f"[red] {failed} commands failed")
 
-    def process_message(self, message: Event):
-        (variant, event_payload) = betterproto.which_one_of(message, "et")
-        if variant == "command":
-            event_payload: CommandEvent
-            name = event_payload.command_ref
-            (command_name, payload) = betterproto.which_one_of(
-                event_payload, "CommandVariant"
-            )
-
-            if command_name != "stdout" and command_name != "profile":
-                self.status_dict[name] = Status(command_name)
-                if command_name == "started":
-                    self.processed_started(name, message.time)
-
-                if command_name == "finished":
-                    payload = cast(CommandFinished, payload)
-                    self.process_finished(payload, name, message.time)
-
-                if command_name == "skipped":
-                    self.process_skipped(name)
+    @property
+    def event_kinds(self) -> FrozenSet[str]:
+        kinds = {f"command.{status.value}" for status in Status}
+        if self.print_stdout:
+            kinds.add("command.stdout")
+        return frozenset(kinds)
 
-            # we are processing stdout of a command
-            else:
-                if self.progress and self.print_stdout:
-                    self.progress.print(payload.output)
+    def process_message(self, message: Event):
+        process_filtered(self, message)
+
+    def process_event(self, event: ClassifiedEvent):
+        name = event.command_ref
+        command_name = event.variant
+        # we are processing stdout of a command
+        if command_name == "stdout":
+            if self.progress and self.print_stdout:
+                self.progress.print(stdout_text(cast(CommandStdout, event.payload)))
+            return
+        self.status_dict[name] = Status(command_name)
+        if command_name == "scheduled":
+            self.total_scheduled += 1
+        if command_name == "started":
+            self.processed_started(name, event.time)
+        if command_name == "finished":
+            payload = cast(CommandFinished, event.payload)
+            self.process_finished(payload, name, event.time)
+        if command_name == "skipped":
+            self.process_skipped(name)
+        if command_name == "cancelled":
+            self.running.pop(name, None)
+        if command_name == "killed":
+            self.killed_list.append(name)
 
     def processed_started(self, name: str, time: datetime):
         self.total_executing += 1
         self.total_run += 1
         self.start_time[name] = time
+        self.running[name] = time
 
     def process_skipped(self, name: str):
+        self.running.pop(name, None)
         self.skipped_list.append(name)
 
     def process_finished(self, obj: CommandFinished, command_name: str, time: datetime):
+        self.total_finished += 1
+        if obj.cached:
+            # never started -- it took no time at all
+            self.total_cached += 1
+            self.start_time[command_name] = time
+            self.finished_list.append((obj, command_name, time))
+            return
         self.total_executing -= 1
+        self.running.pop(command_name, None)
         if obj.outputs.exit_code == 0:
             self.total_passed += 1
         else:
@@ -219,3 +303,49 @@ class OutputConsole:
 
     def reset(self):
         self.is_done = False
+
+
+@dataclass
+class LineReporter(OutputConsole):
+    """
+    Console for logs that aren't a terminal, e.g. CI -- prints a line for each command that finishes, rather than
+    redrawing a live display
+    """
+
+    def __enter__(self):
+        return self
+
+    def process_event(self, event: ClassifiedEvent):
+        super().process_event(event)
+        name = event.command_ref
+        if event.kind == "command.stdout":
+            if self.print_stdout:
+                smelt_console.print(
+                    stdout_text(cast(CommandStdout, event.payload)),
+                    markup=False,
+                    highlight=False,
+                )
+        elif event.kind == "command.finished":
+            result = result_text(cast(CommandFinished, event.payload))
+            started = self.start_time.get(name, event.time)
+            seconds = (event.time - started).total_seconds()
+            self._report(f"{name} {result} in {seconds:.2f}s")
+        elif event.kind in ("command.skipped", "command.cancelled"):
+            self._report(f"{name} {event.variant.upper()}")
+        elif event.kind == "command.killed":
+            self._report(f"{name} {killed_text(cast(CommandKilled, event.payload))}")
+
+    def _report(self, line: str):
+        done = self.total_finished + len(self.skipped_list)
+        smelt_console.print(
+            f"[{done}/{self.total_scheduled}] {line}", markup=False, highlight=False
+        )
+
+
+def console_for_output(print_stdout: bool = False) -> OutputConsole:
+    """
+    Live display if smelt is writing to a terminal, otherwise a `LineReporter`
+    """
+    if smelt_console.is_terminal:
+        return OutputConsole(print_stdout=print_stdout)
+    return LineReporter(print_stdout=print_stdout)
@@ -1,8 +1,7 @@
 from dataclasses import dataclass, field
-from typing import Dict, cast
-import betterproto
-from pysmelt.proto.smelt_telemetry import CommandEvent, CommandFinished, Event
-from pysmelt.proto.executed_tests import Invocation
+from typing import ClassVar, Dict, FrozenSet, cast
+from pysmelt.proto.smelt_telemetry import CommandFinished, Event
+from pysmelt.subscribers import ClassifiedEvent, process_filtered
 
 
 @dataclass
@@ -11,25 +10,15 @@ class RetcodeTracker:
     Simple subscriber that maps commands to their return codes
     """
 
+    event_kinds: ClassVar[FrozenSet[str]] = frozenset({"command.finished"})
     retcode_dict: Dict[str, int] = field(default_factory=dict)
 
     def process_message(self, message: Event):
-        (variant, event_payload) = betterproto.which_one_of(message, "et")
-        if variant == "command":
-            event_payload = cast(CommandEvent, event_payload)
-            (command_name, command_payload) = betterproto.which_one_of(
-                event_payload, "CommandVariant"
-            )
-
-            if command_name == "finished":
-                command_payload = cast(CommandFinished, command_payload)
-                self.retcode_dict[event_payload.command_ref] = (
-                    command_payload.outputs.exit_code
-                )
-            else:
-                pass
-        else:
-            pass
+        process_filtered(self, message)
+
+    def process_event(self, event: ClassifiedEvent):
+        command_payload = cast(CommandFinished, event.payload)
+        self.retcode_dict[event.command_ref] = command_payload.outputs.exit_code
 
     def total_executed(self) -> int:
         return len(self.retcode_dict.items())
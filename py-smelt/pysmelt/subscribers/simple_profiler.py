@@ -1,12 +1,11 @@
 from collections import defaultdict
 from dataclasses import dataclass, field
-from typing import DefaultDict, List, cast
-import betterproto
+from typing import ClassVar, DefaultDict, FrozenSet, List, cast
 from pysmelt.proto.smelt_telemetry import (
     CommandProfile,
-    CommandEvent,
     Event,
 )
+from pysmelt.subscribers import ClassifiedEvent, process_filtered
 
 
 @dataclass
@@ -15,22 +14,14 @@ class ProfileWatcher:
     Simple subscriber that prints the stdout for a single command
     """
 
+    event_kinds: ClassVar[FrozenSet[str]] = frozenset({"command.profile"})
     profile_events: DefaultDict[str, List[CommandProfile]] = field(
         default_factory=lambda: defaultdict(list)
     )
 
     def process_message(self, message: Event):
-        (variant, event_payload) = betterproto.which_one_of(message, "et")
-        if variant == "command":
-            event_payload = cast(CommandEvent, event_payload)
-            (command_name, command_payload) = betterproto.which_one_of(
-                event_payload, "CommandVariant"
-            )
-            if command_name == "profile":
-                profile = cast(CommandProfile, command_payload)
+        process_filtered(self, message)
 
-                self.profile_events[event_payload.command_ref].append(profile)
-            else:
-                pass
-        else:
-            pass
+    def process_event(self, event: ClassifiedEvent):
+        profile = cast(CommandProfile, event.payload)
+        self.profile_events[event.command_ref].append(profile)
@@ -1,39 +1,38 @@
 from collections import defaultdict
 from dataclasses import dataclass, field
-from typing import Callable, Dict, Optional, cast
-import betterproto
+from typing import Callable, ClassVar, FrozenSet, cast
 from pysmelt.proto.smelt_telemetry import (
-    CommandEvent,
-    CommandFinished,
     CommandStdout,
     Event,
 )
+from pysmelt.subscribers import ClassifiedEvent, process_filtered
 
 
 StdoutSink = Callable[[str], None]
 
 
+def stdout_text(stdout: CommandStdout) -> str:
+    """
+    Text to show for a stdout event -- either its output, or a note about how much output was dropped
+    """
+    if stdout.dropped_bytes:
+        return f"... {stdout.dropped_bytes} more bytes of output are in the command log"
+    return stdout.output
+
+
 @dataclass
 class StdoutPrinter:
     """
     Simple subscriber that prints the stdout for a single command
     """
 
+    event_kinds: ClassVar[FrozenSet[str]] = frozenset({"command.stdout"})
     command_ref: str
     sink: StdoutSink
 
     def process_message(self, message: Event):
-        (variant, event_payload) = betterproto.which_one_of(message, "et")
-        if variant == "command":
-            event_payload = cast(CommandEvent, event_payload)
-            (command_name, command_payload) = betterproto.which_one_of(
-                event_payload, "CommandVariant"
-            )
-            if command_name == "stdout":
-                command_payload = cast(CommandStdout, command_payload)
-                self.sink(command_payload.output)
-
-            else:
-                pass
-        else:
-            pass
+        process_filtered(self, message)
+
+    def process_event(self, event: ClassifiedEvent):
+        command_payload = cast(CommandStdout, event.payload)
+        self.sink(stdout_text(command_payload))
@@ -0,0 +1,134 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import FrozenSet, Optional, Tuple, cast
+
+from pysmelt.subscribers import ClassifiedEvent, EventDispatcher
+
+EVENT_QUEUE_SIZE = 10_000
+"""
+Number of events that can be waiting on the subscribers before we start dropping or blocking
+"""
+
+DROPPABLE_KINDS: FrozenSet[str] = frozenset({"command.stdout", "command.profile"})
+"""
+Events that are dropped when the queue is full -- everything else waits for room, since losing e.g. a
+"command.finished" would leave the subscribers with the wrong results
+"""
+
+_STOP = object()
+
+
+@dataclass
+class DispatchStats:
+    """
+    What happened to the events that went through a `ThreadedDispatcher`
+    """
+
+    dispatched: int = 0
+    dropped: int = 0
+    """
+    Droppable events that were thrown away, because the queue was full
+    """
+    late: int = 0
+    """
+    Events that reached the subscribers more than `late_after_s` after they were drained
+    """
+    max_depth: int = 0
+    """
+    Most events that were ever waiting in the queue at once
+    """
+
+
+class ThreadedDispatcher:
+    """
+    Runs an `EventDispatcher` on a worker thread, so slow subscribers can't hold up draining events from rust
+
+    Events are handed over through a bounded queue. A single worker keeps events in the order they arrived.
+    If a subscriber raises, the error is re-raised on the draining thread by the next `dispatch_classified`,
+    or by `close`
+    """
+
+    def __init__(
+        self,
+        dispatcher: EventDispatcher,
+        max_queued: int = EVENT_QUEUE_SIZE,
+        late_after_s: float = 1.0,
+    ):
+        self.dispatcher = dispatcher
+        self.late_after_s = late_after_s
+        self.stats = DispatchStats()
+        self._queue: "queue.Queue[object]" = queue.Queue(maxsize=max_queued)
+        self._error: Optional[BaseException] = None
+        self._worker = threading.Thread(
+            target=self._work, name="smelt-dispatch", daemon=True
+        )
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def depth(self) -> int:
+        """
+        Number of events currently waiting on the subscribers
+        """
+        return self._queue.qsize()
+
+    def start(self):
+        self._worker.start()
+
+    def dispatch_classified(self, event: ClassifiedEvent):
+        self._raise_if_failed()
+        item = (time.monotonic(), event)
+        if event.kind in DROPPABLE_KINDS:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self.stats.dropped += 1
+                return
+        else:
+            self._put_blocking(item)
+        self.stats.max_depth = max(self.stats.max_depth, self._queue.qsize())
+
+    def close(self):
+        """
+        Waits for every queued event to reach the subscribers, then stops the worker
+        """
+        if self._worker.is_alive():
+            self._put_blocking(_STOP)
+            self._worker.join()
+        self._raise_if_failed()
+
+    def _put_blocking(self, item: object):
+        while True:
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                # if the worker died, nobody is ever going to make room
+                self._raise_if_failed()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            (queued_at, event) = cast(Tuple[float, ClassifiedEvent], item)
+            if time.monotonic() - queued_at > self.late_after_s:
+                self.stats.late += 1
+            try:
+                self.dispatcher.dispatch_classified(event)
+            except BaseException as exc:
+                self._error = exc
+                return
+            self.stats.dispatched += 1
@@ -0,0 +1,223 @@
+"""
+Index of the targets in each testlist, for runs that only need a few of them
+
+`TargetIndex` maps a target reference -- `//path:target`, or a name local to the file that uses it -- to the file
+that defines it and its direct dependencies. Files are only loaded the first time a reference in to them is resolved,
+and each file's index is kept next to the testlist cache, with every command pickled on its own: resolving a target
+only unpickles the commands that are actually visited, no matter how large the testlist is
+"""
+
+import pathlib
+import pickle
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Set
+
+from pysmelt import testlist_cache
+from pysmelt.interfaces.command import Command
+from pysmelt.interfaces.paths import SmeltPath, TempTarget
+from pysmelt.interfaces.sweep import sweep_name
+from pysmelt.interfaces.target import TargetRef
+from pysmelt.rc import SmeltRcHolder
+from pysmelt.smelt_muncher import (
+    ImportTracker,
+    SmeltUniverse,
+    load_smelt_commands,
+)
+
+INDEX_DIR = "index"
+
+
+@dataclass
+class FileIndex:
+    """
+    Every target defined in one testlist
+    """
+
+    targets: Dict[str, bytes]
+    """
+    Each command, as a pickled `Command.to_tuple()`, by name
+    """
+    outputs: Dict[str, str]
+    """
+    The name of the command that declares each output
+    """
+    references: List[SmeltPath] = field(default_factory=list)
+    """
+    The other testlists that commands in this one depend on
+    """
+
+    @classmethod
+    def from_commands(cls, commands: Iterable[Command], file: SmeltPath) -> "FileIndex":
+        targets = {}
+        outputs = {}
+        references: Set[SmeltPath] = set()
+        for command in commands:
+            targets[command.name] = pickle.dumps(
+                command.to_tuple(), protocol=pickle.HIGHEST_PROTOCOL
+            )
+            for output in command.outputs:
+                outputs[output] = command.name
+            for dep in command.dependencies:
+                references.add(_target_file(dep, file))
+        references.discard(SmeltPath.from_str(file.to_abs_path()))
+        return cls(
+            targets=targets, outputs=outputs, references=sorted(references, key=str)
+        )
+
+    def command(self, name: str) -> Command:
+        return Command.from_tuple(pickle.loads(self.targets[name]))
+
+
+def _target_file(ref: TargetRef, current_file: SmeltPath) -> SmeltPath:
+    target = TempTarget.parse_string_smelt_target(ref, current_file.to_abs_path())
+    return SmeltPath.from_str(target.file_path.to_abs_path())
+
+
+def load_file_index(file: SmeltPath, default_rules_only: bool = False) -> FileIndex:
+    """
+    Index of `file` -- read from smelt-out when neither the testlist nor the rules have changed, otherwise built from
+    its lowered commands
+    """
+    abs_path = file.to_abs_path()
+    if (
+        not SmeltRcHolder.current_rc().testlist_cache
+        or pathlib.Path(abs_path).suffix == ".py"
+    ):
+        return FileIndex.from_commands(
+            load_smelt_commands(file, default_rules_only), file
+        )
+
+    content = pathlib.Path(abs_path).read_bytes()
+    key = testlist_cache.cache_key(abs_path, content, default_rules_only)
+    directory = testlist_cache.cache_dir() / INDEX_DIR
+    index = testlist_cache.load_cached(key, directory)
+    if index is None:
+        index = FileIndex.from_commands(
+            load_smelt_commands(file, default_rules_only), file
+        )
+        testlist_cache.store(key, index, directory)
+    return index
+
+
+class UnresolvedTarget(RuntimeError):
+    """
+    A target that can't be found by following references alone
+    """
+
+
+@dataclass
+class TargetIndex:
+    """
+    Resolves target references lazily -- see the module docs
+    """
+
+    default_rules_only: bool = False
+    files: Dict[SmeltPath, FileIndex] = field(default_factory=dict)
+
+    def file_index(self, file: SmeltPath) -> FileIndex:
+        if file not in self.files:
+            self.files[file] = load_file_index(file, self.default_rules_only)
+            # nothing that was imported along the way is needed -- only referenced files are loaded
+            ImportTracker.clear()
+        return self.files[file]
+
+    def resolve(self, ref: TargetRef, current_file: SmeltPath) -> TempTarget:
+        """
+        The target that `ref` names -- for an instance of a sweep, e.g. `regress[seed=2]`, that's the sweep itself,
+        since only the sweep is in the testlist; the graph expands it and runs the instance by its full name
+        """
+        target = TempTarget.parse_string_smelt_target(ref, current_file.to_abs_path())
+        file = _target_file(ref, current_file)
+        index = self.file_index(file)
+        name = target.name
+        if name not in index.targets:
+            name = sweep_name(name)
+            if name not in index.targets or index.command(name).sweep is None:
+                raise UnresolvedTarget(f"{ref} is not defined in {file}")
+        return TempTarget(name=name, file_path=file)
+
+    def command(self, target: TempTarget) -> Command:
+        return self.file_index(target.file_path).command(target.name)
+
+    def dependencies(self, target: TempTarget) -> List[TempTarget]:
+        """
+        Targets that `target` directly depends on -- by name, or through a file it requires
+        """
+        command = self.command(target)
+        deps = [self.resolve(dep, target.file_path) for dep in command.dependencies]
+        for required in command.dependent_files:
+            deps.append(self.producer(required))
+        return deps
+
+    def producer(self, output: str) -> TempTarget:
+        """
+        The target that declares `output` -- looked for in the files that are already indexed first, and only then in
+        the rest of the testlists they reach, since a required file can come from a testlist no target names
+        """
+        rv = self._indexed_producer(output)
+        if rv is None:
+            self.index_reachable()
+            rv = self._indexed_producer(output)
+        if rv is None:
+            raise UnresolvedTarget(f"No testlist declares {output}")
+        return rv
+
+    def _indexed_producer(self, output: str) -> Optional[TempTarget]:
+        for file, index in self.files.items():
+            if output in index.outputs:
+                return TempTarget(name=index.outputs[output], file_path=file)
+        return None
+
+    def index_reachable(self):
+        """
+        Indexes every testlist that the indexed ones reach through their dependencies
+        """
+        pending = list(self.files)
+        while pending:
+            for file in self.files[pending.pop()].references:
+                if file not in self.files:
+                    self.file_index(file)
+                    pending.append(file)
+
+    def closure(
+        self, refs: Iterable[TargetRef], current_file: SmeltPath
+    ) -> Dict[SmeltPath, List[Command]]:
+        """
+        Commands for `refs` and everything they transitively depend on, by file
+        """
+        current_file = SmeltPath.from_str(current_file.to_abs_path())
+        pending = [self.resolve(ref, current_file) for ref in refs]
+        seen: Set[TempTarget] = set()
+        while pending:
+            target = pending.pop()
+            if target not in seen:
+                seen.add(target)
+                pending.extend(self.dependencies(target))
+
+        seen_names: Dict[SmeltPath, Set[str]] = {}
+        for target in seen:
+            seen_names.setdefault(target.file_path, set()).add(target.name)
+        commands: Dict[SmeltPath, List[Command]] = {}
+        for file, names in seen_names.items():
+            index = self.files[file]
+            # in testlist order, like a full universe
+            commands[file] = [
+                index.command(name) for name in index.targets if name in names
+            ]
+        return commands
+
+
+def create_target_universe(
+    starting_file: SmeltPath,
+    target_names: Iterable[TargetRef],
+    default_rules_only: bool = False,
+) -> SmeltUniverse:
+    """
+    Same as `create_universe`, but only holds `target_names` and what they depend on -- only the testlists they
+    reference are loaded, plus whichever testlists have to be indexed to find the producer of a required file
+
+    Raises `UnresolvedTarget` if a target isn't defined where it is referenced, or no reachable testlist declares a
+    file that one of them requires
+    """
+    commands = TargetIndex(default_rules_only).closure(target_names, starting_file)
+    return SmeltUniverse(top_file=starting_file, commands=commands)
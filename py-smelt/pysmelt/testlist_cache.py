@@ -0,0 +1,164 @@
+"""
+On disk cache of lowered testlists
+
+A yaml testlist always lowers to the same commands, as long as neither its content nor the rules it uses have
+changed -- so we keep the lowered `Command` list for each testlist under `smelt-out/.testlist_cache`, keyed by a hash
+of the testlist content, where it lives, a fingerprint of every rule module that could be used, and a fingerprint of
+pysmelt itself, so that entries written by any other version of pysmelt are never read
+
+Procedural testlists are only cached once they `declare_inputs` -- their entry also records a digest of each input,
+and is only used while every input is unchanged
+"""
+
+import contextlib
+import functools
+import hashlib
+import os
+import pathlib
+import pickle
+import tempfile
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import pysmelt
+from pysmelt.importer import get_all_files
+from pysmelt.interfaces.command import Command
+from pysmelt.interfaces.paths import SmeltPath
+from pysmelt.rc import SmeltRcHolder
+
+CACHE_DIR = ".testlist_cache"
+
+PROCEDURAL_DIR = "procedural"
+
+
+@dataclass
+class ProceduralEntry:
+    inputs: Dict[str, Optional[str]]
+    """
+    sha256 of every input the testlist declared, by absolute path -- None if it didn't exist
+    """
+    commands: List[Command]
+    imported: Dict[SmeltPath, List[Command]]
+    """
+    Commands of the testlists the script pulled in with `import_as_target`
+    """
+
+
+def cache_dir() -> pathlib.Path:
+    return pathlib.Path(SmeltRcHolder.current_smelt_root()) / "smelt-out" / CACHE_DIR
+
+
+@functools.lru_cache(maxsize=None)
+def package_fingerprint() -> str:
+    """
+    Hash of every module in pysmelt -- the shape of `Command`, the default rules and the way targets are lowered all
+    live there, so any change to them is a change to this
+    """
+    package_dir = pathlib.Path(pysmelt.__file__).parent
+    hasher = hashlib.sha256()
+    for path in sorted(package_dir.rglob("*.py")):
+        hasher.update(path.relative_to(package_dir).as_posix().encode())
+        hasher.update(b"\0")
+        hasher.update(path.read_bytes())
+    return hasher.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _fingerprint_files(files: Tuple[Tuple[str, int, int], ...]) -> str:
+    hasher = hashlib.sha256()
+    for path, _, _ in files:
+        hasher.update(path.encode())
+        hasher.update(pathlib.Path(path).read_bytes())
+    return hasher.hexdigest()
+
+
+def rules_fingerprint(default_rules_only: bool) -> str:
+    """
+    Hash of every rule module in the rules dir, or of none with `default_rules_only` -- the default rules are covered by
+    `package_fingerprint`
+
+    Rule files are only re-read when their size or mtime changes
+    """
+    if default_rules_only:
+        return _fingerprint_files(())
+    rules = sorted(get_all_files(SmeltRcHolder.current_rc().abs_rules_dir))
+    stats = [(str(path), path.stat()) for path in rules]
+    return _fingerprint_files(
+        tuple((path, stat.st_mtime_ns, stat.st_size) for path, stat in stats)
+    )
+
+
+def cache_key(abs_path: str, content: bytes, default_rules_only: bool) -> str:
+    hasher = hashlib.sha256()
+    for part in (
+        package_fingerprint(),
+        abs_path,
+        SmeltRcHolder.current_smelt_root(),
+        rules_fingerprint(default_rules_only),
+    ):
+        hasher.update(part.encode())
+        hasher.update(b"\0")
+    hasher.update(content)
+    return hasher.hexdigest()
+
+
+def load_cached(key: str, directory: Optional[pathlib.Path] = None) -> Optional[Any]:
+    """
+    The lowered commands stored under `key` -- or whatever was stored in `directory`, if given
+    """
+    try:
+        with open((directory or cache_dir()) / key, "rb") as cached:
+            return pickle.load(cached)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        # a truncated or stale entry is just a miss -- it gets overwritten on the next store
+        return None
+
+
+def store(key: str, commands: Any, directory: Optional[pathlib.Path] = None):
+    directory = directory or cache_dir()
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+        # written to a temp file first, so concurrent loads never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+    except OSError:
+        # the cache is best effort -- e.g. smelt-out might be read only
+        return
+    stored = False
+    try:
+        with os.fdopen(fd, "wb") as outfile:
+            pickle.dump(commands, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, directory / key)
+        stored = True
+    except (OSError, pickle.PicklingError, TypeError, AttributeError):
+        # pickle raises TypeError or AttributeError, rather than PicklingError, for some objects it can't pickle
+        pass
+    finally:
+        # whatever went wrong, the temp file never outlives the call
+        if not stored:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+
+
+def input_digests(paths: Iterable[str]) -> Dict[str, Optional[str]]:
+    digests: Dict[str, Optional[str]] = {}
+    for path in paths:
+        try:
+            digests[path] = hashlib.sha256(pathlib.Path(path).read_bytes()).hexdigest()
+        except OSError:
+            digests[path] = None
+    return digests
+
+
+def load_procedural(key: str) -> Optional[ProceduralEntry]:
+    entry = load_cached(key, cache_dir() / PROCEDURAL_DIR)
+    if not isinstance(entry, ProceduralEntry):
+        return None
+    if input_digests(entry.inputs) != entry.inputs:
+        return None
+    return entry
+
+
+def store_procedural(key: str, entry: ProceduralEntry):
+    store(key, entry, cache_dir() / PROCEDURAL_DIR)
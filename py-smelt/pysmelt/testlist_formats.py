@@ -0,0 +1,221 @@
+"""
+Readers for the formats a testlist can be written in
+
+Every format is read in to a `TestlistColumns`, which is validated in one go rather than a model per target:
+
+* yaml (the default) -- read with libyaml's loader when pyyaml was built with it
+* json -- `*.json`, the same list of `{name, rule, rule_args}` entries as yaml
+* columnar -- `*.smeltc`, a binary file of equal length columns, for generated testlists that are too large to
+  parse quickly. It only ever holds data -- strings and json -- so reading one can't run code. See `dump_columnar`
+"""
+
+import json
+import pathlib
+import struct
+import sys
+from array import array
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Union
+
+import yaml
+from pydantic import TypeAdapter
+from typing_extensions import NotRequired, TypedDict
+
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+"""
+libyaml's loader if pyyaml has it, otherwise the pure python one
+"""
+
+JSON_SUFFIX = ".json"
+
+COLUMNAR_SUFFIX = ".smeltc"
+
+COLUMNAR_MAGIC = b"SMELTC\0\0"
+
+COLUMNAR_VERSION = 2
+"""
+Version 1 was a pickle, and is no longer read
+"""
+
+_HEADER = struct.Struct("<8sII")
+"""
+magic, version, number of targets
+"""
+
+_U32 = struct.Struct("<I")
+
+
+class _TargetEntry(TypedDict):
+    name: str
+    rule: str
+    rule_args: NotRequired[Dict[str, Any]]
+
+
+class _Columns(TypedDict):
+    version: int
+    names: List[str]
+    rules: List[str]
+    rule_args: List[Dict[str, Any]]
+
+
+_entries_adapter = TypeAdapter(List[_TargetEntry])
+_columns_adapter = TypeAdapter(_Columns)
+
+
+@dataclass
+class TestlistColumns:
+    """
+    Every target in a testlist, one list per field -- `names[i]` is declared with `rules[i]` and `rule_args[i]`
+    """
+
+    names: List[str]
+    rules: List[str]
+    rule_args: List[Dict[str, Any]]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @classmethod
+    def from_entries(cls, raw_entries: Optional[List[Any]]) -> "TestlistColumns":
+        entries = _entries_adapter.validate_python(raw_entries or [])
+        return cls(
+            names=[entry["name"] for entry in entries],
+            rules=[entry["rule"] for entry in entries],
+            rule_args=[entry.get("rule_args", {}) for entry in entries],
+        )
+
+
+def load_yaml(content: Union[str, bytes]) -> TestlistColumns:
+    return TestlistColumns.from_entries(yaml.load(content, Loader=SafeLoader))
+
+
+def load_json(content: Union[str, bytes]) -> TestlistColumns:
+    return TestlistColumns.from_entries(json.loads(content))
+
+
+class _ColumnReader:
+    """
+    Reads the sections of a columnar testlist in order, checking each against what is left of the file
+    """
+
+    def __init__(self, content: bytes):
+        self.content = memoryview(content)
+        self.offset = 0
+
+    def take(self, size: int) -> memoryview:
+        if size < 0 or self.offset + size > len(self.content):
+            raise RuntimeError("Columnar testlist is truncated")
+        section = self.content[self.offset : self.offset + size]
+        self.offset += size
+        return section
+
+    def u32s(self, count: int) -> array:
+        values = array("I")
+        if values.itemsize != 4:
+            values = array("L")
+        values.frombytes(self.take(count * 4))
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    def strings(self) -> List[str]:
+        (count,) = _U32.unpack(self.take(_U32.size))
+        lengths = self.u32s(count)
+        blob = bytes(self.take(sum(lengths)))
+        strings = []
+        offset = 0
+        for length in lengths:
+            strings.append(blob[offset : offset + length].decode())
+            offset += length
+        return strings
+
+
+def _pack_u32s(values: List[int]) -> bytes:
+    packed = array("I", values) if array("I").itemsize == 4 else array("L", values)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _pack_strings(strings: List[str]) -> bytes:
+    encoded = [string.encode() for string in strings]
+    return (
+        _U32.pack(len(encoded))
+        + _pack_u32s([len(string) for string in encoded])
+        + b"".join(encoded)
+    )
+
+
+def load_columnar(content: bytes) -> TestlistColumns:
+    if len(content) < _HEADER.size:
+        raise RuntimeError("Columnar testlist is truncated")
+    magic, version, count = _HEADER.unpack_from(content)
+    if magic != COLUMNAR_MAGIC:
+        raise RuntimeError(
+            "Not a columnar testlist -- testlists from smelt versions that pickled them need to be written again"
+        )
+    if version != COLUMNAR_VERSION:
+        raise RuntimeError(
+            f"Columnar testlist is version {version}, smelt reads version {COLUMNAR_VERSION}"
+        )
+    reader = _ColumnReader(content)
+    reader.take(_HEADER.size)
+    names = reader.strings()
+    # rules are dictionary encoded -- a testlist usually has a handful of rules across every target
+    rule_table = reader.strings()
+    rule_codes = reader.u32s(count)
+    if any(code >= len(rule_table) for code in rule_codes):
+        raise RuntimeError("Columnar testlist refers to a rule it doesn't have")
+    (args_size,) = _U32.unpack(reader.take(_U32.size))
+    rule_args = json.loads(bytes(reader.take(args_size)))
+    if reader.offset != len(content):
+        raise RuntimeError("Columnar testlist has trailing data")
+    if not isinstance(rule_args, list) or len({len(names), count, len(rule_args)}) != 1:
+        raise RuntimeError("Columnar testlist has columns of different lengths")
+
+    columns = _columns_adapter.validate_python(
+        {
+            "version": version,
+            "names": names,
+            "rules": [rule_table[code] for code in rule_codes],
+            "rule_args": rule_args,
+        }
+    )
+    return TestlistColumns(
+        names=columns["names"], rules=columns["rules"], rule_args=columns["rule_args"]
+    )
+
+
+def load_testlist(path: str) -> TestlistColumns:
+    """
+    Reads a testlist in whichever format its suffix says it is in
+    """
+    content = pathlib.Path(path).read_bytes()
+    suffix = pathlib.Path(path).suffix
+    if suffix == COLUMNAR_SUFFIX:
+        return load_columnar(content)
+    if suffix == JSON_SUFFIX:
+        return load_json(content)
+    return load_yaml(content)
+
+
+def dump_columnar(columns: TestlistColumns, path: str):
+    """
+    Writes `columns` as a columnar testlist -- `path` should end in `COLUMNAR_SUFFIX`
+
+    The file is a header (`COLUMNAR_MAGIC`, version and number of targets, as little endian u32s), then:
+
+    * names -- a count, the utf-8 length of every name, and the names back to back
+    * rules -- every distinct rule, laid out like the names, then the index of each target's rule
+    * rule_args -- the length of, then a json array with one object per target
+    """
+    rule_table = sorted(set(columns.rules))
+    codes = {rule: code for code, rule in enumerate(rule_table)}
+    rule_args = json.dumps(columns.rule_args, separators=(",", ":")).encode()
+    with open(path, "wb") as outfile:
+        outfile.write(_HEADER.pack(COLUMNAR_MAGIC, COLUMNAR_VERSION, len(columns)))
+        outfile.write(_pack_strings(columns.names))
+        outfile.write(_pack_strings(rule_table))
+        outfile.write(_pack_u32s([codes[rule] for rule in columns.rules]))
+        outfile.write(_U32.pack(len(rule_args)))
+        outfile.write(rule_args)
@@ -1,7 +1,11 @@
 use smelt_core::SmeltErr;
-use smelt_data::client_commands::{client_resp::ClientResponses, ClientCommand, ClientResp};
+use smelt_data::client_commands::{
+    client_resp::ClientResponses, ClientCommand, ClientResp, CommandDef, CommandRuntime,
+    EventSubscription, SweepAxisDef, SweepDef,
+};
 use smelt_data::{client_commands::ConfigureSmelt, Event};
 
+mod native;
 mod telemetry;
 use telemetry::{get_subscriber, init_subscriber};
 
@@ -9,19 +13,98 @@ use std::sync::Once;
 
 static START: Once = Once::new();
 
+/// `Command.to_tuple()` on the python side:
+/// `(name, target_type, script, dependent_files, dependencies, outputs, runtime, working_dir,
+/// sweep)`
+type CommandTuple = (
+    String,
+    String,
+    Vec<String>,
+    Vec<String>,
+    Vec<String>,
+    Vec<String>,
+    RuntimeTuple,
+    String,
+    Option<Vec<SweepAxisTuple>>,
+);
+
+/// `(num_cpus, max_memory_mb, timeout, env)`
+type RuntimeTuple = (u32, u32, u32, HashMap<String, String>);
+
+/// `(name, values, start, stop, step)` -- an empty `values` sweeps the range
+type SweepAxisTuple = (String, Vec<String>, i64, i64, i64);
+
+fn command_def(command: CommandTuple) -> CommandDef {
+    let (
+        name,
+        target_type,
+        script,
+        dependent_files,
+        dependencies,
+        outputs,
+        runtime,
+        working_dir,
+        sweep,
+    ) = command;
+    let (num_cpus, max_memory_mb, timeout, env) = runtime;
+    CommandDef {
+        name,
+        target_type,
+        script,
+        dependent_files,
+        dependencies,
+        outputs,
+        runtime: Some(CommandRuntime {
+            num_cpus,
+            max_memory_mb,
+            timeout,
+            env,
+            command_run_dir: String::new(),
+        }),
+        working_dir,
+        sweep: sweep.map(|axes| SweepDef {
+            axes: axes
+                .into_iter()
+                .map(|(name, values, start, stop, step)| SweepAxisDef {
+                    name,
+                    values,
+                    start,
+                    stop,
+                    step,
+                })
+                .collect(),
+        }),
+    }
+}
+
+/// Size of the channel that sits between the wakeup forwarder and python
+const EVENT_FORWARD_SIZE: usize = 100;
+
 // run initialization here
 
 use prost::Message;
 use pyo3::{
     exceptions::PyRuntimeError,
     prelude::*,
-    types::{PyBytes, PyType},
+    types::{PyBytes, PyList, PyType},
+};
+use smelt_events::{
+    ChannelStats, ClientCommandBundle, ClientCommandResp, EventBuffer, EventReceiver, EventStreams,
+    Overflow,
 };
-use smelt_events::{ClientCommandBundle, ClientCommandResp, EventStreams};
 use smelt_graph::{spawn_graph_server, SmeltServerHandle};
 
-use std::sync::Arc;
-use tokio::sync::mpsc::{error::TryRecvError, Receiver, UnboundedSender};
+use std::{
+    collections::HashMap,
+    io::Write,
+    os::unix::{io::AsRawFd, net::UnixStream},
+    sync::Arc,
+    time::Duration,
+};
+use tokio::{
+    runtime::{Builder, Handle, Runtime},
+    sync::mpsc::{error::TryRecvError, UnboundedSender},
+};
 
 pub fn arc_err_to_py(smelt_err: Arc<SmeltErr>) -> PyErr {
     let smelt_string = smelt_err.to_string();
@@ -39,21 +122,55 @@ fn pysmelt(_py: Python, m: Bound<'_, PyModule>) -> PyResult<()> {
 #[pyclass]
 pub struct PyController {
     handle: SmeltServerHandle,
+    /// Channel that each run streams its events back through
+    event_buffer: EventBuffer,
 }
 
 #[pyclass]
 pub struct PyEventStream {
-    recv_chan: Receiver<Event>,
+    recv_chan: EventReceiver,
+    /// Counters for the channel from the graph server -- `recv_chan` is swapped out by `wakeup_fd`
+    stats: Arc<ChannelStats>,
     done: bool,
+    /// Single threaded runtime that is only used to wait on `recv_chan` with a timeout
+    waiter: Runtime,
+    /// Handle to the graph server runtime, used to spawn the wakeup forwarder
+    server_rt: Handle,
+    /// Read end of the socket pair that gets a byte written to it whenever an event arrives
+    wakeup: Option<UnixStream>,
 }
 
 impl PyEventStream {
-    pub(crate) fn create_subscriber(recv_chan: Receiver<Event>) -> Self {
+    pub(crate) fn create_subscriber(recv_chan: EventReceiver, server_rt: Handle) -> Self {
+        let waiter = Builder::new_current_thread()
+            .enable_time()
+            .build()
+            .expect("Could not create the runtime for the event stream");
         Self {
+            stats: recv_chan.stats_handle(),
             recv_chan,
             done: false,
+            waiter,
+            server_rt,
+            wakeup: None,
+        }
+    }
+}
+
+/// Forwards every event from `upstream` to `downstream`, poking `wakeup` after each one
+async fn forward_with_wakeup(
+    mut upstream: EventReceiver,
+    downstream: smelt_events::EventQueue,
+    mut wakeup: UnixStream,
+) {
+    while let Some(event) = upstream.recv().await {
+        if downstream.send(event).await.is_err() {
+            break;
         }
+        // If the socket buffer is full, the reader has plenty of wakeups queued up already
+        let _ = wakeup.write(&[1]);
     }
+    // dropping the writer closes the socket, which wakes the reader up one last time
 }
 
 fn client_channel_err(_in_err: impl std::error::Error) -> PyErr {
@@ -75,8 +192,9 @@ fn handle_client_resp(
 fn submit_message(
     tx_client: &UnboundedSender<ClientCommandBundle>,
     message: ClientCommand,
+    buffer: &EventBuffer,
 ) -> Result<EventStreams, PyErr> {
-    let (bundle, recv) = ClientCommandBundle::from_message(message);
+    let (bundle, recv) = ClientCommandBundle::with_buffer(message, buffer);
 
     tx_client.send(bundle).map_err(client_channel_err)?;
     Ok(recv)
@@ -94,34 +212,100 @@ impl PyController {
             let subscriber = get_subscriber("smelt".into(), "info".into(), std::io::stdout);
             init_subscriber(subscriber);
         });
+        let event_buffer = EventBuffer::from_cfg(&cfg);
         let handle = spawn_graph_server(cfg);
-        Ok(PyController { handle })
+        Ok(PyController {
+            handle,
+            event_buffer,
+        })
     }
 
     pub fn set_graph(&self, graph: String) -> PyResult<()> {
-        let EventStreams { sync_chan, .. } =
-            submit_message(&self.handle.tx_client, ClientCommand::send_graph(graph))?;
+        let EventStreams { sync_chan, .. } = submit_message(
+            &self.handle.tx_client,
+            ClientCommand::send_graph(graph),
+            &self.event_buffer,
+        )?;
 
         let resp = sync_chan.blocking_recv();
         handle_client_resp(resp).map(|_| ())
     }
 
-    pub fn run_all_tests(&self, tt: String) -> PyResult<PyEventStream> {
-        self.run_tests(ClientCommand::execute_type(tt))
+    /// Same as `set_graph`, but takes `Command.to_tuple()` for every command, rather than a yaml
+    /// document -- the commands are handed to the graph as they are, without being serialized
+    pub fn set_graph_structured(
+        &self,
+        py: Python<'_>,
+        commands: Vec<CommandTuple>,
+    ) -> PyResult<()> {
+        py.allow_threads(|| {
+            let defs = commands.into_iter().map(command_def).collect();
+            let EventStreams { sync_chan, .. } = submit_message(
+                &self.handle.tx_client,
+                ClientCommand::send_command_defs(defs),
+                &self.event_buffer,
+            )?;
+            handle_client_resp(sync_chan.blocking_recv()).map(|_| ())
+        })
+    }
+
+    /// Adds, replaces and removes commands by name, leaving every other command in the graph as it
+    /// is -- commands are given as `Command.to_tuple()`, like `set_graph_structured`
+    pub fn update_graph(
+        &self,
+        py: Python<'_>,
+        add: Vec<CommandTuple>,
+        replace: Vec<CommandTuple>,
+        remove: Vec<String>,
+    ) -> PyResult<()> {
+        py.allow_threads(|| {
+            let EventStreams { sync_chan, .. } = submit_message(
+                &self.handle.tx_client,
+                ClientCommand::update_commands(
+                    add.into_iter().map(command_def).collect(),
+                    replace.into_iter().map(command_def).collect(),
+                    remove,
+                ),
+                &self.event_buffer,
+            )?;
+            handle_client_resp(sync_chan.blocking_recv()).map(|_| ())
+        })
+    }
+
+    /// `subscription` is an optional serialized `EventSubscription` -- if given, only the events
+    /// it asks for are streamed back
+    #[pyo3(signature = (tt, subscription=None))]
+    pub fn run_all_tests(
+        &self,
+        tt: String,
+        subscription: Option<Vec<u8>>,
+    ) -> PyResult<PyEventStream> {
+        self.run_tests(ClientCommand::execute_type(tt), subscription)
     }
 
-    pub fn run_one_test(&self, test: String) -> PyResult<PyEventStream> {
-        self.run_tests(ClientCommand::execute_command(test))
+    #[pyo3(signature = (test, subscription=None))]
+    pub fn run_one_test(
+        &self,
+        test: String,
+        subscription: Option<Vec<u8>>,
+    ) -> PyResult<PyEventStream> {
+        self.run_tests(ClientCommand::execute_command(test), subscription)
     }
 
-    pub fn run_many_tests(&self, tests: Vec<String>) -> PyResult<PyEventStream> {
-        self.run_tests(ClientCommand::execute_many(tests))
+    #[pyo3(signature = (tests, subscription=None))]
+    pub fn run_many_tests(
+        &self,
+        tests: Vec<String>,
+        subscription: Option<Vec<u8>>,
+    ) -> PyResult<PyEventStream> {
+        self.run_tests(ClientCommand::execute_many(tests), subscription)
     }
 
     pub fn get_current_cfg<'py>(&self, py: Python<'py>) -> PyResult<Bound<'py, PyBytes>> {
         let command = ClientCommand::get_cfg();
         let EventStreams { sync_chan, .. } =
-            submit_message(&self.handle.tx_client, command).map_err(client_channel_err)?;
+            submit_message(&self.handle.tx_client, command, &self.event_buffer)
+                .map_err(client_channel_err)?;
         let resp = sync_chan.blocking_recv();
         handle_client_resp(resp).map(|val| match val.client_responses.unwrap() {
             ClientResponses::CurrentCfg(a) => to_bytes(a, py),
@@ -131,10 +315,23 @@ impl PyController {
 }
 
 impl PyController {
-    fn run_tests(&self, command: ClientCommand) -> PyResult<PyEventStream> {
+    fn run_tests(
+        &self,
+        command: ClientCommand,
+        subscription: Option<Vec<u8>>,
+    ) -> PyResult<PyEventStream> {
+        let subscription = subscription
+            .map(|val| EventSubscription::decode(val.as_slice()))
+            .transpose()
+            .map_err(|err| PyRuntimeError::new_err(format!("Malformed subscription: {err}")))?;
+        let command = command.with_subscription(subscription);
         let EventStreams { event_stream, .. } =
-            submit_message(&self.handle.tx_client, command).map_err(client_channel_err)?;
-        Ok(PyEventStream::create_subscriber(event_stream))
+            submit_message(&self.handle.tx_client, command, &self.event_buffer)
+                .map_err(client_channel_err)?;
+        Ok(PyEventStream::create_subscriber(
+            event_stream,
+            self.handle.rt_handle.clone(),
+        ))
     }
 }
 
@@ -148,9 +345,8 @@ fn to_bytes<M: Message>(message: M, py: Python<'_>) -> Bound<'_, PyBytes> {
 #[pymethods]
 impl PyEventStream {
     pub fn pop_message_blocking<'py>(&mut self, py: Python<'py>) -> PyResult<Bound<'py, PyBytes>> {
-        let val = self
-            .recv_chan
-            .blocking_recv()
+        let val = py
+            .allow_threads(|| self.recv_chan.blocking_recv())
             .ok_or_else(|| PyRuntimeError::new_err("Event channel closed"))?;
         self.set_done(&val);
 
@@ -176,6 +372,90 @@ impl PyEventStream {
         }
     }
 
+    /// Pops up to `max_events` encoded events, waiting at most `timeout_ms` for the first one
+    ///
+    /// The GIL is released while we wait, so other python threads keep running. An empty list
+    /// means that nothing arrived before the timeout, or that the channel has been closed
+    pub fn pop_batch<'py>(
+        &mut self,
+        py: Python<'py>,
+        max_events: usize,
+        timeout_ms: u64,
+    ) -> PyResult<Bound<'py, PyList>> {
+        let encoded: Vec<Vec<u8>> = py.allow_threads(|| {
+            self.recv_batch(max_events, timeout_ms)
+                .iter()
+                .map(Message::encode_to_vec)
+                .collect()
+        });
+
+        Ok(PyList::new_bound(
+            py,
+            encoded.iter().map(|val| PyBytes::new_bound(py, val)),
+        ))
+    }
+
+    /// Same as `pop_batch`, but each event comes back as a plain tuple instead of encoded bytes
+    ///
+    /// See `native::event_to_py` for the layout -- this skips encoding the events here and
+    /// decoding them again in python
+    pub fn pop_batch_native<'py>(
+        &mut self,
+        py: Python<'py>,
+        max_events: usize,
+        timeout_ms: u64,
+    ) -> PyResult<Bound<'py, PyList>> {
+        let events = py.allow_threads(|| self.recv_batch(max_events, timeout_ms));
+
+        Ok(PyList::new_bound(
+            py,
+            events
+                .into_iter()
+                .map(|event| native::event_to_py(py, event)),
+        ))
+    }
+
+    /// Returns a file descriptor that becomes readable whenever a new event is ready
+    ///
+    /// This lets an event loop (e.g. asyncio's `add_reader`) sleep until there's work to do. The
+    /// descriptor hits EOF once the event stream has closed. Reading from it is the caller's job
+    pub fn wakeup_fd(&mut self) -> PyResult<i32> {
+        if let Some(ref reader) = self.wakeup {
+            return Ok(reader.as_raw_fd());
+        }
+        let (reader, writer) = UnixStream::pair()?;
+        reader.set_nonblocking(true)?;
+        writer.set_nonblocking(true)?;
+
+        let (tx, rx) = EventBuffer {
+            capacity: EVENT_FORWARD_SIZE,
+            overflow: Overflow::Block,
+        }
+        .channel();
+        let upstream = std::mem::replace(&mut self.recv_chan, rx);
+        self.server_rt
+            .spawn(forward_with_wakeup(upstream, tx, writer));
+
+        let fd = reader.as_raw_fd();
+        self.wakeup = Some(reader);
+        Ok(fd)
+    }
+
+    /// Counters for the channel that carries this stream's events
+    ///
+    /// `blocked_us` is how long running commands spent waiting for us to read events -- if it
+    /// is large, the subscribers are slowing the run down
+    pub fn channel_stats(&self) -> HashMap<&'static str, u64> {
+        let stats = self.stats.snapshot();
+        HashMap::from([
+            ("sent", stats.sent),
+            ("dropped", stats.dropped),
+            ("spilled", stats.spilled),
+            ("blocked_sends", stats.blocked_sends),
+            ("blocked_us", stats.blocked_us),
+        ])
+    }
+
     /// Returns true if we've seen a entire Invocation complete end to end AND the channel has
     /// been closed
     pub fn is_done(&mut self, _py: Python<'_>) -> bool {
@@ -189,4 +469,33 @@ impl PyEventStream {
             self.done = true;
         }
     }
+
+    /// Waits up to `timeout_ms` for an event, and then takes every event that is already queued
+    /// up, up to `max_events` in total
+    fn recv_batch(&mut self, max_events: usize, timeout_ms: u64) -> Vec<Event> {
+        let mut events = Vec::new();
+        if max_events == 0 {
+            return events;
+        }
+
+        let recv_chan = &mut self.recv_chan;
+        let first = self.waiter.block_on(async {
+            tokio::time::timeout(Duration::from_millis(timeout_ms), recv_chan.recv()).await
+        });
+
+        if let Ok(Some(event)) = first {
+            events.push(event);
+            while events.len() < max_events {
+                match self.recv_chan.try_recv() {
+                    Ok(event) => events.push(event),
+                    Err(_) => break,
+                }
+            }
+        }
+
+        for event in events.iter() {
+            self.set_done(event);
+        }
+        events
+    }
 }
@@ -0,0 +1,106 @@
+//! Converts events straight in to python tuples
+//!
+//! Encoding every event with prost and then decoding it again with betterproto is the most
+//! expensive part of streaming events to python -- these tuples skip that round trip, and are
+//! turned back in to typed events on the python side (see `pysmelt.subscribers.classify_native`)
+use pyo3::prelude::*;
+use smelt_data::{
+    command_event::CommandVariant,
+    event::Et,
+    executed_tests::{artifact_pointer::Pointer, Digest},
+    invoke_event::InvokeVariant,
+    Event,
+};
+
+/// Converts an event in to `(kind, trace_id, secs, nanos, command_ref, payload)`
+///
+/// `kind` is the same as `ClassifiedEvent.kind` on the python side, e.g. "command.finished".
+/// `payload` holds the fields of the innermost message, in proto field order:
+///
+/// * command.finished: `(exit_code, [(artifact_name, path, cas_hash)], cached, result_digest)`, where
+///   `cas_hash` and `result_digest` are `(hash, size_bytes)`, or None when they are not set
+/// * command.stdout: `(output, dropped_bytes)`
+/// * command.profile: `(memory_used, cpu_load)`
+/// * command.killed: `(reason, limit)`
+/// * invoke.start: `(smelt_root, username, hostname, git_hash, git_repo, git_branch)`
+/// * error: `(sig, error_payload)`
+/// * None for every variant without any fields
+pub(crate) fn event_to_py(py: Python<'_>, event: Event) -> PyObject {
+    let Event { time, trace_id, et } = event;
+    let (secs, nanos) = time.map_or((0, 0), |time| (time.seconds, time.nanos));
+    let (kind, command_ref, payload) = match et {
+        Some(Et::Command(command)) => {
+            let (kind, payload) = command_payload(py, command.command_variant);
+            (kind, Some(command.command_ref), payload)
+        }
+        Some(Et::Invoke(invoke)) => {
+            let (kind, payload) = invoke_payload(py, invoke.invoke_variant);
+            (kind, None, payload)
+        }
+        Some(Et::Error(error)) => ("error", None, (error.sig, error.error_payload).into_py(py)),
+        None => ("", None, py.None()),
+    };
+    (kind, trace_id, secs, nanos, command_ref, payload).into_py(py)
+}
+
+fn command_payload(py: Python<'_>, variant: Option<CommandVariant>) -> (&'static str, PyObject) {
+    match variant {
+        Some(CommandVariant::Scheduled(_)) => ("command.scheduled", py.None()),
+        Some(CommandVariant::Started(_)) => ("command.started", py.None()),
+        Some(CommandVariant::Cancelled(_)) => ("command.cancelled", py.None()),
+        Some(CommandVariant::Skipped(_)) => ("command.skipped", py.None()),
+        Some(CommandVariant::Finished(finished)) => {
+            let outputs = finished.outputs.unwrap_or_default();
+            let artifacts: Vec<(String, Option<String>, Option<(String, i64)>)> = outputs
+                .artifacts
+                .into_iter()
+                .map(|artifact| {
+                    let path = artifact.pointer.map(|Pointer::Path(path)| path);
+                    let cas_hash = artifact.cas_hash.map(digest_to_py);
+                    (artifact.artifact_name, path, cas_hash)
+                })
+                .collect();
+            let result_digest = outputs.result_digest.map(digest_to_py);
+            (
+                "command.finished",
+                (outputs.exit_code, artifacts, finished.cached, result_digest).into_py(py),
+            )
+        }
+        Some(CommandVariant::Stdout(stdout)) => (
+            "command.stdout",
+            (stdout.output, stdout.dropped_bytes).into_py(py),
+        ),
+        Some(CommandVariant::Profile(profile)) => (
+            "command.profile",
+            (profile.memory_used, profile.cpu_load).into_py(py),
+        ),
+        Some(CommandVariant::Killed(killed)) => {
+            ("command.killed", (killed.reason, killed.limit).into_py(py))
+        }
+        None => ("command.", py.None()),
+    }
+}
+
+fn digest_to_py(digest: Digest) -> (String, i64) {
+    (digest.hash, digest.size_bytes)
+}
+
+fn invoke_payload(py: Python<'_>, variant: Option<InvokeVariant>) -> (&'static str, PyObject) {
+    match variant {
+        Some(InvokeVariant::Start(start)) => (
+            "invoke.start",
+            (
+                start.smelt_root,
+                start.username,
+                start.hostname,
+                start.git_hash,
+                start.git_repo,
+                start.git_branch,
+            )
+                .into_py(py),
+        ),
+        Some(InvokeVariant::Done(_)) => ("invoke.done", py.None()),
+        Some(InvokeVariant::Set(_)) => ("invoke.set", py.None()),
+        None => ("invoke.", py.None()),
+    }
+}
@@ -1,3 +1,4 @@
+import asyncio
 import subprocess
 import math
 from typing import Generator
@@ -64,6 +65,33 @@ def test_sanity_pygraph_runone():
     # we have 3 tests, 0 of which fail -- so we should rerun no tests
 
 
+def test_async_run_all_tests():
+    """
+    Drives the asyncio api, while another task shares the event loop
+    """
+    test_list = f"{get_git_root()}/test_data/smelt_files/tests_only.smelt.yaml"
+    graph = create_graph(test_list)
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.001)
+
+    async def run_graph() -> int:
+        tick_task = asyncio.create_task(ticker())
+        events = [event async for event in graph.arun_all_tests("test")]
+        tick_task.cancel()
+        return len(events)
+
+    num_events = asyncio.run(run_graph())
+    expected_passed = 3
+    assert num_events > 0, "We should have seen events from the graph"
+    assert ticks > 0, "Running the graph should not block the event loop"
+    assert graph.retcode_tracker.total_passed() == expected_passed
+
+
 # def test_sanity_pygraph_rerun_with_failing():
 #    test_list = f"{get_git_root()}/test_data/smelt_files/failing_tests_only.smelt.yaml"
 #    graph = create_graph(test_list)
@@ -1,9 +1,26 @@
-from pysmelt.rc import SmeltRC
-from pysmelt.smelt_muncher import parse_smelt
+import json
+import pathlib
+import pickle
+from dataclasses import replace
+from typing import Dict, List
+
+import pytest
+import yaml
+from pydantic import ValidationError
+
+from pysmelt.importer import RuleRegistry
+from pysmelt.rc import SmeltRC, SmeltRcHolder
+from pysmelt import testlist_formats
+from pysmelt.testlist_formats import COLUMNAR_SUFFIX, dump_columnar, load_testlist
+from pysmelt import smelt_muncher, target_index, testlist_cache
+from pysmelt.smelt_muncher import create_universe, load_smelt_commands, parse_smelt
 
 
 from pysmelt.path_utils import get_git_root
+from pysmelt.serde import SafeDataclassDumper
+from pysmelt.interfaces.command import Command
 from pysmelt.interfaces.paths import SmeltPath
+from pysmelt.interfaces.sweep import SweepAxis
 
 
 def test_sanity_smelt_parse():
@@ -16,3 +33,410 @@ def test_sanity_smelt_parse():
 
 
 test_sanity_smelt_parse()
+
+
+def write_testlist(path: pathlib.Path, targets: Dict[str, List[str]]):
+    path.write_text(
+        yaml.safe_dump(
+            [
+                {"name": name, "rule": "test_group", "rule_args": {"tests": deps}}
+                for name, deps in targets.items()
+            ]
+        )
+    )
+
+
+def test_parallel_universe_matches_serial(tmp_path: pathlib.Path):
+    write_testlist(tmp_path / "top.smelt", {"all": ["//a.smelt:a", "//b.smelt:b"]})
+    write_testlist(tmp_path / "a.smelt", {"a": ["//c.smelt:c"]})
+    write_testlist(tmp_path / "b.smelt", {"b": ["//c.smelt:c", "//d.smelt:d"]})
+    write_testlist(tmp_path / "c.smelt", {"c": []})
+    write_testlist(tmp_path / "d.smelt", {"d": []})
+
+    old_rc = SmeltRcHolder.current_rc()
+    # no cache, so both runs actually parse every file
+    SmeltRcHolder.set_current_rc(
+        replace(old_rc, smelt_root=str(tmp_path), testlist_cache=False)
+    )
+    try:
+        top = SmeltPath.from_str("top.smelt")
+        serial = create_universe(top, default_rules_only=True, max_workers=1)
+        parallel = create_universe(top, default_rules_only=True, max_workers=2)
+    finally:
+        SmeltRcHolder.set_current_rc(old_rc)
+
+    assert set(serial.commands) == {
+        SmeltPath.from_str(name)
+        for name in ("top.smelt", "a.smelt", "b.smelt", "c.smelt", "d.smelt")
+    }
+    assert parallel.commands == serial.commands
+    assert list(parallel.commands) == list(serial.commands)
+
+
+def test_unchanged_testlists_come_from_cache(tmp_path: pathlib.Path, monkeypatch):
+    write_testlist(tmp_path / "top.smelt", {"a": [], "b": []})
+    monkeypatch.setattr(
+        SmeltRcHolder,
+        "_current_rc",
+        replace(SmeltRcHolder.current_rc(), smelt_root=str(tmp_path)),
+    )
+    top = SmeltPath.from_str("top.smelt")
+    cold = load_smelt_commands(top, default_rules_only=True)
+    assert len(list((tmp_path / "smelt-out" / ".testlist_cache").iterdir())) == 1
+
+    def no_parsing(*args, **kwargs):
+        raise AssertionError("testlist should have come from the cache")
+
+    with monkeypatch.context() as patched:
+        patched.setattr(smelt_muncher, "parse_smelt", no_parsing)
+        assert load_smelt_commands(top, default_rules_only=True) == cold
+
+    # any change to the testlist, or to pysmelt itself, is a miss
+    write_testlist(tmp_path / "top.smelt", {"a": []})
+    assert [command.name for command in load_smelt_commands(top, True)] == ["a"]
+    key = testlist_cache.cache_key(f"{tmp_path}/top.smelt", b"", True)
+    with monkeypatch.context() as patched:
+        patched.setattr(testlist_cache, "package_fingerprint", lambda: "another")
+        assert testlist_cache.cache_key(f"{tmp_path}/top.smelt", b"", True) != key
+
+
+def test_failed_stores_leave_nothing_behind(tmp_path: pathlib.Path):
+    testlist_cache.store("unpicklable", [lambda: None], tmp_path)
+    assert list(tmp_path.iterdir()) == []
+
+
+RULE_FILE = """
+from dataclasses import dataclass
+from pysmelt.interfaces import Target
+
+
+@dataclass
+class {name}(Target):
+    def gen_script(self):
+        return ["true"]
+"""
+
+
+def test_rule_index_imports_only_referenced_rules(tmp_path: pathlib.Path, monkeypatch):
+    rules_dir = tmp_path / "rules"
+    rules_dir.mkdir()
+    (rules_dir / "a.py").write_text(RULE_FILE.format(name="rule_a"))
+    (rules_dir / "b.py").write_text(RULE_FILE.format(name="rule_b"))
+    monkeypatch.setattr(
+        SmeltRcHolder,
+        "_current_rc",
+        replace(SmeltRcHolder.current_rc(), smelt_root=str(tmp_path)),
+    )
+
+    # the first process has to import everything to build the index
+    RuleRegistry.clear()
+    assert "rule_a" in RuleRegistry.resolve({"rule_a"}, rules_dir)
+    assert (tmp_path / "smelt-out" / ".rule_index.json").exists()
+
+    # later ones only import what they need
+    RuleRegistry.clear()
+    rules = RuleRegistry.resolve({"rule_b", "raw_bash"}, rules_dir)
+    assert "rule_b" in rules and "raw_bash" in rules and "rule_a" not in rules
+    assert list(RuleRegistry._loaded) == [str(rules_dir / "b.py")]
+
+    # a changed rule file gets re-indexed
+    (rules_dir / "a.py").write_text(RULE_FILE.format(name="rule_renamed"))
+    RuleRegistry.clear()
+    assert RuleRegistry.rule_index(rules_dir)["rule_renamed"] == rules_dir / "a.py"
+    RuleRegistry.clear()
+
+
+def test_testlist_formats_agree(tmp_path: pathlib.Path):
+    entries = [
+        {"name": "a", "rule": "raw_bash", "rule_args": {"cmds": ["echo a"]}},
+        {"name": "b", "rule": "test_group", "rule_args": {"tests": ["a"]}},
+        {"name": "c", "rule": "raw_bash"},
+    ]
+    (tmp_path / "list.smelt").write_text(yaml.safe_dump(entries))
+    (tmp_path / "list.json").write_text(json.dumps(entries))
+    dump_columnar(
+        testlist_formats.TestlistColumns.from_entries(entries),
+        str(tmp_path / f"list{COLUMNAR_SUFFIX}"),
+    )
+
+    loaded = [
+        smelt_muncher.columns_to_targets(
+            load_testlist(str(tmp_path / name)), default_rules_only=True
+        )
+        for name in ("list.smelt", "list.json", f"list{COLUMNAR_SUFFIX}")
+    ]
+    assert loaded[0] == loaded[1] == loaded[2]
+    assert loaded[0]["a"].cmds == ["echo a"]
+
+    with pytest.raises(ValidationError):
+        testlist_formats.TestlistColumns.from_entries([{"name": "no rule"}])
+
+
+def test_columnar_testlists_only_hold_data(tmp_path: pathlib.Path):
+    columnar = tmp_path / f"list{COLUMNAR_SUFFIX}"
+    dump_columnar(
+        testlist_formats.TestlistColumns.from_entries(
+            [{"name": "a", "rule": "raw_bash", "rule_args": {"cmds": ["echo a"]}}]
+        ),
+        str(columnar),
+    )
+    content = columnar.read_bytes()
+
+    # a pickle is never unpickled
+    (tmp_path / f"pickled{COLUMNAR_SUFFIX}").write_bytes(pickle.dumps({"version": 1}))
+    with pytest.raises(RuntimeError, match="Not a columnar testlist"):
+        load_testlist(str(tmp_path / f"pickled{COLUMNAR_SUFFIX}"))
+
+    with pytest.raises(RuntimeError, match="truncated"):
+        testlist_formats.load_columnar(content[:-4])
+    with pytest.raises(RuntimeError, match="trailing"):
+        testlist_formats.load_columnar(content + b"\0")
+
+
+def test_command_tuple_matches_dict():
+    commands = parse_smelt(
+        SmeltPath.from_str(f"{get_git_root()}/examples/tests_only.smelt"),
+        default_rules_only=True,
+    )[1]
+    for command in commands:
+        as_dict = command.to_dict()
+        runtime = as_dict["runtime"]
+        assert command.to_tuple() == (
+            as_dict["name"],
+            as_dict["target_type"],
+            as_dict["script"],
+            as_dict["dependent_files"],
+            as_dict["dependencies"],
+            as_dict["outputs"],
+            (
+                runtime["num_cpus"],
+                runtime["max_memory_mb"],
+                runtime["timeout"],
+                runtime["env"],
+            ),
+            as_dict["working_dir"],
+            as_dict["sweep"],
+        )
+
+
+def test_universe_apply_update():
+    top_file = SmeltPath.from_str(f"{get_git_root()}/examples/tests_only.smelt")
+    commands = parse_smelt(top_file, default_rules_only=True)[1]
+    universe = smelt_muncher.SmeltUniverse(
+        top_file=top_file, commands={top_file: commands}
+    )
+    first, second, *rest = commands
+    new_second = replace(second, script=["echo changed"])
+    added = replace(first, name="added")
+    other_file = SmeltPath.from_str("other.smelt")
+
+    universe.apply_update([added], [new_second], [first.name], other_file)
+
+    assert universe.commands[top_file] == [new_second, *rest]
+    assert universe.commands[other_file] == [added]
+
+
+def test_commands_share_repeated_values():
+    content = yaml.safe_dump(
+        [
+            {
+                "name": f"test_{idx}",
+                "rule": "raw_bash",
+                "rule_args": {"cmds": ["make sim"]},
+            }
+            for idx in range(2)
+        ]
+    )
+    targets = smelt_muncher.smelt_contents_to_targets(content, default_rules_only=True)
+    first, second = smelt_muncher.lower_targets_to_commands(
+        targets.values(), str(get_git_root())
+    )
+    assert first.script[0] is second.script[0]
+    assert first.runtime.env is second.runtime.env
+    assert pickle.loads(pickle.dumps(first)) == first
+    assert pickle.loads(pickle.dumps(first)).runtime.env is first.runtime.env
+
+    # a shared env can't be changed under every other command
+    with pytest.raises(TypeError):
+        first.runtime.env["FOO"] = "bar"
+    assert second.runtime.env == {}
+
+
+def test_lowered_commands_round_trip_through_yaml(tmp_path: pathlib.Path):
+    # what `smelt lower` does
+    testlist = f"{get_git_root()}/test_data/smelt_files/tests_only.smelt.yaml"
+    _, commands = parse_smelt(SmeltPath.from_str(testlist), default_rules_only=True)
+    lowered = tmp_path / "command.yaml"
+    with open(lowered, "w") as outfile:
+        yaml.dump(commands, outfile, Dumper=SafeDataclassDumper, sort_keys=False)
+
+    loaded = [Command.from_dict(data) for data in yaml.safe_load(lowered.read_text())]
+    assert loaded == commands
+    assert (
+        yaml.safe_load(yaml.safe_dump(commands[0].to_dict())) == commands[0].to_dict()
+    )
+
+
+def test_released_universes_refuse_to_be_read():
+    top_file = SmeltPath.from_str(f"{get_git_root()}/examples/tests_only.smelt")
+    commands = parse_smelt(top_file, default_rules_only=True)[1]
+    released = smelt_muncher.SmeltUniverse(
+        top_file=top_file, commands={}, released=True
+    )
+    with pytest.raises(RuntimeError, match="release_universe"):
+        released.all_commands
+    released.apply_update(commands, [], [], top_file)
+    assert released.commands == {}
+
+
+def test_target_universe_loads_only_the_closure(tmp_path: pathlib.Path, monkeypatch):
+    write_testlist(
+        tmp_path / "top.smelt",
+        {"all": ["//a.smelt:a", "//b.smelt:b"], "only_a": ["//a.smelt:a"], "x": []},
+    )
+    write_testlist(tmp_path / "a.smelt", {"a": ["//c.smelt:c"], "unused": []})
+    (tmp_path / "b.smelt").write_text(
+        yaml.safe_dump(
+            [
+                {
+                    "name": "b",
+                    "rule": "raw_bash",
+                    "rule_args": {"outputs": {"log": "b.log"}},
+                }
+            ]
+        )
+    )
+    write_testlist(tmp_path / "c.smelt", {"c": []})
+    with open(tmp_path / "top.smelt", "a") as testlist:
+        testlist.write(
+            yaml.safe_dump(
+                [
+                    {
+                        "name": "regress",
+                        "rule": "sweep",
+                        "rule_args": {
+                            "cmds": ["./simv +seed={{seed}}"],
+                            "params": {"seed": {"start": 0, "stop": 4}},
+                        },
+                    }
+                ]
+            )
+        )
+    monkeypatch.setattr(
+        SmeltRcHolder,
+        "_current_rc",
+        replace(SmeltRcHolder.current_rc(), smelt_root=str(tmp_path)),
+    )
+    top = SmeltPath.from_str("top.smelt")
+    top_abs = SmeltPath.from_str(f"{tmp_path}/top.smelt")
+
+    for _ in range(2):  # cold, then from the stored index
+        universe = target_index.create_target_universe(top, ["only_a"], True)
+        assert {
+            str(file): [command.name for command in commands]
+            for file, commands in universe.commands.items()
+        } == {
+            f"{tmp_path}/top.smelt": ["only_a"],
+            f"{tmp_path}/a.smelt": ["a"],
+            f"{tmp_path}/c.smelt": ["c"],
+        }
+
+    # an instance of a sweep pulls in the sweep, which the graph runs the instance from
+    universe = target_index.create_target_universe(
+        top, ["regress[seed=2]", "//a.smelt:a"], True
+    )
+    assert [command.name for command in universe.commands[top_abs]] == ["regress"]
+    with pytest.raises(target_index.UnresolvedTarget, match=r"x\[seed=2\]"):
+        target_index.create_target_universe(top, ["x[seed=2]"], True)
+
+    # a target that isn't there is reported straight away
+    with pytest.raises(target_index.UnresolvedTarget, match="missing"):
+        target_index.create_target_universe(top, ["missing"], True)
+
+    # a required file is looked for in the indexed testlists, then in the ones they reach
+    index = target_index.TargetIndex(default_rules_only=True)
+    index.closure(["only_a"], top)
+    (b_log,) = target_index.load_file_index(
+        SmeltPath.from_str(f"{tmp_path}/b.smelt"), True
+    ).outputs
+    assert index.producer(b_log).name == "b"
+    with pytest.raises(target_index.UnresolvedTarget):
+        index.producer("nowhere.log")
+
+
+PROCEDURAL_TESTLIST = """
+import pathlib
+from pysmelt.default_targets import raw_bash
+from pysmelt.generators.procedural import declare_inputs
+
+declare_inputs("seeds.txt")
+with open(pathlib.Path(__file__).parent / "runs.txt", "a") as runs:
+    runs.write("run\\n")
+
+raw_bash(name="build", cmds=["make"])
+
+
+def generate_targets():
+    for seed in (pathlib.Path(__file__).parent / "seeds.txt").read_text().split():
+        yield raw_bash(name=f"seed_{seed}", cmds=[f"./simv +seed={seed}"], deps=["build"])
+"""
+
+
+def test_procedural_testlists_are_cached_on_their_inputs(
+    tmp_path: pathlib.Path, monkeypatch
+):
+    (tmp_path / "sweep.py").write_text(PROCEDURAL_TESTLIST)
+    (tmp_path / "seeds.txt").write_text("1 2 3")
+    monkeypatch.setattr(
+        SmeltRcHolder,
+        "_current_rc",
+        replace(SmeltRcHolder.current_rc(), smelt_root=str(tmp_path)),
+    )
+    testlist = SmeltPath.from_str("sweep.py")
+
+    def names():
+        return [command.name for command in load_smelt_commands(testlist)]
+
+    assert names() == ["build", "seed_1", "seed_2", "seed_3"]
+    assert names() == ["build", "seed_1", "seed_2", "seed_3"]
+    assert (tmp_path / "runs.txt").read_text().count("run") == 1
+
+    # a changed input re-runs the script
+    (tmp_path / "seeds.txt").write_text("4")
+    assert names() == ["build", "seed_4"]
+    assert (tmp_path / "runs.txt").read_text().count("run") == 2
+
+
+def test_sweeps_lower_to_a_single_command():
+    targets = smelt_muncher.smelt_contents_to_targets(
+        yaml.safe_dump(
+            [
+                {
+                    "name": "regress",
+                    "rule": "sweep",
+                    "rule_args": {
+                        "cmds": ["./simv +seed={{seed}} +mode={{mode}}"],
+                        "params": {
+                            "mode": ["fast", "slow"],
+                            "seed": {"start": 10, "stop": 20, "step": 3},
+                        },
+                        "outputs": {"log": "{{mode}}/{{seed}}.log"},
+                    },
+                }
+            ]
+        ),
+        default_rules_only=True,
+    )
+    (command,) = smelt_muncher.lower_targets_to_commands(targets.values(), "/")
+
+    assert command.name == "regress"
+    assert command.script == ["./simv +seed={{seed}} +mode={{mode}}"]
+    assert [(axis.name, len(axis)) for axis in command.sweep] == [
+        ("mode", 2),
+        ("seed", 4),
+    ]
+    assert len(SweepAxis(name="seed", start=10, stop=0, step=-4)) == 3
+    with pytest.raises(ValueError):
+        SweepAxis(name="seed", stop=10, step=0)
+    assert Command.from_tuple(command.to_tuple()) == command
+    assert Command.from_dict(command.to_dict()) == command
@@ -0,0 +1,303 @@
+import threading
+from types import SimpleNamespace
+from typing import List, cast
+
+import betterproto
+import pytest
+from rich.progress import Task
+
+from pysmelt.output import smelt_console
+from pysmelt.proto.executed_tests import Digest, TestOutputs
+from pysmelt.proto.smelt_telemetry import (
+    AllCommandsDone,
+    CommandEvent,
+    CommandFinished,
+    CommandKilled,
+    CommandScheduled,
+    CommandStarted,
+    CommandStdout,
+    Event,
+    InvokeEvent,
+    KillReason,
+)
+from pysmelt.subscribers import EventDispatcher, classify_event, classify_native
+from pysmelt.subscribers.is_done import IsDoneSubscriber
+from pysmelt.subscribers.output_collector import (
+    LineReporter,
+    OutputConsole,
+    RenderableTree,
+)
+from pysmelt.subscribers.retcode import RetcodeTracker
+from pysmelt.subscribers.stdout import StdoutPrinter
+from pysmelt.subscribers.threaded import ThreadedDispatcher
+
+
+def finished(name: str, exit_code: int) -> Event:
+    return Event(
+        command=CommandEvent(
+            command_ref=name,
+            finished=CommandFinished(outputs=TestOutputs(exit_code=exit_code)),
+        )
+    )
+
+
+def stdout(name: str, output: str) -> Event:
+    return Event(
+        command=CommandEvent(command_ref=name, stdout=CommandStdout(output=output))
+    )
+
+
+def scheduled(name: str) -> Event:
+    return Event(command=CommandEvent(command_ref=name, scheduled=CommandScheduled()))
+
+
+def started(name: str) -> Event:
+    return Event(command=CommandEvent(command_ref=name, started=CommandStarted()))
+
+
+def done() -> Event:
+    return Event(invoke=InvokeEvent(done=AllCommandsDone()))
+
+
+def test_classify_event():
+    event = classify_event(finished("a", 1))
+    assert event.kind == "command.finished"
+    assert event.variant == "finished"
+    assert event.command_ref == "a"
+    assert event.payload.outputs.exit_code == 1
+
+    assert classify_event(done()).kind == "invoke.done"
+
+
+class Legacy:
+    """
+    Subscriber that doesn't declare `event_kinds`
+    """
+
+    def __init__(self):
+        self.seen: List[Event] = []
+
+    def process_message(self, message: Event):
+        self.seen.append(message)
+
+
+def test_dispatch_routes_by_kind():
+    retcodes = RetcodeTracker()
+    is_done = IsDoneSubscriber()
+    lines: List[str] = []
+    printer = StdoutPrinter("a", lines.append)
+    legacy = Legacy()
+    dispatcher = EventDispatcher([retcodes, is_done, printer, legacy])
+
+    events = [stdout("a", "hello"), finished("a", 0), finished("b", 3), done()]
+    for event in events:
+        dispatcher.dispatch(event)
+
+    assert retcodes.retcode_dict == {"a": 0, "b": 3}
+    assert is_done.is_done
+    assert lines == ["hello"]
+    # subscribers without `event_kinds` still see everything
+    assert legacy.seen == events
+
+
+def test_process_message_still_filters():
+    retcodes = RetcodeTracker()
+    retcodes.process_message(stdout("a", "hello"))
+    retcodes.process_message(finished("a", 2))
+    assert retcodes.retcode_dict == {"a": 2}
+
+
+def test_subscription_covers_every_subscriber():
+    dispatcher = EventDispatcher(
+        [RetcodeTracker(), IsDoneSubscriber(), StdoutPrinter("a", print)]
+    )
+    subscription = dispatcher.subscription(stdout_commands=["a"])
+    assert subscription is not None
+    assert subscription.command_variants == ["finished", "stdout"]
+    assert subscription.stdout_commands == ["a"]
+
+    # a subscriber that doesn't say what it wants gets everything
+    assert EventDispatcher([RetcodeTracker(), Legacy()]).subscription() is None
+
+
+def test_stdout_printer_reports_dropped_output():
+    lines: List[str] = []
+    printer = StdoutPrinter("a", lines.append)
+    printer.process_message(stdout("a", "hello"))
+    printer.process_message(
+        Event(
+            command=CommandEvent(
+                command_ref="a", stdout=CommandStdout(output="", dropped_bytes=12)
+            )
+        )
+    )
+    assert lines[0] == "hello"
+    assert "12 more bytes" in lines[1]
+
+
+def test_native_events_match_protobuf():
+    native = (
+        "command.finished",
+        "trace",
+        1_700_000_000,
+        123_456_000,
+        "a",
+        (
+            3,
+            [
+                ("smelt_log", "/tmp/a/command.out", ("ab" * 32, 12)),
+                ("waves", None, None),
+            ],
+            True,
+            ("cd" * 32, 4),
+        ),
+    )
+    event = classify_native(native)
+    assert event.kind == "command.finished"
+    assert event.command_ref == "a"
+    assert event.payload.outputs.exit_code == 3
+    assert event.payload.outputs.artifacts[0].path == "/tmp/a/command.out"
+    assert event.payload.outputs.artifacts[0].cas_hash == Digest(
+        hash="ab" * 32, size_bytes=12
+    )
+    assert event.payload.outputs.result_digest.hash == "cd" * 32
+    assert event.payload.cached
+
+    # the lazily built event is the same as one that went through protobuf
+    decoded = classify_event(Event.FromString(bytes(event.event)))
+    assert decoded.kind == event.kind
+    assert decoded.time == event.time
+    assert decoded.payload == event.payload
+    assert decoded.payload.outputs.artifacts[0].cas_hash.size_bytes == 12
+    assert decoded.payload.outputs.result_digest.size_bytes == 4
+    assert not betterproto.serialized_on_wire(
+        decoded.payload.outputs.artifacts[1].cas_hash
+    )
+    assert (
+        betterproto.which_one_of(decoded.payload.outputs.artifacts[1], "pointer")[0]
+        == ""
+    )
+
+    start = classify_native(
+        ("invoke.start", "trace", 0, 0, None, ("/root", "me", "host", "", "", ""))
+    )
+    assert start.payload.username == "me"
+    assert classify_native(("error", "trace", 0, 0, None, (1, "boom"))).payload.sig == 1
+
+    # events with no variant set still classify, with no payload
+    for kind in ("command.", "invoke.", ""):
+        empty = classify_native((kind, "trace", 0, 0, "a", None))
+        assert empty.kind == kind
+        assert empty.payload is None
+        assert empty.event.trace_id == "trace"
+
+
+class Blocking:
+    """
+    Subscriber that holds up the worker until `release` is set
+    """
+
+    event_kinds = frozenset({"command.stdout", "command.finished"})
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.seen: List[str] = []
+
+    def process_event(self, event):
+        self.release.wait()
+        self.seen.append(event.kind)
+
+
+def test_threaded_dispatch_drops_only_stdout():
+    blocking = Blocking()
+    with ThreadedDispatcher(EventDispatcher([blocking]), max_queued=2) as threaded:
+        for idx in range(10):
+            threaded.dispatch_classified(classify_event(stdout("a", f"line {idx}")))
+        blocking.release.set()
+        threaded.dispatch_classified(classify_event(finished("a", 0)))
+
+    assert threaded.stats.dropped > 0
+    assert threaded.stats.dispatched == len(blocking.seen)
+    assert threaded.stats.max_depth <= 2
+    # stdout can be dropped, but finished always arrives, and in order
+    assert blocking.seen[-1] == "command.finished"
+
+
+def test_threaded_dispatch_reraises_subscriber_errors():
+    class Broken:
+        event_kinds = frozenset({"command.finished"})
+
+        def process_event(self, event):
+            raise ValueError("broken subscriber")
+
+    threaded = ThreadedDispatcher(EventDispatcher([Broken()]))
+    threaded.start()
+    threaded.dispatch_classified(classify_event(finished("a", 0)))
+    with pytest.raises(ValueError, match="broken subscriber"):
+        threaded.close()
+
+
+def test_live_display_caps_running_commands():
+    console = OutputConsole(max_visible=3)
+    for idx in range(10):
+        console.process_message(scheduled(f"cmd{idx}"))
+        console.process_message(started(f"cmd{idx}"))
+    console.process_message(finished("cmd0", 0))
+
+    assert list(console.running) == [f"cmd{idx}" for idx in range(1, 10)]
+    tree = RenderableTree().render(
+        cast(Task, SimpleNamespace(fields={"fields": {"console": console}}))
+    )
+    labels = [str(child.label) for child in tree.children]
+    assert labels == [
+        "Running cmd1",
+        "Running cmd2",
+        "Running cmd3",
+        "and 6 more running",
+    ]
+    assert "1/10 done" in str(tree.label)
+
+
+def test_line_reporter_prints_finished_commands():
+    reporter = LineReporter()
+    with smelt_console.capture() as capture:
+        reporter.process_message(scheduled("a"))
+        reporter.process_message(scheduled("b"))
+        reporter.process_message(started("a"))
+        reporter.process_message(finished("a", 1))
+    assert capture.get().strip().startswith("[1/2] a FAILED, code: 1")
+
+
+def test_cached_commands_never_started():
+    reporter = LineReporter()
+    cached = finished("build", 0)
+    cached.command.finished.cached = True
+    with smelt_console.capture() as capture:
+        reporter.process_message(scheduled("build"))
+        reporter.process_message(cached)
+    assert capture.get().strip().startswith("[1/1] build CACHED")
+    assert reporter.total_executing == 0
+    assert reporter.total_cached == 1
+    assert reporter.total_run - reporter.total_passed == 0
+
+
+def test_killed_commands_are_reported():
+    reporter = LineReporter()
+    killed = Event(
+        command=CommandEvent(
+            command_ref="sim",
+            killed=CommandKilled(reason=KillReason.TIMED_OUT, limit=30),
+        )
+    )
+    with smelt_console.capture() as capture:
+        reporter.process_message(scheduled("sim"))
+        reporter.process_message(started("sim"))
+        reporter.process_message(killed)
+        reporter.process_message(finished("sim", -124))
+    lines = capture.get().strip().splitlines()
+    assert lines[0].endswith("sim KILLED, ran past its 30s timeout")
+    assert lines[1].startswith("[1/1] sim TIMED OUT")
+    assert reporter.killed_list == ["sim"]
+
+    native = classify_native(("command.killed", "trace", 0, 0, "sim", (1, 512)))
+    assert native.payload == CommandKilled(reason=KillReason.OUT_OF_MEMORY, limit=512)